@@ -2,9 +2,8 @@ const Attendance = require('../models/attendance.models');
 const User = require('../models/user.models');
 const mongoose = require('mongoose');
 const cloudinary = require('cloudinary').v2;
-const { spawn } = require('child_process');
-const path = require('path');
-const fs = require('fs');
+const { getFaceEncodingFromBase64, getFaceEncodingFromBuffer } = require('../utils/faceWorker');
+const { identifyFace } = require('../utils/faceService');
 
 // Helper to get start of day for consistent date querying
 const getStartOfDay = (date) => {
@@ -491,62 +490,47 @@ exports.getMyAttendanceSummary = async (req, res) => {
     }
 };
 
-const scriptPath = path.join(__dirname, '..', '..', 'face_recognition_service', 'face_scan.py');
-
 exports.scanAndMarkAttendance = async (req, res) => {
   try {
-    const { faceImage, method = 'face', location } = req.body;
-    if (!faceImage) {
+    // 1. The image arrives either as the raw request body (application/octet-stream
+    // or image/*, with method and location in the query string) or as base64
+    // in a JSON body
+    const rawImage = Buffer.isBuffer(req.body) && req.body.length ? req.body : null;
+    const { faceImage, method = 'face', location } = rawImage ? req.query : req.body;
+    if (!rawImage && !faceImage) {
       return res.status(400).json({ message: 'Face image is required.' });
     }
-    // 1. Save the base64 image to a temporary file
-    const tmpDir = path.join(__dirname, '../../tmp');
-    if (!fs.existsSync(tmpDir)) fs.mkdirSync(tmpDir);
-    const tmpFile = path.join(tmpDir, `scan_${Date.now()}.jpg`);
-    fs.writeFileSync(tmpFile, Buffer.from(faceImage, 'base64'));
-
-    // 2. Call Python script to get face encoding (pass local file path)
-    const getFaceEncoding = (imagePath) => {
-      return new Promise((resolve, reject) => {
-        const py = spawn('python', [scriptPath, imagePath]);
-        let result = '';
-        let error = '';
-        py.stdout.on('data', (data) => { result += data.toString(); });
-        py.stderr.on('data', (data) => { error += data.toString(); });
-        py.on('close', (code) => {
-          fs.unlinkSync(tmpFile); // Clean up temp file
-          if (code !== 0 || error) return reject(error || 'Python process failed');
-          try {
-            const parsed = JSON.parse(result);
-            if (parsed.success) resolve(parsed.encoding);
-            else reject(parsed.error);
-          } catch (e) {
-            reject('Invalid JSON from Python');
-          }
-        });
-      });
-    };
+    if (rawImage) req.body = {};
 
+    // 2. Get face encoding from the resident Python worker; the image is
+    // handed over in memory, never through a temporary file
     let scanEncoding;
     try {
-      scanEncoding = await getFaceEncoding(tmpFile);
+      scanEncoding = await (rawImage ? getFaceEncodingFromBuffer(rawImage) : getFaceEncodingFromBase64(faceImage));
     } catch (err) {
       return res.status(400).json({ message: 'Face encoding failed: ' + err });
     }
 
-    // 3. Compare encoding to all users
-    const users = await User.find({ faceEmbeddings: { $exists: true, $ne: [] } });
-    const euclideanDistance = (a, b) => {
-      if (!a || !b || a.length !== b.length) return Infinity;
-      return Math.sqrt(a.reduce((sum, v, i) => sum + Math.pow(v - b[i], 2), 0));
-    };
+    // 3. Let the face service search its gallery index
     let matchedUser = null;
-    let minDistance = Infinity;
-    for (const user of users) {
-      const dist = euclideanDistance(scanEncoding, user.faceEmbeddings);
-      if (dist < 0.6 && dist < minDistance) { // 0.6 is a common threshold
-        minDistance = dist;
-        matchedUser = user;
+    try {
+      const { employeeId } = await identifyFace(scanEncoding);
+      if (employeeId) matchedUser = await User.findOne({ employeeId });
+    } catch (err) {
+      // Face service unreachable: fall back to comparing against all users
+      console.error('Face service identify failed, scanning users:', err.message);
+      const users = await User.find({ faceEmbeddings: { $exists: true, $ne: [] } });
+      const euclideanDistance = (a, b) => {
+        if (!a || !b || a.length !== b.length) return Infinity;
+        return Math.sqrt(a.reduce((sum, v, i) => sum + Math.pow(v - b[i], 2), 0));
+      };
+      let minDistance = Infinity;
+      for (const user of users) {
+        const dist = euclideanDistance(scanEncoding, user.faceEmbeddings);
+        if (dist < 0.6 && dist < minDistance) { // 0.6 is a common threshold
+          minDistance = dist;
+          matchedUser = user;
+        }
       }
     }
     if (!matchedUser) {
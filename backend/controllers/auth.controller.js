@@ -2,10 +2,11 @@ const User = require('../models/user.models');
 const bcrypt = require('bcryptjs');
 const jwt = require('jsonwebtoken');
 const fetch = require('node-fetch');
+const crypto = require('crypto');
 const cloudinary = require('cloudinary').v2;
-const { spawn } = require('child_process');
-const path = require('path');
-const scriptPath = path.join(__dirname, '..', '..', 'face_recognition_service', 'face_scan.py');
+const { getFaceEncodingFromBase64 } = require('../utils/faceWorker');
+const { syncGalleryFace } = require('../utils/faceService');
+const { archiveUrl, enqueueArchive } = require('../utils/archiveQueue');
 
 // Configure Cloudinary (make sure your .env has these variables)
 cloudinary.config({
@@ -377,42 +378,19 @@ exports.registerWithFace = async (req, res) => {
       return res.status(409).json({ message: 'User already exists.' });
     }
 
-    // 1. Upload image to Cloudinary
-    const dataUri = `data:image/jpeg;base64,${faceImage}`;
-    const uploadResult = await cloudinary.uploader.upload(dataUri, {
-      folder: 'employee_faces',
-      resource_type: 'image',
-    });
-    const cloudinaryUrl = uploadResult.secure_url;
-
-    // 2. Call Python script to get face encoding
-    const getFaceEncoding = (imageUrl) => {
-      return new Promise((resolve, reject) => {
-        const py = spawn('python', [scriptPath, imageUrl]);
-        let result = '';
-        let error = '';
-        py.stdout.on('data', (data) => { result += data.toString(); });
-        py.stderr.on('data', (data) => { error += data.toString(); });
-        py.on('close', (code) => {
-          if (code !== 0 || error) return reject(error || 'Python process failed');
-          try {
-            const parsed = JSON.parse(result);
-            if (parsed.success) resolve(parsed.encoding);
-            else reject(parsed.error);
-          } catch (e) {
-            reject('Invalid JSON from Python');
-          }
-        });
-      });
-    };
-
+    // 1. Get face encoding from the resident Python worker, straight from the request bytes
     let faceEncoding;
     try {
-      faceEncoding = await getFaceEncoding(cloudinaryUrl);
+      faceEncoding = await getFaceEncodingFromBase64(faceImage);
     } catch (err) {
       return res.status(400).json({ message: 'Face encoding failed: ' + err });
     }
 
+    // 2. Queue the image for Cloudinary; its URL is known before the upload
+    const publicId = `employee_faces/${crypto.randomUUID()}`;
+    await enqueueArchive(faceImage, publicId);
+    const cloudinaryUrl = archiveUrl(publicId);
+
     // 3. Hash password
     const hashedPassword = await bcrypt.hash(password, 10);
 
@@ -427,11 +405,16 @@ exports.registerWithFace = async (req, res) => {
       employeeId: await generateEmployeeId(),
       faceImageUrl: cloudinaryUrl,
       faceEmbeddings: faceEncoding,
+      faceColorSpace: 'rgb',
     });
     await user.save();
+    const galleryIndexed = await syncGalleryFace(user.employeeId, faceEncoding, req.headers.authorization);
 
     res.status(201).json({
-      message: 'User and face registered successfully.',
+      message: galleryIndexed
+        ? 'User and face registered successfully.'
+        : 'User and face registered, but the face service did not index the face; it will be recognized after the service restarts.',
+      galleryIndexed,
       user: {
         employeeId: user.employeeId,
         name: user.name,
@@ -457,49 +440,33 @@ exports.addFaceToUser = async (req, res) => {
     const user = await User.findOne({ email });
     if (!user) return res.status(404).json({ message: 'User not found.' });
 
-    // 1. Upload image to Cloudinary
-    const dataUri = `data:image/jpeg;base64,${faceImage}`;
-    const uploadResult = await cloudinary.uploader.upload(dataUri, {
-      folder: 'employee_faces',
-      resource_type: 'image',
-    });
-    const cloudinaryUrl = uploadResult.secure_url;
-
-    // 2. Call Python script to get face encoding
-    const getFaceEncoding = (imageUrl) => {
-      return new Promise((resolve, reject) => {
-        const py = spawn('python', [scriptPath, imageUrl]);
-        let result = '';
-        let error = '';
-        py.stdout.on('data', (data) => { result += data.toString(); });
-        py.stderr.on('data', (data) => { error += data.toString(); });
-        py.on('close', (code) => {
-          if (code !== 0 || error) return reject(error || 'Python process failed');
-          try {
-            const parsed = JSON.parse(result);
-            if (parsed.success) resolve(parsed.encoding);
-            else reject(parsed.error);
-          } catch (e) {
-            reject('Invalid JSON from Python');
-          }
-        });
-      });
-    };
-
+    // 1. Get face encoding from the resident Python worker, straight from the request bytes
     let faceEncoding;
     try {
-      faceEncoding = await getFaceEncoding(cloudinaryUrl);
+      faceEncoding = await getFaceEncodingFromBase64(faceImage);
     } catch (err) {
       return res.status(400).json({ message: 'Face encoding failed: ' + err });
     }
 
+    // 2. Queue the image for Cloudinary; its URL is known before the upload
+    const publicId = `employee_faces/${crypto.randomUUID()}`;
+    await enqueueArchive(faceImage, publicId);
+    const cloudinaryUrl = archiveUrl(publicId);
+
     // 3. Update user in MongoDB with Cloudinary URL and face encoding
     user.faceImageUrl = cloudinaryUrl;
     user.faceEmbeddings = faceEncoding;
+    user.faceColorSpace = 'rgb';
     await user.save();
+    const galleryIndexed = user.employeeId
+      ? await syncGalleryFace(user.employeeId, faceEncoding, req.headers.authorization)
+      : false;
 
     res.json({
-      message: 'Face registered successfully.',
+      message: galleryIndexed
+        ? 'Face registered successfully.'
+        : 'Face registered, but the face service did not index it; it will be recognized after the service restarts.',
+      galleryIndexed,
       faceImageUrl: user.faceImageUrl,
     });
   } catch (err) {
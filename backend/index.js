@@ -57,4 +57,6 @@ app.use('/api/analytics', require('./routes/analytics.routes'));
 const PORT = process.env.PORT || 5000;
 app.listen(PORT, () => {
   console.log(`Server running on port ${PORT}`);
+  // Finish archiving face images spooled before the last shutdown
+  require('./utils/archiveQueue').resumeArchives();
 }); 
\ No newline at end of file
@@ -36,6 +36,12 @@ const userSchema = new mongoose.Schema({
     type: Array,
     default: []
   },
+  // Channel order the embeddings were computed from; embeddings without it
+  // predate the RGB pipeline and are re-encoded by reencode_faces.py
+  faceColorSpace: {
+    type: String,
+    enum: ['bgr', 'rgb']
+  },
   faceImageUrl: {
     type: String,
     default: ''
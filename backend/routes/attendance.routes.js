@@ -20,7 +20,7 @@ router.get('/admin/payroll', authMiddleware.verifyToken, authMiddleware.verifyAd
 router.get('/my-records', authMiddleware.verifyToken, attendanceController.getMyAttendanceRecords);
 router.get('/my-summary', authMiddleware.verifyToken, attendanceController.getMyAttendanceSummary);
 
-// New POST route '/scan'
-router.post('/scan', attendanceController.scanAndMarkAttendance);
+// New POST route '/scan': JSON { faceImage: base64 } or the raw image bytes
+router.post('/scan', express.raw({ type: ['application/octet-stream', 'image/*'], limit: '10mb' }), attendanceController.scanAndMarkAttendance);
 
 module.exports = router; 
\ No newline at end of file
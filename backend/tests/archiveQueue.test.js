@@ -0,0 +1,84 @@
+const test = require('node:test');
+const assert = require('node:assert');
+const fs = require('fs');
+const os = require('os');
+const path = require('path');
+
+// Configure the queue before it is loaded: a throwaway spool, short backoff
+const root = fs.mkdtempSync(path.join(os.tmpdir(), 'archive-queue-test-'));
+const spoolDir = path.join(root, 'spool');
+const uploadedDir = path.join(root, 'uploaded');
+process.env.ARCHIVE_SPOOL_DIR = spoolDir;
+process.env.ARCHIVE_MAX_ATTEMPTS = '3';
+process.env.ARCHIVE_BACKOFF_MS = '20';
+
+const { enqueueArchive, resumeArchives, setUploader } = require('../utils/archiveQueue');
+
+// Local stand-in for Cloudinary: copies the spooled file into uploadedDir,
+// failing the first `failures` attempts of each public id
+const localUploader = (failures = 0) => {
+  const attempts = {};
+  const upload = async (file, job) => {
+    attempts[job.publicId] = (attempts[job.publicId] || []).concat(Date.now());
+    if (attempts[job.publicId].length <= failures) throw new Error('upload failed');
+    await fs.promises.mkdir(uploadedDir, { recursive: true });
+    await fs.promises.copyFile(file, path.join(uploadedDir, job.publicId));
+  };
+  return { upload, attempts };
+};
+
+const waitFor = async (condition, timeoutMs = 5000) => {
+  const deadline = Date.now() + timeoutMs;
+  while (Date.now() < deadline) {
+    if (condition()) return true;
+    await new Promise((resolve) => setTimeout(resolve, 10));
+  }
+  return condition();
+};
+
+const spooled = () => fs.readdirSync(spoolDir).filter((name) => name.endsWith('.json'));
+
+test.after(() => fs.rmSync(root, { recursive: true, force: true }));
+
+test('retries with backoff until the upload succeeds', async () => {
+  const uploader = localUploader(2);
+  setUploader(uploader.upload);
+  await enqueueArchive(Buffer.from('image-1').toString('base64'), 'retry');
+
+  assert.ok(await waitFor(() => fs.existsSync(path.join(uploadedDir, 'retry'))));
+  const times = uploader.attempts.retry;
+  assert.strictEqual(times.length, 3);
+  // Retry n waits BACKOFF_MS * 2 ** (n - 1), less at most half for jitter
+  assert.ok(times[1] - times[0] >= 10);
+  assert.ok(times[2] - times[1] >= 20);
+  assert.strictEqual(fs.readFileSync(path.join(uploadedDir, 'retry'), 'utf8'), 'image-1');
+  assert.ok(await waitFor(() => spooled().length === 0));
+});
+
+test('moves a job to failed/ after the last attempt', async () => {
+  const uploader = localUploader(100);
+  setUploader(uploader.upload);
+  const id = await enqueueArchive(Buffer.from('image-2').toString('base64'), 'gives-up');
+
+  const failedJob = path.join(spoolDir, 'failed', `${id}.json`);
+  assert.ok(await waitFor(() => fs.existsSync(failedJob)));
+  assert.strictEqual(uploader.attempts['gives-up'].length, 3);
+  const job = JSON.parse(fs.readFileSync(failedJob, 'utf8'));
+  assert.strictEqual(job.attempts, 3);
+  assert.strictEqual(job.lastError, 'upload failed');
+  assert.strictEqual(fs.readFileSync(path.join(spoolDir, 'failed', `${id}.bin`), 'utf8'), 'image-2');
+  assert.ok(await waitFor(() => spooled().length === 0));
+});
+
+test('resumes jobs spooled by a previous run', async () => {
+  const uploader = localUploader();
+  setUploader(uploader.upload);
+  fs.writeFileSync(path.join(spoolDir, 'left-over.bin'), 'image-3');
+  fs.writeFileSync(path.join(spoolDir, 'left-over.json'), JSON.stringify({ publicId: 'resumed', attempts: 1 }));
+
+  resumeArchives();
+
+  assert.ok(await waitFor(() => fs.existsSync(path.join(uploadedDir, 'resumed'))));
+  assert.strictEqual(fs.readFileSync(path.join(uploadedDir, 'resumed'), 'utf8'), 'image-3');
+  assert.ok(await waitFor(() => spooled().length === 0));
+});
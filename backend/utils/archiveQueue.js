@@ -0,0 +1,106 @@
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+const cloudinary = require('cloudinary').v2;
+
+const SPOOL_DIR = process.env.ARCHIVE_SPOOL_DIR || path.join(__dirname, '..', '..', 'tmp', 'archive_spool');
+const CONCURRENCY = Number(process.env.ARCHIVE_CONCURRENCY || 2);
+const MAX_ATTEMPTS = Number(process.env.ARCHIVE_MAX_ATTEMPTS || 8);
+const BACKOFF_MS = Number(process.env.ARCHIVE_BACKOFF_MS || 2000);
+const MAX_BACKOFF_MS = Number(process.env.ARCHIVE_MAX_BACKOFF_MS || 600000);
+
+// Images are spooled to disk before the request returns and uploaded to
+// Cloudinary in the background with retries, so enrollment only waits for
+// encoding and the database write. Spooled jobs left over from a previous
+// run are resumed on startup.
+const ready = [];
+let active = 0;
+let uploadImage = (file, job) =>
+  cloudinary.uploader.upload(file, { public_id: job.publicId, resource_type: 'image' });
+
+const jobPath = (id, ext) => path.join(SPOOL_DIR, `${id}.${ext}`);
+
+// URL an image will have once uploaded, known before the upload happens
+const archiveUrl = (publicId) => cloudinary.url(publicId, { secure: true, resource_type: 'image' });
+
+const drain = () => {
+  while (active < CONCURRENCY && ready.length) {
+    const id = ready.shift();
+    active += 1;
+    attempt(id).finally(() => {
+      active -= 1;
+      drain();
+    });
+  }
+};
+
+const schedule = (id, delayMs) => {
+  if (delayMs > 0) {
+    setTimeout(() => {
+      ready.push(id);
+      drain();
+    }, delayMs).unref();
+  } else {
+    ready.push(id);
+    drain();
+  }
+};
+
+const attempt = async (id) => {
+  let job;
+  try {
+    job = JSON.parse(await fs.promises.readFile(jobPath(id, 'json'), 'utf8'));
+  } catch (err) {
+    console.error(`Archive job ${id} unreadable:`, err.message);
+    return;
+  }
+  try {
+    await uploadImage(jobPath(id, 'bin'), job);
+    await fs.promises.unlink(jobPath(id, 'json'));
+    await fs.promises.unlink(jobPath(id, 'bin'));
+  } catch (err) {
+    job.attempts += 1;
+    job.lastError = err.message;
+    if (job.attempts >= MAX_ATTEMPTS) {
+      console.error(`Giving up archiving ${job.publicId} after ${job.attempts} attempts:`, err.message);
+      const failedDir = path.join(SPOOL_DIR, 'failed');
+      await fs.promises.mkdir(failedDir, { recursive: true });
+      await fs.promises.rename(jobPath(id, 'bin'), path.join(failedDir, `${id}.bin`));
+      // Keep the final attempt count and error with the failed job
+      const failedJob = path.join(failedDir, `${id}.json`);
+      await fs.promises.writeFile(`${failedJob}.tmp`, JSON.stringify(job));
+      await fs.promises.rename(`${failedJob}.tmp`, failedJob);
+      await fs.promises.unlink(jobPath(id, 'json'));
+      return;
+    }
+    const delay = Math.min(BACKOFF_MS * 2 ** (job.attempts - 1), MAX_BACKOFF_MS) * (0.5 + Math.random() / 2);
+    console.error(`Archiving ${job.publicId} failed (${err.message}), retrying in ${Math.round(delay)}ms`);
+    await fs.promises.writeFile(jobPath(id, 'json'), JSON.stringify(job));
+    schedule(id, delay);
+  }
+};
+
+// Spool base64 image bytes for upload under publicId; resolves once the
+// job is on disk
+const enqueueArchive = async (imageB64, publicId) => {
+  await fs.promises.mkdir(SPOOL_DIR, { recursive: true });
+  const id = crypto.randomUUID();
+  await fs.promises.writeFile(jobPath(id, 'bin'), Buffer.from(imageB64, 'base64'));
+  await fs.promises.writeFile(jobPath(id, 'json'), JSON.stringify({ publicId, attempts: 0 }));
+  schedule(id, 0);
+  return id;
+};
+
+const resumeArchives = () => {
+  if (!fs.existsSync(SPOOL_DIR)) return;
+  for (const name of fs.readdirSync(SPOOL_DIR)) {
+    if (name.endsWith('.json')) schedule(name.slice(0, -'.json'.length), 0);
+  }
+};
+
+// Replace the upload target, e.g. with a local stand-in in tests
+const setUploader = (uploader) => {
+  uploadImage = uploader;
+};
+
+module.exports = { archiveUrl, enqueueArchive, resumeArchives, setUploader };
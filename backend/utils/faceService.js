@@ -0,0 +1,46 @@
+const fetch = require('node-fetch');
+
+const FACE_SERVICE_URL = process.env.FACE_SERVICE_URL || 'http://localhost:8000';
+
+// Headers authenticating the backend to the face service: the shared
+// FACE_SERVICE_TOKEN, or else the caller's admin token when there is one
+const serviceHeaders = (authorization) => {
+  const headers = { 'Content-Type': 'application/json' };
+  if (process.env.FACE_SERVICE_TOKEN) headers['X-Service-Token'] = process.env.FACE_SERVICE_TOKEN;
+  else if (authorization) headers.Authorization = authorization;
+  return headers;
+};
+
+// Ask the face service which employee an encoding belongs to. Resolves with
+// { employeeId, distance }; employeeId is null when nobody is within tolerance.
+const identifyFace = async (encoding) => {
+  const response = await fetch(`${FACE_SERVICE_URL}/face-recognition/identify`, {
+    method: 'POST',
+    headers: serviceHeaders(),
+    body: JSON.stringify({ encoding }),
+  });
+  if (!response.ok) throw new Error(`Face service responded with ${response.status}`);
+  const data = await response.json();
+  return { employeeId: data.employeeId || null, distance: data.distance };
+};
+
+// Index a freshly enrolled encoding in the face service's gallery. Authenticates
+// with the shared FACE_SERVICE_TOKEN, falling back to the caller's admin token.
+// Resolves with true once indexed and false otherwise; the gallery catches up
+// on the service's next restart.
+const syncGalleryFace = async (employeeId, encoding, authorization) => {
+  try {
+    const response = await fetch(`${FACE_SERVICE_URL}/api/admin/gallery/${encodeURIComponent(employeeId)}`, {
+      method: 'PUT',
+      headers: serviceHeaders(authorization),
+      body: JSON.stringify({ encoding }),
+    });
+    if (response.ok) return true;
+    console.error(`Gallery sync for ${employeeId} failed with ${response.status}`);
+  } catch (err) {
+    console.error('Gallery sync error:', err.message);
+  }
+  return false;
+};
+
+module.exports = { identifyFace, syncGalleryFace };
@@ -0,0 +1,99 @@
+const { spawn } = require('child_process');
+const path = require('path');
+const readline = require('readline');
+
+const scriptPath = path.join(__dirname, '..', '..', 'face_recognition_service', 'face_scan.py');
+const WORKER_PROCESSES = process.env.FACE_WORKER_PROCESSES || '1';
+const JOB_TIMEOUT_MS = Number(process.env.FACE_WORKER_TIMEOUT_MS || 30000);
+
+// One long-lived `face_scan.py --worker` process shared by all requests, so
+// the Python interpreter and dlib models are loaded once instead of per scan.
+let worker = null;
+let nextJobId = 1;
+const pending = new Map();
+
+const failPending = (reason) => {
+  for (const { reject, timer } of pending.values()) {
+    clearTimeout(timer);
+    reject(reason);
+  }
+  pending.clear();
+};
+
+// Drop a worker that failed and reject its jobs; later events from a worker
+// that was already replaced are ignored
+const retire = (py, reason) => {
+  if (worker !== py) return;
+  worker = null;
+  failPending(reason);
+};
+
+const startWorker = () => {
+  const py = spawn('python', [scriptPath, '--worker', '--workers', WORKER_PROCESSES]);
+  const lines = readline.createInterface({ input: py.stdout });
+  lines.on('line', (line) => {
+    let parsed;
+    try {
+      parsed = JSON.parse(line);
+    } catch (e) {
+      return;
+    }
+    const job = pending.get(parsed.id);
+    if (!job) return;
+    pending.delete(parsed.id);
+    clearTimeout(job.timer);
+    if (parsed.success) job.resolve(parsed.encoding);
+    else job.reject(parsed.error);
+  });
+  py.stderr.on('data', (data) => {
+    console.error('face worker:', data.toString());
+  });
+  py.on('error', (err) => {
+    console.error('face worker failed to start:', err);
+    retire(py, `Python worker failed to start: ${err.message}`);
+  });
+  // Writing to a worker that died or never started emits EPIPE here; without
+  // a listener it would crash the server. The next job starts a new worker.
+  py.stdin.on('error', (err) => {
+    console.error('face worker stdin error:', err.message);
+    retire(py, `Python worker unavailable: ${err.message}`);
+  });
+  py.on('close', (code) => {
+    retire(py, `Python worker exited with code ${code}`);
+  });
+  return py;
+};
+
+// Send one job: a JSON header line, followed by the raw image bytes when
+// there is a payload (the header then carries their length as image_bytes)
+const submitJob = (job, payload) => {
+  if (!worker) worker = startWorker();
+  const id = nextJobId++;
+  return new Promise((resolve, reject) => {
+    const py = worker;
+    // A job that overruns is most likely stuck and would hold up every job
+    // queued behind it: kill the worker so the next job starts a fresh one
+    const timer = setTimeout(() => {
+      pending.delete(id);
+      reject('Python worker timed out');
+      retire(py, 'Python worker restarted after a job timed out');
+      py.kill('SIGKILL');
+    }, JOB_TIMEOUT_MS);
+    pending.set(id, { resolve, reject, timer });
+    const header = payload ? { id, ...job, image_bytes: payload.length } : { id, ...job };
+    worker.stdin.write(JSON.stringify(header) + '\n');
+    if (payload) worker.stdin.write(payload);
+  });
+};
+
+// Resolve with the 128-d encoding for an image URL or local path
+const getFaceEncoding = (image) => submitJob({ image });
+
+// Resolve with the 128-d encoding for base64 image bytes already in memory
+const getFaceEncodingFromBase64 = (imageB64) => submitJob({ image_b64: imageB64 });
+
+// Resolve with the 128-d encoding for raw image bytes in a Buffer, sent to
+// the worker as-is
+const getFaceEncodingFromBuffer = (image) => submitJob({}, image);
+
+module.exports = { getFaceEncoding, getFaceEncodingFromBase64, getFaceEncodingFromBuffer };
@@ -0,0 +1,163 @@
+import os
+import math
+import time
+import heapq
+import itertools
+import threading
+from contextlib import contextmanager
+import metrics
+
+# Requests allowed in the CPU-heavy pipeline at once in this process. Under
+# gunicorn this defaults to the cores per worker (see gunicorn.conf.py).
+ADMISSION_SLOTS = int(os.environ.get('ADMISSION_SLOTS', str(os.cpu_count() or 1)))
+# Requests allowed to wait for a slot; beyond this new ones get a 429
+ADMISSION_QUEUE_DEPTH = int(os.environ.get('ADMISSION_QUEUE_DEPTH', str(ADMISSION_SLOTS * 4)))
+# Longest a request waits for a slot (seconds) unless the client sends a
+# shorter X-Request-Timeout; after that it gets a 503
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', '5'))
+
+# Lower values are served first
+PRIORITY_SCAN = 0
+PRIORITY_ENROLL = 1
+PRIORITY_NAMES = {PRIORITY_SCAN: 'scan', PRIORITY_ENROLL: 'enroll'}
+
+queue_depth = metrics.registry.gauge('face_admission_queue_depth', 'Requests waiting for a pipeline slot', ['priority'])
+slots_in_use = metrics.registry.gauge('face_admission_slots_in_use', 'Pipeline slots taken')
+wait_seconds = metrics.registry.histogram('face_admission_wait_seconds', 'Time requests waited for a pipeline slot', ['priority'])
+rejected = metrics.registry.counter('face_admission_rejected_total', 'Requests turned away by admission control',
+                                    ['priority', 'reason'])
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request is not admitted. status is 429 when the queue is
+    full and 503 when its deadline passed while queued.
+    """
+
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('event', 'slots', 'granted', 'cancelled')
+
+    def __init__(self, slots):
+        self.event = threading.Event()
+        self.slots = slots
+        self.granted = False
+        self.cancelled = False
+
+
+class AdmissionController:
+    """
+    Bounded, prioritized admission to the decode/detect/encode pipeline.
+
+    At most `slots` requests run the pipeline at once; the rest wait in a
+    priority queue (scans before enrollments, first come first served
+    within a priority) of at most `max_queue` entries. Waiting ends at the
+    request's deadline, so work whose client has given up is never started.
+    A request that fans out over several processes takes one slot per
+    process; it waits at the head of the queue until enough are free.
+    """
+
+    def __init__(self, slots=ADMISSION_SLOTS, max_queue=ADMISSION_QUEUE_DEPTH, timeout=ADMISSION_TIMEOUT):
+        self.slots = max(1, slots)
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._free = self.slots
+        # (priority, sequence, waiter)
+        self._queue = []
+        self._waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        # Moving average of seconds a slot is held, for Retry-After
+        self._service_time = 1.0
+        slots_in_use.fn = lambda: self.slots - self._free
+        for priority, name in PRIORITY_NAMES.items():
+            queue_depth.set(0, priority=name)
+
+    def retry_after(self):
+        """
+        Seconds until the queue is likely to have drained
+        """
+        return max(1, math.ceil(self._service_time * (self._queued() + 1) / self.slots))
+
+    def acquire(self, priority=PRIORITY_SCAN, timeout=None, slots=1):
+        """
+        Take `slots` pipeline slots (at most all of them), waiting at most
+        timeout seconds (default the controller's). Raises Overloaded when
+        the request is not admitted. Returns the number of slots taken.
+        """
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        slots = max(1, min(slots, self.slots))
+        name = PRIORITY_NAMES[priority]
+        start = time.monotonic()
+        with self._lock:
+            if self._free >= slots and not self._queued():
+                self._free -= slots
+                wait_seconds.observe(0.0, priority=name)
+                return slots
+            if self._queued() >= self.max_queue or timeout <= 0:
+                rejected.inc(priority=name, reason='queue_full')
+                raise Overloaded(429, self.retry_after(), 'Server is busy, please retry shortly')
+            waiter = _Waiter(slots)
+            heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+            self._set_waiting(priority, 1)
+            # Free slots held back for a larger request may fit this one
+            self._grant()
+
+        waiter.event.wait(timeout)
+        with self._lock:
+            if not waiter.granted:
+                # Left in the heap and skipped when popped
+                waiter.cancelled = True
+                self._set_waiting(priority, -1)
+                # It may have been holding back smaller requests behind it
+                self._grant()
+                rejected.inc(priority=name, reason='deadline')
+                raise Overloaded(503, self.retry_after(), 'Server is busy, please retry shortly')
+        wait_seconds.observe(time.monotonic() - start, priority=name)
+        return slots
+
+    def release(self, held_seconds=None, slots=1):
+        with self._lock:
+            if held_seconds is not None:
+                self._service_time += 0.2 * (held_seconds - self._service_time)
+            self._free += slots
+            self._grant()
+
+    @contextmanager
+    def admit(self, priority=PRIORITY_SCAN, timeout=None, slots=1):
+        slots = self.acquire(priority, timeout, slots)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(time.monotonic() - start, slots)
+
+    def _grant(self):
+        """
+        Hand free slots to waiters in queue order, stopping at the first
+        that needs more than are free. Called with the lock held.
+        """
+        while self._queue:
+            priority, _, waiter = self._queue[0]
+            if waiter.cancelled:
+                heapq.heappop(self._queue)
+                continue
+            if waiter.slots > self._free:
+                return
+            heapq.heappop(self._queue)
+            self._free -= waiter.slots
+            self._set_waiting(priority, -1)
+            waiter.granted = True
+            waiter.event.set()
+
+    def _queued(self):
+        return sum(self._waiting.values())
+
+    def _set_waiting(self, priority, delta):
+        self._waiting[priority] += delta
+        queue_depth.set(self._waiting[priority], priority=PRIORITY_NAMES[priority])
@@ -1,20 +1,35 @@
 import os
+import csv
+import hmac
+import json
+import math
+import numbers
+import time
+import zipfile
 import logging
-import numpy as np
-from flask import Flask, request, jsonify
-import face_recognition
-import cv2
+from flask import Flask, Response, request, jsonify
 import cloudinary
-import cloudinary.uploader
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import bcrypt
 from jose import jwt
 from functools import wraps
-from db_config import face_collection, employee_collection, attendance_collection
+from db_config import face_collection, employee_collection, record_attendance, record_attendance_many, find_attendance
+from gallery_index import GalleryIndex, read_gallery, DEFAULT_TOLERANCE
+from face_templates import add_template, count_legacy, AutoEnroller, ScanTemplateWriter
+from employee_directory import EmployeeDirectory
+from archive_outbox import ArchiveOutbox
+import bulk_enroll
+from gallery_snapshot import GallerySnapshot, SnapshotRebuilder, GALLERY_SNAPSHOT_PATH
+from liveness import check_liveness
+from preprocessing import decode_image, find_faces, encode_faces
 from flask_cors import CORS
-import base64
-from bson.objectid import ObjectId
+from flask_sock import Sock
+from tracking import KioskSession, KioskSessions, KIOSK_DETECT_EVERY
+import metrics
+from result_cache import RecognitionCache, dhash
+from admission import AdmissionController, Overloaded, PRIORITY_SCAN, PRIORITY_ENROLL
+from uploads import UploadRequest, request_image, decode_base64
 
 # Configure logging
 logging.basicConfig(
@@ -26,7 +41,12 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 app = Flask(__name__)
+# Uploaded frames are parsed in memory, never spooled to a temporary file
+app.request_class = UploadRequest
 app.config['SECRET_KEY'] = os.getenv('JWT_SECRET_KEY', 'your-secret-key-here')
+# Shared secret backend services send as X-Service-Token to update the
+# gallery without an admin's JWT; empty disables service access
+FACE_SERVICE_TOKEN = os.getenv('FACE_SERVICE_TOKEN', '')
 
 # Configure Cloudinary
 cloudinary.config(
@@ -36,154 +56,290 @@ cloudinary.config(
 )
 
 CORS(app)
+metrics.install(app)
+
+# Every stored face encoding, loaded once and kept in sync by upload_face.
+# With GALLERY_SNAPSHOT_PATH set, all workers on the host map one snapshot
+# file instead of each pulling and holding its own copy.
+gallery = GalleryIndex()
+gallery_snapshot = GallerySnapshot(GALLERY_SNAPSHOT_PATH) if GALLERY_SNAPSHOT_PATH else None
+snapshot_rebuilder = None
+if gallery_snapshot:
+    # Rebuilt on every start (once, in the gunicorn master): a snapshot left
+    # by the previous run misses faces written while the service was down
+    gallery_snapshot.publish(read_gallery(face_collection, employee_collection))
+    gallery.load_snapshot(gallery_snapshot)
+    snapshot_rebuilder = SnapshotRebuilder(
+        gallery_snapshot, lambda: read_gallery(face_collection, employee_collection)
+    )
+else:
+    gallery.load(face_collection, employee_collection)
+legacy_faces, legacy_users = count_legacy(face_collection, employee_collection)
+if legacy_faces or legacy_users:
+    logger.warning(f"{legacy_faces} faces and {legacy_users} users hold BGR encodings that match RGB scans poorly; "
+                   f"run reencode_faces.py")
+
+def publish_gallery():
+    """
+    Schedule a snapshot rebuild so other workers pick up a gallery write
+    """
+    if snapshot_rebuilder:
+        snapshot_rebuilder.request()
+
+def record_archived_image(job, url):
+    face_collection.update_one({'employee_id': job['meta']['employee_id']}, {'$set': {'image_url': url}})
+
+# Enrollment images are archived to Cloudinary in the background from a
+# durable on-disk outbox, so enrollment never waits on the upload
+archive_outbox = ArchiveOutbox(on_uploaded=record_archived_image)
+archive_outbox.start()
+
+# Names shown after a recognition, cached so a scan costs one write at most
+employees = EmployeeDirectory(employee_collection)
+
+# Confident scans that differ from an employee's stored templates become
+# new templates, so the gallery follows gradual changes in appearance
+auto_enroller = AutoEnroller()
+
+def apply_scan_templates(stored):
+    """
+    Index a batch of written scan templates with one gallery update
+    """
+    gallery.upsert_many(stored)
+    publish_gallery()
+
+# Claimed templates are written in batches in the background, never on the
+# scan's request thread
+scan_templates = ScanTemplateWriter(face_collection, apply_scan_templates)
+
+def learn_from_scan(employee_id, face_encoding, distance):
+    """
+    Queue a matched scan as a template when the auto-enrollment policy allows
+    """
+    if auto_enroller.claim(employee_id, distance) and not scan_templates.submit(employee_id, face_encoding):
+        logger.warning(f"Scan template queue full, dropped template for {employee_id}")
+
+def reload_gallery():
+    """
+    Reload the gallery and employee cache from their source of truth. Under
+    gunicorn this runs in the master on SIGHUP (see gunicorn.conf.py).
+    """
+    if gallery_snapshot:
+        gallery_snapshot.publish(read_gallery(face_collection, employee_collection))
+        gallery.load_snapshot(gallery_snapshot)
+    else:
+        gallery.load(face_collection, employee_collection)
+    employees.invalidate()
+
+snapshot_reloads = metrics.registry.counter('face_gallery_snapshot_reloads_total', 'Gallery snapshots mapped after another worker published')
+
+@app.before_request
+def refresh_gallery():
+    if gallery_snapshot and gallery.refresh(gallery_snapshot):
+        snapshot_reloads.inc()
 
 def admin_required(f):
     @wraps(f)
     def decorated(*args, **kwargs):
         token = request.headers.get('Authorization')
-        print("Authorization header:", token)
         if not token:
-            print("No token provided.")
             return jsonify({'error': 'Token is missing'}), 401
         try:
             token = token.split(' ')[1]
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-            print("Decoded token data:", data)
             current_user = employee_collection.find_one({'email': data['email']})
-            print("Current user found:", current_user)
             if not current_user or current_user.get('role') != 'admin':
-                print("Admin check failed.")
+                logger.debug(f"Admin check failed for {data.get('email')}")
                 return jsonify({'error': 'Admin access required'}), 403
         except Exception as e:
-            print("Token decode error:", str(e))
+            logger.debug(f"Token decode error: {str(e)}")
             return jsonify({'error': f'Invalid token: {str(e)}'}), 401
         return f(current_user, *args, **kwargs)
     return decorated
 
-def detect_liveness(image):
+def admin_or_service_required(f):
+    """
+    Like admin_required, but also admits a backend service presenting
+    FACE_SERVICE_TOKEN, in which case current_user is None
+    """
+    admin_view = admin_required(f)
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        token = request.headers.get('X-Service-Token', '')
+        if FACE_SERVICE_TOKEN and hmac.compare_digest(token.encode('utf-8'), FACE_SERVICE_TOKEN.encode('utf-8')):
+            return f(None, *args, **kwargs)
+        return admin_view(*args, **kwargs)
+    return decorated
+
+def is_encoding(values):
+    """
+    True for a sequence of 128 finite numbers
+    """
+    return len(values) == 128 and all(
+        isinstance(v, numbers.Real) and not isinstance(v, bool) and math.isfinite(v) for v in values
+    )
+
+# CPU-heavy requests take one of a bounded number of pipeline slots, so a
+# rush queues (scans ahead of enrollments) instead of thrashing the cores
+admission = AdmissionController()
+
+@app.errorhandler(Overloaded)
+def overloaded(e):
+    response = jsonify({'success': False, 'error': str(e), 'message': str(e)})
+    response.status_code = e.status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+def request_timeout():
     """
-    Enhanced liveness detection using multiple checks
+    Seconds the client is prepared to wait, from X-Request-Timeout
     """
     try:
-        # Convert to grayscale
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # Load the pre-trained classifiers
-        haarcascades_path = cv2.__file__.replace('cv2.cpython-{}.so'.format(cv2.__version__.split('.')[0]), '') + 'data/'
-        face_cascade = cv2.CascadeClassifier(haarcascades_path + 'haarcascade_frontalface_default.xml')
-        eye_cascade = cv2.CascadeClassifier(haarcascades_path + 'haarcascade_eye.xml')
-
-        # Detect faces
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
-        
-        if len(faces) == 0:
-            return False
-            
-        for (x, y, w, h) in faces:
-            roi_gray = gray[y:y+h, x:x+w]
-            roi_color = image[y:y+h, x:x+w]
-            eyes = eye_cascade.detectMultiScale(roi_gray)
-            
-            # Check for multiple faces (anti-spoofing)
-            if len(faces) > 1:
-                return False
-                
-            # Check for eye presence
-            if len(eyes) < 1:
-                return False
-                
-            # Check face size (anti-spoofing)
-            if w < 100 or h < 100:  # Face too small
-                return False
-                
-            # Check face position (should be centered)
-            height, width = image.shape[:2]
-            if x < width * 0.1 or x + w > width * 0.9 or y < height * 0.1 or y + h > height * 0.9:
-                return False
-                
-        return True
-    except Exception as e:
-        logger.error(f"Error in liveness detection: {str(e)}")
-        return False
+        return float(request.headers['X-Request-Timeout'])
+    except (KeyError, ValueError):
+        return None
+
+def admitted(priority):
+    """
+    Run the view in a pipeline slot; requests that are not admitted get a
+    429 or 503 with Retry-After
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            with admission.admit(priority, request_timeout()):
+                return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+def log_stage_timings(endpoint, timings):
+    """
+    Log per-stage durations (ms) for one request
+    """
+    logger.info(f"{endpoint} stage timings (ms): " + ', '.join(
+        f"{stage}={duration:.1f}" for stage, duration in timings.items()
+    ))
+
+def decode_base64_image(image_b64):
+    """
+    Decode a base64 image, with or without a data-URL prefix
+    """
+    return decode_image(decode_base64(image_b64))
+
+# Recognition results of recent uploads, so a resubmitted frame skips
+# decode, liveness, detection and encoding
+result_cache = RecognitionCache()
+metrics.registry.counter('face_result_cache_hits_total', 'Uploads answered from the result cache', fn=lambda: result_cache.hits)
+metrics.registry.counter('face_result_cache_near_hits_total', 'Uploads answered from a near-duplicate frame',
+                         fn=lambda: result_cache.near_hits)
+metrics.registry.counter('face_result_cache_misses_total', 'Uploads recognized from scratch', fn=lambda: result_cache.misses)
+metrics.registry.gauge('face_result_cache_entries', 'Cached recognition results', fn=lambda: len(result_cache))
+
+def recognize_cached(raw, recognize):
+    """
+    Decode an upload and run recognize(image) -> (outcome, employee_id,
+    distance) on it, reusing the result of an identical (or, if enabled,
+    near-identical) recent upload while the gallery is unchanged. Results
+    are only reused by the same pipeline: a liveness-free match must never
+    answer a scan that requires liveness, nor the other way round.
+    """
+    pipeline = recognize.__name__
+    version = (pipeline, gallery.version)
+    key = result_cache.key(raw, pipeline)
+    result = result_cache.get(key, version)
+    if result is not None:
+        return result
+    image = decode_frame(raw)
+    if image is None:
+        return ('invalid', None, None)
+    fingerprint = None
+    if result_cache.near_enabled:
+        fingerprint = dhash(image)
+        result = result_cache.get_near(fingerprint, version)
+        if result is not None:
+            return result
+    result = recognize(image)
+    if result[0] != 'no_gallery':
+        result_cache.put(key, version, result, fingerprint)
+    return result
+
+def match_face(face_encoding):
+    """
+    Match an encoding against the gallery, learning from confident matches
+    """
+    if len(gallery) == 0:
+        return ('no_gallery', None, None)
+    # Find the nearest stored face
+    matched_employee_id, distance = gallery.match(face_encoding, tolerance=0.6)
+    if matched_employee_id is None:
+        return ('unknown', None, distance)
+    learn_from_scan(matched_employee_id, face_encoding, distance)
+    return ('match', matched_employee_id, distance)
+
+def recognize_live_face(image):
+    """
+    Check liveness, then encode and match the face it found
+    """
+    # Check for liveness; its face box doubles as the detection result
+    is_live, face_location, timings = check_liveness(image)
+    metrics.observe_stages(timings)
+    if not is_live:
+        log_stage_timings('mark_attendance', timings)
+        return ('not_live', None, None)
+    
+    # Get encoding for the face found by the liveness check
+    start = time.perf_counter()
+    face_encoding = encode_faces(image, [face_location])[0]
+    timings['encode'] = (time.perf_counter() - start) * 1000
+    log_stage_timings('mark_attendance', timings)
+    return match_face(face_encoding)
+
+def recognize_face(image):
+    """
+    Detect, encode and match the first face in an image
+    """
+    face_locations = find_faces(image)
+    if not face_locations:
+        return ('no_face', None, None)
+    return match_face(encode_faces(image, face_locations[:1])[0])
 
 # Public endpoints (no authentication required)
 @app.route('/api/attendance/mark', methods=['POST'])
+@admitted(PRIORITY_SCAN)
 def mark_attendance():
     """
-    Public endpoint for marking attendance using face recognition
+    Public endpoint for marking attendance using face recognition. The
+    image is a multipart 'image' file or the raw request body.
     """
     try:
-        if 'image' not in request.files:
+        raw = request_image()
+        if not raw:
             return jsonify({'error': 'No image file provided'}), 400
-            
-        image_file = request.files['image']
         
-        # Read image for face detection
-        image_array = np.frombuffer(image_file.read(), np.uint8)
-        image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
+        outcome, matched_employee_id, distance = recognize_cached(raw, recognize_live_face)
         
-        # Check for liveness
-        if not detect_liveness(image):
+        if outcome == 'invalid':
+            return jsonify({'error': 'Invalid image'}), 400
+        if outcome == 'not_live':
             return jsonify({'error': 'Liveness detection failed. Please ensure you are a real person.'}), 400
-        
-        # Detect face and get encoding
-        face_locations = face_recognition.face_locations(image)
-        if not face_locations:
-            return jsonify({'error': 'No face detected in the image'}), 400
-            
-        face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-        
-        # Get all face encodings from database
-        stored_faces = list(face_collection.find({}, {'face_encoding': 1, 'employee_id': 1}))
-        
-        if not stored_faces:
+        if outcome == 'no_gallery':
             return jsonify({'error': 'No faces registered in the system'}), 404
-            
-        # Compare with stored faces
-        matches = face_recognition.compare_faces(
-            [np.array(face['face_encoding']) for face in stored_faces],
-            face_encoding,
-            tolerance=0.6
-        )
-        
-        if True not in matches:
+        if outcome != 'match':
             return jsonify({'error': 'Face not recognized'}), 404
-            
-        # Get the matched employee
-        matched_index = matches.index(True)
-        matched_employee = stored_faces[matched_index]
         
-        # Check if attendance already marked today
-        today = datetime.utcnow().date()
-        existing_attendance = attendance_collection.find_one({
-            'employee_id': matched_employee['employee_id'],
-            'timestamp': {
-                '$gte': datetime.combine(today, datetime.min.time()),
-                '$lte': datetime.combine(today, datetime.max.time())
-            }
-        })
+        # Log attendance unless already marked today, in one atomic upsert
+        created, attendance_log = record_attendance(matched_employee_id, 1 - distance)
         
-        if existing_attendance:
+        if not created:
             return jsonify({
                 'message': 'Attendance already marked for today',
-                'employee_id': matched_employee['employee_id'],
-                'timestamp': existing_attendance['timestamp']
+                'employee_id': matched_employee_id,
+                'timestamp': attendance_log['timestamp']
             }), 200
         
-        # Log attendance
-        attendance_log = {
-            'employee_id': matched_employee['employee_id'],
-            'timestamp': datetime.utcnow(),
-            'confidence': float(1 - face_recognition.face_distance(
-                [face_encoding],
-                [np.array(matched_employee['face_encoding'])]
-            )[0])
-        }
-        
-        attendance_collection.insert_one(attendance_log)
-        
         return jsonify({
             'message': 'Attendance marked successfully',
-            'employee_id': matched_employee['employee_id'],
+            'employee_id': matched_employee_id,
             'timestamp': attendance_log['timestamp']
         }), 200
         
@@ -224,6 +380,7 @@ def register_employee(current_user):
         }
         
         employee_collection.insert_one(employee)
+        employees.invalidate(data['employee_id'])
         
         return jsonify({'message': 'Employee registered successfully'}), 201
         
@@ -233,6 +390,7 @@ def register_employee(current_user):
 
 @app.route('/api/admin/upload-face', methods=['POST'])
 @admin_required
+@admitted(PRIORITY_ENROLL)
 def upload_face(current_user):
     """
     Admin endpoint for uploading employee face data
@@ -250,54 +408,67 @@ def upload_face(current_user):
         if not employee:
             return jsonify({'error': 'Employee not found'}), 404
         
-        image_file = request.files['image']
+        image_bytes = request.files['image'].read()
         
         # Read image for face detection
-        image_array = np.frombuffer(image_file.read(), np.uint8)
-        image = cv2.imdecode(image_array, cv2.IMREAD_COLOR)
-        
-        # Check for liveness
-        if not detect_liveness(image):
+        start = time.perf_counter()
+        image = decode_image(image_bytes)
+        timings = {'decode': (time.perf_counter() - start) * 1000}
+        
+        # Check for liveness; its face box doubles as the detection result
+        is_live, face_location, liveness_timings = check_liveness(image)
+        timings.update(liveness_timings)
+        metrics.observe_stages(liveness_timings)
+        if not is_live:
+            log_stage_timings('upload_face', timings)
             return jsonify({'error': 'Liveness detection failed. Please ensure you are a real person.'}), 400
         
-        # Detect face and get encoding
-        face_locations = face_recognition.face_locations(image)
-        if not face_locations:
-            return jsonify({'error': 'No face detected in the image'}), 400
-        
-        face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-        
-        # Store face encoding in MongoDB
-        face_data = {
-            'employee_id': employee_id,
-            'face_encoding': face_encoding.tolist(),
-            'created_at': datetime.utcnow()
-        }
+        # Get encoding for the face found by the liveness check
+        start = time.perf_counter()
+        face_encoding = encode_faces(image, [face_location])[0]
+        timings['encode'] = (time.perf_counter() - start) * 1000
+        log_stage_timings('upload_face', timings)
         
-        # Update or insert face encoding
-        face_collection.update_one(
-            {'employee_id': employee_id},
-            {'$set': face_data},
-            upsert=True
-        )
+        # Add the encoding to the employee's templates; replace=true starts over
+        replace = request.form.get('replace', '').lower() in ('1', 'true', 'yes')
+        templates = add_template(face_collection, employee_id, face_encoding, replace=replace)
+        gallery.upsert(employee_id, templates)
+        publish_gallery()
         
-        # Upload to Cloudinary
-        image_file.seek(0)
-        upload_result = cloudinary.uploader.upload(
-            image_file,
-            folder="employee_faces",
-            public_id=f"employee_{employee_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-        )
+        # Queue the image for archival; its URL is known before the upload
+        public_id = f"employee_{employee_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        archive_outbox.enqueue(image_bytes, "employee_faces", public_id, {'employee_id': employee_id})
         
         return jsonify({
             'message': 'Face registered successfully',
-            'image_url': upload_result['secure_url']
+            'templates': len(templates),
+            'image_url': archive_outbox.url_for("employee_faces", public_id)
         }), 201
         
     except Exception as e:
         logger.error(f"Error in face upload: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/admin/face/<employee_id>', methods=['DELETE'])
+@admin_required
+def delete_face(current_user, employee_id):
+    """
+    Admin endpoint for removing an employee's face data
+    """
+    try:
+        result = face_collection.delete_one({'employee_id': employee_id})
+        gallery.remove(employee_id)
+        publish_gallery()
+
+        if result.deleted_count == 0:
+            return jsonify({'error': 'No face registered for this employee'}), 404
+
+        return jsonify({'message': 'Face removed successfully'}), 200
+
+    except Exception as e:
+        logger.error(f"Error in face removal: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/api/employee/login', methods=['POST'])
 def login():
     """
@@ -334,10 +505,101 @@ def login():
         logger.error(f"Error in login: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+# Attendance history is served in pages of this many records, newest first
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+HISTORY_MAX_PAGE_SIZE = 500
+# Export rows sent per response chunk
+EXPORT_CHUNK_RECORDS = 500
+EXPORT_FIELDS = ('employee_id', 'timestamp', 'confidence')
+EXPORT_MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+def parse_history_time(value, upper=False):
+    """
+    Parse an ISO date or datetime query parameter to naive UTC, as stored.
+    A bare date used as an upper bound covers the whole of that day.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    if upper and len(value) == 10:
+        parsed += timedelta(days=1)
+    return parsed
+
+class _Echo:
+    # File-like object whose write returns the line, for csv.writer
+    def write(self, value):
+        return value
+
+def stream_attendance(records, export):
+    """
+    Yield records from a cursor as NDJSON lines or CSV rows in chunks, so an
+    export holds no more than one cursor batch in memory
+    """
+    writer = csv.writer(_Echo())
+    try:
+        lines = [writer.writerow(EXPORT_FIELDS)] if export == 'csv' else []
+        for record in records:
+            record['timestamp'] = record['timestamp'].isoformat()
+            if export == 'csv':
+                lines.append(writer.writerow([record.get(field) for field in EXPORT_FIELDS]))
+            else:
+                lines.append(json.dumps(record) + '\n')
+            if len(lines) >= EXPORT_CHUNK_RECORDS:
+                yield ''.join(lines)
+                lines = []
+        if lines:
+            yield ''.join(lines)
+    finally:
+        records.close()
+
+def attendance_history(employee_id):
+    """
+    Respond with one page of an employee's attendance history, or with the
+    whole filtered history streamed as an export.
+
+    Query parameters: from / to (ISO dates or datetimes, to inclusive for a
+    date), limit, before (the next_before of the previous page) and format
+    (ndjson or csv to export instead of paging).
+    """
+    try:
+        before = parse_history_time(request.args.get('before'))
+        start = parse_history_time(request.args.get('from'))
+        end = parse_history_time(request.args.get('to'), upper=True)
+        limit = int(request.args.get('limit', HISTORY_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'error': 'Invalid before, from, to or limit parameter'}), 400
+    if limit < 1:
+        return jsonify({'error': 'limit must be positive'}), 400
+    limit = min(limit, HISTORY_MAX_PAGE_SIZE)
+    
+    export = request.args.get('format')
+    if export:
+        if export not in EXPORT_MIMETYPES:
+            return jsonify({'error': 'format must be ndjson or csv'}), 400
+        records = find_attendance(employee_id, before, start, end)
+        return Response(stream_attendance(records, export), mimetype=EXPORT_MIMETYPES[export], headers={
+            'Content-Disposition': f'attachment; filename="attendance_{employee_id}.{export}"'
+        })
+    
+    # One record past the page tells whether there is a next page
+    records = list(find_attendance(employee_id, before, start, end, limit + 1))
+    next_before = None
+    if len(records) > limit:
+        records = records[:limit]
+        next_before = records[-1]['timestamp'].isoformat()
+    return jsonify({
+        'employee_id': employee_id,
+        'attendance_records': records,
+        'next_before': next_before
+    }), 200
+
 @app.route('/api/employee/attendance', methods=['GET'])
 def get_attendance():
     """
-    Get employee's attendance history
+    Get employee's attendance history, a page at a time (see
+    attendance_history)
     """
     try:
         token = request.headers.get('Authorization')
@@ -346,85 +608,61 @@ def get_attendance():
             
         token = token.split(' ')[1]
         data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-        employee_id = data['employee_id']
-        
-        # Get attendance records
-        attendance_records = list(attendance_collection.find(
-            {'employee_id': employee_id},
-            {'_id': 0, 'employee_id': 1, 'timestamp': 1, 'confidence': 1}
-        ).sort('timestamp', -1))
-        
-        return jsonify({
-            'employee_id': employee_id,
-            'attendance_records': attendance_records
-        }), 200
+        return attendance_history(data['employee_id'])
         
     except Exception as e:
         logger.error(f"Error in getting attendance: {str(e)}")
         return jsonify({'error': 'Internal server error'}), 500
 
+@app.route('/api/admin/attendance/<employee_id>', methods=['GET'])
+@admin_required
+def get_employee_attendance(current_user, employee_id):
+    """
+    Admin endpoint for an employee's attendance history or export
+    """
+    try:
+        return attendance_history(employee_id)
+    except Exception as e:
+        logger.error(f"Error in getting attendance: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 @app.route('/face-recognition/scan', methods=['POST'])
+@admitted(PRIORITY_SCAN)
 def face_scan():
-    data = request.get_json()
-    if not data or 'image' not in data:
+    """
+    Recognize a face and mark attendance. The image is the raw request body
+    (application/octet-stream or image/*), which is decoded straight from
+    the request buffer, a multipart 'image' file, or base64 in JSON
+    {"image": ...}.
+    """
+    raw = request_image()
+    if not raw:
         return jsonify({'success': False, 'message': 'No image provided'}), 400
-    image_b64 = data['image']
-    # Decode base64 image
-    image_data = image_b64.split(',')[1] if ',' in image_b64 else image_b64
-    nparr = np.frombuffer(base64.b64decode(image_data), np.uint8)
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     # Face recognition logic
     try:
-        # Detect face and get encoding
-        face_locations = face_recognition.face_locations(image)
-        if not face_locations:
+        # Detect face, get encoding and find the nearest stored face
+        outcome, matched_employee_id, distance = recognize_cached(raw, recognize_face)
+        if outcome == 'invalid':
+            return jsonify({'success': False, 'message': 'Invalid image'}), 400
+        if outcome == 'no_face':
             return jsonify({'success': False, 'message': 'No face detected in the image'}), 404
-        face_encoding = face_recognition.face_encodings(image, face_locations)[0]
-        # Get all face encodings from database
-        stored_faces = list(face_collection.find({}, {'face_encoding': 1, 'employee_id': 1}))
-        if not stored_faces:
+        if outcome == 'no_gallery':
             return jsonify({'success': False, 'message': 'No faces registered in the system'}), 404
-        # Compare with stored faces
-        matches = face_recognition.compare_faces(
-            [np.array(face['face_encoding']) for face in stored_faces],
-            face_encoding,
-            tolerance=0.6
-        )
-        if True not in matches:
+        if outcome != 'match':
             return jsonify({'success': False, 'message': 'Unknown user. Please register first.'}), 404
-        # Get the matched employee
-        matched_index = matches.index(True)
-        matched_employee = stored_faces[matched_index]
         # Look up employee details
-        employee = employee_collection.find_one({'employee_id': matched_employee['employee_id']})
+        employee = employees.get(matched_employee_id)
         if not employee:
             return jsonify({'success': False, 'message': 'Unknown user. Please register first.'}), 404
-        # Check if attendance already marked today
-        today = datetime.utcnow().date()
-        existing_attendance = attendance_collection.find_one({
-            'employee_id': matched_employee['employee_id'],
-            'timestamp': {
-                '$gte': datetime.combine(today, datetime.min.time()),
-                '$lte': datetime.combine(today, datetime.max.time())
-            }
-        })
-        if existing_attendance:
+        # Log attendance unless already marked today, in one atomic upsert
+        created, _ = record_attendance(matched_employee_id, 1 - distance)
+        if not created:
             return jsonify({
                 'success': True,
                 'message': 'Attendance already marked for today',
                 'name': employee['name'],
                 'employeeId': employee['employee_id']
             }), 200
-        # Log attendance
-        attendance_log = {
-            'employee_id': matched_employee['employee_id'],
-            'timestamp': datetime.utcnow(),
-            'confidence': float(1 - face_recognition.face_distance(
-                [face_encoding],
-                [np.array(matched_employee['face_encoding'])]
-            )[0])
-        }
-        attendance_collection.insert_one(attendance_log)
         return jsonify({
             'success': True,
             'message': 'Attendance marked successfully',
@@ -435,5 +673,319 @@ def face_scan():
         logger.error(f"Error in face scan: {str(e)}")
         return jsonify({'success': False, 'message': 'Internal server error'}), 500
 
+@app.route('/face-recognition/scan-batch', methods=['POST'])
+@admitted(PRIORITY_SCAN)
+def face_scan_batch():
+    """
+    Recognize every face in a batch of frames and mark attendance for each
+    matched employee. Accepts multipart 'images' files or a JSON body
+    {"images": [base64, ...]} or [base64, ...].
+    """
+    if request.files:
+        raw_images = [f.read() for f in request.files.getlist('images')]
+        decode = decode_image
+    else:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            data = data.get('images')
+        raw_images = data if isinstance(data, list) else []
+        decode = decode_base64_image
+    if not raw_images:
+        return jsonify({'success': False, 'message': 'No images provided'}), 400
+    try:
+        # Detect and encode every face in every frame
+        results = []
+        encodings = []
+        owners = []
+        for index, raw in enumerate(raw_images):
+            entry = {'index': index, 'faces': []}
+            results.append(entry)
+            try:
+                image = decode(raw)
+            except Exception:
+                image = None
+            if image is None:
+                entry['error'] = 'Invalid image'
+                continue
+            face_locations = find_faces(image)
+            if not face_locations:
+                entry['error'] = 'No face detected in the image'
+                continue
+            for location, encoding in zip(face_locations, encode_faces(image, face_locations)):
+                entry['faces'].append({'location': list(location)})
+                encodings.append(encoding)
+                owners.append(entry['faces'][-1])
+
+        if encodings and len(gallery) == 0:
+            return jsonify({'success': False, 'message': 'No faces registered in the system'}), 404
+
+        # Resolve all faces against the gallery in one matrix operation
+        best = {}
+        for face, (employee_id, distance) in zip(owners, gallery.match_many(encodings, tolerance=0.6)):
+            face['distance'] = distance
+            face['employeeId'] = employee_id
+            if employee_id is None:
+                face['status'] = 'unknown'
+            elif employee_id not in best or distance < best[employee_id]:
+                best[employee_id] = distance
+
+        # Mark each matched employee once in one bulk upsert; those already
+        # marked today are left untouched
+        names = {employee_id: info['name'] for employee_id, info in employees.get_many(list(best)).items()}
+        newly_marked = record_attendance_many({
+            employee_id: 1 - distance for employee_id, distance in best.items() if employee_id in names
+        })
+        already_marked = set(names) - newly_marked
+
+        marked = 0
+        for face in owners:
+            employee_id = face['employeeId']
+            if employee_id is None:
+                continue
+            if employee_id not in names:
+                face['status'] = 'unknown'
+                continue
+            face['name'] = names[employee_id]
+            if employee_id in already_marked:
+                face['status'] = 'already_marked'
+            else:
+                face['status'] = 'marked'
+                marked += 1
+                # Later faces of the same employee in this batch are duplicates
+                already_marked.add(employee_id)
+
+        return jsonify({
+            'success': True,
+            'results': results,
+            'marked': marked
+        }), 200
+    except Exception as e:
+        logger.error(f"Error in batch face scan: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/face-recognition/identify', methods=['POST'])
+@admin_or_service_required
+def identify(current_user):
+    """
+    Resolve face encodings against the gallery without marking attendance.
+    Accepts {"encoding": [...]}, {"encodings": [[...], ...]} or a base64
+    {"image": ...}, plus an optional "tolerance" no looser than the default.
+    Backend services only, so it cannot serve as an open lookup of who is
+    enrolled.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'success': False, 'message': 'Invalid request body'}), 400
+    try:
+        tolerance = min(float(data.get('tolerance', DEFAULT_TOLERANCE)), DEFAULT_TOLERANCE)
+        if 'encodings' in data:
+            encodings = data['encodings']
+        elif 'encoding' in data:
+            encodings = [data['encoding']]
+        elif 'image' in data:
+            with admission.admit(PRIORITY_SCAN, request_timeout()):
+                image = decode_base64_image(data['image'])
+                if image is None:
+                    return jsonify({'success': False, 'message': 'Invalid image'}), 400
+                face_locations = find_faces(image)
+                if not face_locations:
+                    return jsonify({'success': False, 'message': 'No face detected in the image'}), 404
+                encodings = encode_faces(image, face_locations[:1])
+        else:
+            return jsonify({'success': False, 'message': 'No encoding or image provided'}), 400
+        if len(encodings) == 0 or not all(is_encoding(encoding) for encoding in encodings):
+            return jsonify({'success': False, 'message': 'Encodings must have 128 finite numbers'}), 400
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Invalid request body'}), 400
+    try:
+        matches = [
+            {'employeeId': employee_id, 'distance': distance}
+            for employee_id, distance in gallery.match_many(encodings, tolerance=tolerance)
+        ]
+        if 'encodings' in data:
+            return jsonify({'success': True, 'matches': matches}), 200
+        return jsonify({'success': matches[0]['employeeId'] is not None, **matches[0]}), 200
+    except Exception as e:
+        logger.error(f"Error in identify: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+def decode_frame(frame):
+    """
+    Decode a kiosk frame sent as raw image bytes or as base64 text
+    """
+    try:
+        if isinstance(frame, str):
+            return decode_base64_image(frame)
+        return decode_image(frame)
+    except Exception:
+        return None
+
+def kiosk_attendance(employee_id, distance, face_encoding):
+    """
+    Mark attendance for a newly identified kiosk track
+    """
+    employee = employees.get(employee_id)
+    if not employee:
+        return {'status': 'unknown'}
+    learn_from_scan(employee_id, face_encoding, distance)
+    created, attendance_log = record_attendance(employee_id, 1 - distance)
+    return {
+        'status': 'marked' if created else 'already_marked',
+        'name': employee['name'],
+        'timestamp': attendance_log['timestamp'].isoformat()
+    }
+
+# Kiosk frame streams, tracked per session so a face standing in front of
+# the camera is encoded once rather than on every frame
+kiosk_sessions = KioskSessions(lambda: KioskSession(
+    decode=decode_frame,
+    detect=find_faces,
+    encode=encode_faces,
+    match=lambda encodings: gallery.match_many(encodings, tolerance=0.6),
+    on_identified=kiosk_attendance
+))
+sock = Sock(app)
+
+metrics.registry.gauge('face_gallery_employees', 'Employees in the gallery', fn=lambda: len(gallery), aggregate='max')
+metrics.registry.gauge('face_gallery_templates', 'Templates in the gallery', fn=lambda: len(gallery.arrays().templates), aggregate='max')
+metrics.registry.counter('face_employee_cache_hits_total', 'Employee directory cache hits', fn=lambda: employees.hits)
+metrics.registry.counter('face_employee_cache_misses_total', 'Employee directory cache misses', fn=lambda: employees.misses)
+metrics.registry.gauge('face_kiosk_sessions', 'Open kiosk stream sessions', fn=lambda: len(kiosk_sessions))
+metrics.registry.gauge('face_archive_outbox_pending', 'Images waiting to be archived', fn=archive_outbox.pending, aggregate='max')
+
+@sock.route('/face-recognition/stream/ws')
+def kiosk_stream(ws):
+    """
+    WebSocket kiosk stream: each message is one frame (binary image bytes
+    or base64 text) and is answered with the tracks after that frame
+    """
+    session = kiosk_sessions.create()
+    ws.send(json.dumps({'sessionId': session.session_id, 'detectEvery': session.detect_every}))
+    try:
+        while True:
+            frame = ws.receive()
+            if frame is None:
+                break
+            try:
+                with admission.admit(PRIORITY_SCAN):
+                    result = session.process(frame)
+            except Overloaded as e:
+                result = {'error': str(e), 'retryAfter': e.retry_after}
+            ws.send(json.dumps(result))
+    finally:
+        kiosk_sessions.close(session.session_id)
+        logger.info(f"Kiosk session ended: {session.stats()}")
+
+@app.route('/face-recognition/stream', methods=['POST'])
+def start_kiosk_stream():
+    """
+    Start an HTTP kiosk stream for clients that cannot use the WebSocket
+    """
+    session = kiosk_sessions.create()
+    return jsonify({'success': True, 'sessionId': session.session_id, 'detectEvery': KIOSK_DETECT_EVERY}), 201
+
+@app.route('/face-recognition/stream/<session_id>/frame', methods=['POST'])
+@admitted(PRIORITY_SCAN)
+def kiosk_stream_frame(session_id):
+    """
+    Feed one frame of an HTTP kiosk stream, as a raw image body or JSON
+    {"image": base64}
+    """
+    if request.is_json:
+        frame = (request.get_json(silent=True) or {}).get('image')
+    else:
+        frame = request.get_data()
+    if not frame:
+        return jsonify({'success': False, 'message': 'No image provided'}), 400
+    try:
+        result = kiosk_sessions.get_or_create(session_id).process(frame)
+        if 'error' in result:
+            return jsonify({'success': False, 'message': result['error']}), 400
+        return jsonify({'success': True, **result}), 200
+    except Exception as e:
+        logger.error(f"Error in kiosk stream: {str(e)}")
+        return jsonify({'success': False, 'message': 'Internal server error'}), 500
+
+@app.route('/face-recognition/stream/<session_id>', methods=['DELETE'])
+def end_kiosk_stream(session_id):
+    session = kiosk_sessions.close(session_id)
+    if not session:
+        return jsonify({'success': False, 'message': 'Unknown session'}), 404
+    return jsonify({'success': True, **session.stats()}), 200
+
+@app.route('/api/admin/gallery/<employee_id>', methods=['PUT'])
+@admin_or_service_required
+def update_gallery_face(current_user, employee_id):
+    """
+    Admin endpoint for indexing an encoding stored elsewhere (e.g. on the
+    user document by the Node backend)
+    """
+    data = request.get_json(silent=True) or {}
+    encoding = data.get('encoding')
+    if not isinstance(encoding, list) or not is_encoding(encoding):
+        return jsonify({'error': 'Encoding must have 128 finite numbers'}), 400
+    try:
+        gallery.upsert(employee_id, encoding)
+        publish_gallery()
+        return jsonify({'message': 'Gallery updated successfully'}), 200
+    except Exception as e:
+        logger.error(f"Error in gallery update: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/admin/gallery/stats', methods=['GET'])
+@admin_required
+def gallery_stats(current_user):
+    """
+    Admin endpoint reporting the matcher in use and, on request, its
+    recall@1 against exact search
+    """
+    stats = gallery.stats()
+    stats['snapshot_etag'] = gallery.etag
+    if request.args.get('recall'):
+        stats['recall_at_1'] = gallery.recall_at_1()
+    return jsonify(stats), 200
+
+@app.route('/api/admin/bulk-enroll', methods=['POST'])
+@admin_required
+def bulk_enroll_faces(current_user):
+    """
+    Admin endpoint enrolling a zip of images (<employee_id>.jpg files,
+    <employee_id>/ folders or a manifest.csv) in one pass. The gallery is
+    reloaded once at the end and each employee's last image is archived.
+    Images are encoded a few at a time, each batch in its own enrollment
+    pipeline slot, so scans keep being served during a large import.
+    """
+    if 'archive' not in request.files:
+        return jsonify({'error': 'No archive provided'}), 400
+    append = request.form.get('append', '').lower() in ('1', 'true', 'yes')
+    try:
+        items, profiles = bulk_enroll.read_zip(request.files['archive'].stream)
+    except (bulk_enroll.ManifestError, zipfile.BadZipFile) as e:
+        return jsonify({'error': str(e)}), 400
+    try:
+        result, encoded, written = bulk_enroll.enroll(
+            items, profiles, append=append, admit=lambda: admission.admit(PRIORITY_ENROLL)
+        )
+        if result['employees']:
+            reload_gallery()
+
+        written = set(written)
+        images = {}
+        for item, (employee_id, _, encoding, _) in zip(items, encoded):
+            if encoding is not None and employee_id in written:
+                images[employee_id] = item['data']
+        for employee_id, image_bytes in images.items():
+            public_id = f"employee_{employee_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            archive_outbox.enqueue(image_bytes, "employee_faces", public_id, {'employee_id': employee_id})
+
+        return jsonify(result), 200
+    except Overloaded:
+        raise
+    except Exception as e:
+        logger.error(f"Error in bulk enrollment: {str(e)}")
+        return jsonify({'error': 'Internal server error'}), 500
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000, debug=True) 
\ No newline at end of file
+    # Development server only; serve production traffic with
+    # gunicorn -c gunicorn.conf.py app:app
+    app.run(host='0.0.0.0', port=8000, debug=os.getenv('FLASK_DEBUG', '1') == '1') 
\ No newline at end of file
@@ -0,0 +1,229 @@
+import os
+import json
+import time
+import heapq
+import uuid
+import random
+import shutil
+import logging
+import threading
+from processes import pid_alive
+
+logger = logging.getLogger(__name__)
+
+# Directory the outbox spools images to; survives restarts
+ARCHIVE_OUTBOX_DIR = os.environ.get('ARCHIVE_OUTBOX_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive_outbox'))
+# 'cloudinary', or 'local' to copy into ARCHIVE_LOCAL_DIR instead (development and tests)
+ARCHIVE_UPLOADER = os.environ.get('ARCHIVE_UPLOADER', 'cloudinary')
+ARCHIVE_LOCAL_DIR = os.environ.get('ARCHIVE_LOCAL_DIR', os.path.join(ARCHIVE_OUTBOX_DIR, 'uploaded'))
+ARCHIVE_WORKERS = int(os.environ.get('ARCHIVE_WORKERS', '2'))
+ARCHIVE_MAX_ATTEMPTS = int(os.environ.get('ARCHIVE_MAX_ATTEMPTS', '8'))
+# First retry delay in seconds; doubles per attempt up to ARCHIVE_MAX_BACKOFF
+ARCHIVE_BACKOFF = float(os.environ.get('ARCHIVE_BACKOFF', '2.0'))
+ARCHIVE_MAX_BACKOFF = float(os.environ.get('ARCHIVE_MAX_BACKOFF', '600'))
+
+
+class CloudinaryUploader:
+    """
+    Uploads archived images to Cloudinary
+    """
+
+    def url_for(self, folder, public_id):
+        import cloudinary.utils
+        return cloudinary.utils.cloudinary_url(f"{folder}/{public_id}", secure=True)[0]
+
+    def upload(self, path, folder, public_id):
+        import cloudinary.uploader
+        return cloudinary.uploader.upload(path, folder=folder, public_id=public_id)['secure_url']
+
+
+class LocalUploader:
+    """
+    Stand-in upload target that copies images into a local directory
+    """
+
+    def __init__(self, directory=ARCHIVE_LOCAL_DIR):
+        self.directory = directory
+
+    def url_for(self, folder, public_id):
+        return 'file://' + os.path.join(os.path.abspath(self.directory), folder, public_id)
+
+    def upload(self, path, folder, public_id):
+        target = os.path.join(self.directory, folder)
+        os.makedirs(target, exist_ok=True)
+        shutil.copyfile(path, os.path.join(target, public_id))
+        return self.url_for(folder, public_id)
+
+
+def create_uploader(name=ARCHIVE_UPLOADER):
+    if name == 'local':
+        return LocalUploader()
+    if name != 'cloudinary':
+        logger.warning(f"Unknown ARCHIVE_UPLOADER {name!r}, using cloudinary")
+    return CloudinaryUploader()
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class ArchiveOutbox:
+    """
+    Durable on-disk queue of images waiting to be archived, drained by a
+    pool of worker threads.
+
+    Each job is an image file plus a JSON record. A job's record is named
+    <id>.json while pending and <id>.<pid>.json once a process has claimed
+    it, so several workers sharing the directory never upload the same
+    image twice, and jobs claimed by a process that died are picked up
+    again. Failed uploads are retried with exponential backoff; jobs that
+    exhaust their attempts are moved to failed/.
+    """
+
+    def __init__(self, directory=ARCHIVE_OUTBOX_DIR, uploader=None, workers=ARCHIVE_WORKERS,
+                 max_attempts=ARCHIVE_MAX_ATTEMPTS, backoff=ARCHIVE_BACKOFF, on_uploaded=None):
+        self.directory = directory
+        self.uploader = uploader or create_uploader()
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        # Called as on_uploaded(job, url) after each successful upload
+        self.on_uploaded = on_uploaded
+        self._heap = []
+        self._cond = threading.Condition()
+        self._threads = []
+        self._pid = None
+        os.makedirs(os.path.join(directory, 'failed'), exist_ok=True)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def url_for(self, folder, public_id):
+        """
+        The URL an image will have once archived, known before the upload
+        """
+        return self.uploader.url_for(folder, public_id)
+
+    def enqueue(self, data, folder, public_id, meta=None):
+        """
+        Spool image bytes for upload and return the job id. The job is on
+        disk before this returns, so it is not lost if the process exits.
+        """
+        self.start()
+        job_id = uuid.uuid4().hex
+        job = {'id': job_id, 'folder': folder, 'public_id': public_id, 'meta': meta or {},
+               'attempts': 0, 'created_at': time.time()}
+        _write_atomic(self._path(job_id, 'bin'), data)
+        # Written directly in claimed form: this process uploads it
+        _write_atomic(self._claimed_path(job_id), json.dumps(job).encode('utf-8'))
+        self._schedule(job_id, time.monotonic())
+        return job_id
+
+    def pending(self):
+        """
+        Number of jobs waiting in the directory, across all processes
+        """
+        return sum(1 for name in os.listdir(self.directory) if name.endswith('.json'))
+
+    def _path(self, job_id, ext):
+        return os.path.join(self.directory, f"{job_id}.{ext}")
+
+    def _claimed_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.{os.getpid()}.json")
+
+    def start(self):
+        # Threads are started lazily and per process, so a prefork server
+        # does not inherit dead threads from its parent
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._heap = []
+            self._threads = [
+                threading.Thread(target=self._run, name=f'archive-outbox-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+        for thread in self._threads:
+            thread.start()
+        self._recover()
+
+    def _after_fork(self):
+        # The parent's threads do not exist in the child and may have held
+        # the lock at fork time
+        self._cond = threading.Condition()
+        self._heap = []
+        self._threads = []
+        self._pid = None
+
+    def _recover(self):
+        """
+        Claim jobs left pending, or held by processes that no longer exist
+        """
+        for name in os.listdir(self.directory):
+            parts = name.split('.')
+            if parts[-1] != 'json':
+                continue
+            if len(parts) == 3 and (int(parts[1]) == os.getpid() or pid_alive(int(parts[1]))):
+                continue
+            try:
+                os.rename(os.path.join(self.directory, name), self._claimed_path(parts[0]))
+            except OSError:
+                # Claimed by another process first
+                continue
+            self._schedule(parts[0], time.monotonic())
+
+    def _schedule(self, job_id, due):
+        with self._cond:
+            heapq.heappush(self._heap, (due, job_id))
+            self._cond.notify()
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[1]
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _run(self):
+        while True:
+            job_id = self._next_job()
+            try:
+                self._attempt(job_id)
+            except Exception as e:
+                logger.error(f"Error processing archive job {job_id}: {str(e)}")
+
+    def _attempt(self, job_id):
+        record_path = self._claimed_path(job_id)
+        with open(record_path, 'rb') as f:
+            job = json.loads(f.read().decode('utf-8'))
+        try:
+            url = self.uploader.upload(self._path(job_id, 'bin'), job['folder'], job['public_id'])
+        except Exception as e:
+            job['attempts'] += 1
+            job['last_error'] = str(e)
+            if job['attempts'] >= self.max_attempts:
+                logger.error(f"Giving up archiving {job['public_id']} after {job['attempts']} attempts: {str(e)}")
+                failed = os.path.join(self.directory, 'failed')
+                os.replace(self._path(job_id, 'bin'), os.path.join(failed, f"{job_id}.bin"))
+                _write_atomic(os.path.join(failed, f"{job_id}.json"), json.dumps(job).encode('utf-8'))
+                os.remove(record_path)
+                return
+            delay = min(self.backoff * 2 ** (job['attempts'] - 1), ARCHIVE_MAX_BACKOFF)
+            delay *= random.uniform(0.5, 1.0)
+            logger.warning(f"Archiving {job['public_id']} failed ({str(e)}), retrying in {delay:.1f}s")
+            _write_atomic(record_path, json.dumps(job).encode('utf-8'))
+            self._schedule(job_id, time.monotonic() + delay)
+            return
+
+        if self.on_uploaded:
+            try:
+                self.on_uploaded(job, url)
+            except Exception as e:
+                logger.error(f"Error recording archived image {job['public_id']}: {str(e)}")
+        os.remove(record_path)
+        os.remove(self._path(job_id, 'bin'))
@@ -0,0 +1,93 @@
+"""
+Compare face documents stored with legacy array encodings against the
+binary format: BSON bytes on the wire and the time to decode a gallery of
+documents into the (N, 128) matrix the service matches against.
+
+Runs offline: documents are BSON-encoded in memory the way MongoDB would
+send them, so no database is needed.
+
+    python benchmarks/bench_encoding_storage.py --faces 10000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import bson
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_codec():
+    """
+    Import the codec helpers without opening db_config's MongoDB connection
+    """
+    import ast
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'db_config.py')
+    with open(path) as f:
+        tree = ast.parse(f.read())
+    wanted = {'encode_face_encoding', 'decode_face_encoding', 'decode_face_encodings',
+              'ENCODING_FORMAT_VERSION', 'ENCODING_DTYPE'}
+    body = [
+        node for node in tree.body
+        if (isinstance(node, ast.FunctionDef) and node.name in wanted)
+        or (isinstance(node, ast.Assign) and any(getattr(t, 'id', None) in wanted for t in node.targets))
+    ]
+    namespace = {'np': np, 'Binary': bson.binary.Binary}
+    exec(compile(ast.Module(body=body, type_ignores=[]), path, 'exec'), namespace)
+    return namespace
+
+
+def time_load(wire, decode_face_encodings, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        docs = bson.decode_all(wire)
+        matrix = decode_face_encodings([doc['face_encoding'] for doc in docs])
+        best = min(best, time.perf_counter() - start)
+    return best, matrix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--faces', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    codec = load_codec()
+    rng = np.random.default_rng(0)
+    encodings = rng.normal(0, 0.1, (args.faces, 128))
+
+    legacy_wire = b''.join(
+        bson.encode({'employee_id': f'EMP{i:06d}', 'face_encoding': encoding.tolist()})
+        for i, encoding in enumerate(encodings)
+    )
+    binary_wire = b''.join(
+        bson.encode({'employee_id': f'EMP{i:06d}', 'face_encoding': codec['encode_face_encoding'](encoding)})
+        for i, encoding in enumerate(encodings)
+    )
+
+    legacy_time, legacy_matrix = time_load(legacy_wire, codec['decode_face_encodings'], args.repeat)
+    binary_time, binary_matrix = time_load(binary_wire, codec['decode_face_encodings'], args.repeat)
+
+    print(json.dumps({
+        'faces': args.faces,
+        'legacy': {
+            'bytes': len(legacy_wire),
+            'bytes_per_face': round(len(legacy_wire) / args.faces, 1),
+            'load_ms': round(legacy_time * 1000, 1),
+        },
+        'binary': {
+            'bytes': len(binary_wire),
+            'bytes_per_face': round(len(binary_wire) / args.faces, 1),
+            'load_ms': round(binary_time * 1000, 1),
+        },
+        'bytes_ratio': round(len(legacy_wire) / len(binary_wire), 2),
+        'load_speedup': round(legacy_time / binary_time, 2),
+        'max_abs_error': float(np.abs(legacy_matrix - binary_matrix).max()),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,274 @@
+"""
+Offline benchmark and load test for the recognition endpoints.
+
+Runs the Flask app in-process against a mongomock stand-in for MongoDB and
+a synthetic gallery, drives each endpoint from a pool of concurrent
+clients, and reports throughput, p50/p95/p99 latency and peak RSS per
+endpoint (sampled during its run, and as growth over the RSS before it),
+plus latency percentiles per pipeline stage (taken from the Server-Timing
+header). Results are written as JSON and can be compared against a
+previous run.
+
+    python benchmarks/bench_endpoints.py --gallery 10000 --concurrency 4 \\
+        --images path/to/faces --output results.json --baseline baseline.json
+
+Without --images, synthetic frames are used: they measure decode and
+detection cost, but no face is found, so encode and match are skipped.
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures  # noqa: E402
+
+ENDPOINTS = ('scan', 'scan_raw', 'mark', 'identify', 'scan_batch', 'worker')
+
+
+def percentiles(samples):
+    if not samples:
+        return {'p50_ms': None, 'p95_ms': None, 'p99_ms': None}
+    ordered = sorted(samples)
+
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 3)
+    return {'p50_ms': pick(0.50), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99)}
+
+
+def current_rss_mb():
+    # VmRSS from /proc; None where it is unavailable (e.g. macOS)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    return None
+
+
+class RSSSampler:
+    """
+    Peak resident set size while one endpoint runs, sampled on a background
+    thread: ru_maxrss is the whole process's high-water mark and would carry
+    earlier endpoints' peaks into later ones
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.baseline = current_rss_mb()
+        self.peak = self.baseline
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='rss-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+    def _sample(self):
+        rss = current_rss_mb()
+        if rss is not None and (self.peak is None or rss > self.peak):
+            self.peak = rss
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def report(self):
+        if self.baseline is None:
+            return {'peak_rss_mb': None, 'rss_delta_mb': None}
+        return {'peak_rss_mb': round(self.peak, 1), 'rss_delta_mb': round(self.peak - self.baseline, 1)}
+
+
+def parse_server_timing(header):
+    stages = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        if params.startswith('dur=') and name != 'total':
+            stages[name] = float(params[4:])
+    return stages
+
+
+def make_requests(images, sample_encodings):
+    """
+    endpoint -> function(client, i) performing request i and returning
+    (ok, server_timing_header)
+    """
+    b64_images = [base64.b64encode(data).decode('ascii') for data in images]
+    encodings = [list(map(float, e)) for e in sample_encodings] or [
+        list(map(float, e)) for e in fixtures.synthetic_encodings(1)[:, 0]
+    ]
+
+    def scan(client, i):
+        r = client.post('/face-recognition/scan', json={'image': b64_images[i % len(b64_images)]})
+        return r.status_code < 500, r.headers.get('Server-Timing')
+
+    def scan_raw(client, i):
+        r = client.post('/face-recognition/scan', data=images[i % len(images)], content_type='application/octet-stream')
+        return r.status_code < 500, r.headers.get('Server-Timing')
+
+    def mark(client, i):
+        from io import BytesIO
+        data = {'image': (BytesIO(images[i % len(images)]), 'frame.jpg')}
+        r = client.post('/api/attendance/mark', data=data, content_type='multipart/form-data')
+        return r.status_code < 500, r.headers.get('Server-Timing')
+
+    def identify(client, i):
+        r = client.post('/face-recognition/identify', json={'encoding': encodings[i % len(encodings)]},
+                        headers={'X-Service-Token': os.environ['FACE_SERVICE_TOKEN']})
+        return r.status_code < 500, r.headers.get('Server-Timing')
+
+    def scan_batch(client, i):
+        r = client.post('/face-recognition/scan-batch', json={'images': b64_images})
+        return r.status_code < 500, r.headers.get('Server-Timing')
+
+    def worker(client, i):
+        from face_scan import process_job
+        result = process_job({'id': i, 'image_b64': b64_images[i % len(b64_images)]})
+        return result.get('success') or result.get('error') == 'No face detected', None
+
+    return {'scan': scan, 'scan_raw': scan_raw, 'mark': mark, 'identify': identify, 'scan_batch': scan_batch, 'worker': worker}
+
+
+def run_endpoint(app, request, requests_count, concurrency, warmup):
+    """
+    Issue requests_count requests from concurrency threads (each with its
+    own test client) after warmup unmeasured ones
+    """
+    for i in range(warmup):
+        request(app.test_client(), i)
+
+    latencies = []
+    stages = {}
+    errors = [0]
+    lock = threading.Lock()
+    clients = threading.local()
+
+    def one(i):
+        if not hasattr(clients, 'client'):
+            clients.client = app.test_client()
+        start = time.perf_counter()
+        try:
+            ok, timing = request(clients.client, i)
+        except Exception:
+            ok, timing = False, None
+        elapsed = (time.perf_counter() - start) * 1000
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+            for name, duration in parse_server_timing(timing).items():
+                stages.setdefault(name, []).append(duration)
+
+    with RSSSampler() as rss:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, range(requests_count)))
+        wall = time.perf_counter() - start
+    return {
+        'requests': requests_count,
+        'errors': errors[0],
+        'throughput_rps': round(requests_count / wall, 2),
+        **percentiles(latencies),
+        **rss.report(),
+        'stages': {name: {'samples': len(s), **percentiles(s)} for name, s in sorted(stages.items())},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """
+    Per-endpoint percentage change against a baseline run; positive is
+    better for throughput and worse for latency
+    """
+    report = {}
+    for endpoint, current in results['endpoints'].items():
+        previous = baseline.get('endpoints', {}).get(endpoint)
+        if not previous:
+            continue
+        report[endpoint] = {
+            key: round((current[key] - previous[key]) / previous[key] * 100.0, 1)
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+            if current.get(key) is not None and previous.get(key)
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--gallery', type=int, default=1000, help='synthetic employees in the gallery')
+    parser.add_argument('--templates', type=int, default=1, help='templates per synthetic employee')
+    parser.add_argument('--images', help='directory of sample face images (default: synthetic frames)')
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--requests', type=int, default=100, help='measured requests per endpoint')
+    parser.add_argument('--warmup', type=int, default=5)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--output', help='write JSON results here')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    fixtures.use_local_mongo()
+    images = fixtures.load_images(args.images, width=args.width, height=args.height)
+    sample_encodings = fixtures.encode_samples(images)
+    enrolled = {f'SAMPLE{i:03d}': encoding for i, encoding in enumerate(sample_encodings)}
+    gallery_size = fixtures.populate_gallery(args.gallery, args.templates, enrolled)
+
+    # Imported after the fixtures are in place: app loads the gallery on import
+    from app import app
+
+    requests = make_requests(images, sample_encodings)
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'gallery_employees': gallery_size,
+            'templates_per_employee': args.templates,
+            'images': len(images),
+            'sample_faces': len(sample_encodings),
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'endpoints': {},
+    }
+    for endpoint in args.endpoints:
+        results['endpoints'][endpoint] = run_endpoint(
+            app, requests[endpoint], args.requests, args.concurrency, args.warmup
+        )
+        print(json.dumps({endpoint: results['endpoints'][endpoint]}), file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['vs_baseline_pct'] = compare(results, json.load(f))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""
+Bytes on the wire and CPU per scan for each way of uploading a frame.
+
+Sends the same frames through a Flask app that uses the service's upload
+handling (uploads.py) as base64 JSON, as a base64 data URL in JSON, as a
+multipart file and as a raw application/octet-stream body. It measures only
+ingestion: everything from the request bytes to the buffer handed to the
+image decoder. Decode, detection and encoding cost the same for every form.
+
+    python benchmarks/bench_ingest.py --size 200000 --requests 2000
+    python benchmarks/bench_ingest.py --images path/to/faces --output ingest.json
+"""
+import os
+import sys
+import json
+import time
+import base64
+import argparse
+import numpy as np
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from uploads import UploadRequest, request_image, decode_base64  # noqa: E402
+
+FORMS = ('json_base64', 'json_data_url', 'multipart', 'raw')
+
+
+def make_app():
+    app = Flask(__name__)
+    app.request_class = UploadRequest
+
+    @app.route('/ingest', methods=['POST'])
+    def ingest():
+        raw = request_image()
+        data = decode_base64(raw) if isinstance(raw, str) else raw
+        buffer = np.frombuffer(data, np.uint8)
+        return jsonify({'bytes': int(buffer.size)})
+    return app
+
+
+def make_request(form, image):
+    """
+    (body, content type) of one frame uploaded in the given form
+    """
+    if form == 'json_base64':
+        return json.dumps({'image': base64.b64encode(image).decode('ascii')}).encode(), 'application/json'
+    if form == 'json_data_url':
+        body = json.dumps({'image': 'data:image/jpeg;base64,' + base64.b64encode(image).decode('ascii')})
+        return body.encode(), 'application/json'
+    if form == 'multipart':
+        boundary = 'frame-boundary'
+        head = (f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="frame.jpg"\r\n'
+                'Content-Type: image/jpeg\r\n\r\n').encode()
+        return head + image + f'\r\n--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+    return image, 'application/octet-stream'
+
+
+def run_form(client, form, images, requests_count):
+    # Bodies are built up front so only the server side is measured
+    bodies = [make_request(form, image) for image in images]
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    for i in range(requests_count):
+        body, content_type = bodies[i % len(bodies)]
+        response = client.post('/ingest', data=body, content_type=content_type)
+        assert response.status_code == 200 and response.json['bytes'] == len(images[i % len(images)]), response.data
+    cpu = time.process_time() - start_cpu
+    wall = time.perf_counter() - start
+    return {
+        'bytes_per_scan': round(sum(len(body) for body, _ in bodies) / len(bodies)),
+        'cpu_us_per_scan': round(cpu / requests_count * 1e6, 1),
+        'wall_us_per_scan': round(wall / requests_count * 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', help='directory of sample images (default: random frames of --size bytes)')
+    parser.add_argument('--size', type=int, default=150000, help='bytes per random frame')
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--output', help='write JSON results here')
+    args = parser.parse_args()
+
+    if args.images:
+        import fixtures
+        images = fixtures.load_images(args.images)
+    else:
+        rng = np.random.default_rng(0)
+        images = [rng.integers(0, 256, args.size, dtype=np.uint8).tobytes() for _ in range(4)]
+
+    client = make_app().test_client()
+    results = {'meta': {'images': len(images), 'mean_image_bytes': round(sum(map(len, images)) / len(images)),
+                        'requests': args.requests}, 'forms': {}}
+    for form in FORMS:
+        run_form(client, form, images, min(50, args.requests))
+        results['forms'][form] = run_form(client, form, images, args.requests)
+
+    baseline = results['forms']['json_base64']
+    results['raw_vs_json_base64'] = {
+        'bytes_saved_per_scan': baseline['bytes_per_scan'] - results['forms']['raw']['bytes_per_scan'],
+        'cpu_us_saved_per_scan': round(baseline['cpu_us_per_scan'] - results['forms']['raw']['cpu_us_per_scan'], 1),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
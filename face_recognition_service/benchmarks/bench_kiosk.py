@@ -0,0 +1,91 @@
+"""
+Replay a recorded kiosk video through the per-frame scan pipeline (decode,
+detect, encode and match every frame) and through a tracked KioskSession,
+and report sustained frames per second for each on one core.
+
+Frames are JPEG-encoded first so both paths pay the same decode cost a
+kiosk upload would. Matching runs against a small synthetic gallery.
+
+    python benchmarks/bench_kiosk.py path/to/kiosk.mp4 --frames 300 --detect-every 5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing import decode_image, find_faces, encode_faces  # noqa: E402
+from matchers import BruteForceMatcher  # noqa: E402
+from tracking import KioskSession  # noqa: E402
+
+
+def read_frames(path, limit):
+    capture = cv2.VideoCapture(path)
+    frames = []
+    while len(frames) < limit:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        frames.append(cv2.imencode('.jpg', frame)[1].tobytes())
+    capture.release()
+    return frames
+
+
+def make_match(size=1000, seed=0):
+    gallery = np.random.default_rng(seed).normal(0, 0.1, (size, 128)).astype(np.float32)
+    matcher = BruteForceMatcher(gallery)
+
+    def match(encodings):
+        _, distances = matcher.search(np.asarray(encodings, dtype=np.float32).reshape(-1, 128))
+        return [(None, float(d)) for d in distances[:, 0]]
+    return match
+
+
+def per_frame(frames, match):
+    encodes = 0
+    for frame in frames:
+        image = decode_image(frame)
+        locations = find_faces(image)
+        if locations:
+            match(encode_faces(image, locations))
+            encodes += len(locations)
+    return encodes
+
+
+def tracked(frames, match, detect_every):
+    session = KioskSession(decode_image, find_faces, encode_faces, match,
+                           lambda *args: {'status': 'marked'}, detect_every=detect_every)
+    for frame in frames:
+        session.process(frame)
+    return session.stats()['encodings']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--detect-every', type=int, default=5)
+    args = parser.parse_args()
+
+    cv2.setNumThreads(1)
+    frames = read_frames(args.video, args.frames)
+    if not frames:
+        raise SystemExit(f'No frames read from {args.video}')
+    match = make_match()
+
+    results = {'frames': len(frames)}
+    for name, run in (('per_frame', lambda: per_frame(frames, match)),
+                      ('tracked', lambda: tracked(frames, match, args.detect_every))):
+        start = time.perf_counter()
+        encodes = run()
+        elapsed = time.perf_counter() - start
+        results[name] = {'fps': round(len(frames) / elapsed, 1), 'encodings': encodes}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
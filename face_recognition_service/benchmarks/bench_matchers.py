@@ -0,0 +1,90 @@
+"""
+Scaling benchmark for the gallery matchers on synthetic 128-d encodings.
+
+For each gallery size it reports build time, per-query latency, queries per
+second and recall@1 of each matcher against exact brute-force search.
+
+    python benchmarks/bench_matchers.py --sizes 1000 10000 100000
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matchers import BruteForceMatcher, IVFMatcher  # noqa: E402
+
+
+def synthetic_gallery(size, dim=128, seed=0):
+    """
+    Encodings shaped roughly like dlib's: identity centres with per-dimension
+    spread ~0.1 (norm around 1.1) and small per-sample noise
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.1, (size, dim))
+    return (centres + rng.normal(0, 0.02, (size, dim))).astype(np.float32)
+
+
+def probe_queries(gallery, count, seed=1):
+    """
+    Noisy re-captures of random enrolled faces
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(gallery), min(count, len(gallery)), replace=False)
+    return (gallery[rows] + rng.normal(0, 0.03, (len(rows), gallery.shape[1]))).astype(np.float32)
+
+
+def bench(matcher, queries, exact_rows):
+    latencies = []
+    rows = []
+    for query in queries:
+        start = time.perf_counter()
+        row, _ = matcher.search(query[None, :])
+        latencies.append(time.perf_counter() - start)
+        rows.append(row[0, 0])
+    latencies = np.asarray(latencies) * 1000.0
+    return {
+        'p50_ms': round(float(np.percentile(latencies, 50)), 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 3),
+        'qps': round(len(queries) / (latencies.sum() / 1000.0), 1),
+        'recall_at_1': round(float((np.asarray(rows) == exact_rows).mean()), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--nprobe', type=int, default=8)
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        gallery = synthetic_gallery(size)
+        employee_ids = np.asarray([f'EMP{i:06d}' for i in range(size)], dtype=object)
+        queries = probe_queries(gallery, args.queries)
+
+        start = time.perf_counter()
+        brute = BruteForceMatcher(gallery)
+        brute_build = time.perf_counter() - start
+        exact_rows = brute.search(queries)[0][:, 0]
+
+        start = time.perf_counter()
+        ivf = IVFMatcher(gallery, employee_ids, nprobe=args.nprobe, index_path='')
+        ivf_build = time.perf_counter() - start
+
+        results.append({
+            'size': size,
+            'brute_force': {'build_s': round(brute_build, 3), **bench(brute, queries, exact_rows)},
+            'ivf': {'build_s': round(ivf_build, 3), **ivf.stats(), **bench(ivf, queries, exact_rows)},
+        })
+        print(json.dumps(results[-1]), file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Compare the old full-resolution pipeline (BGR image straight into
+face_locations/face_encodings) with preprocessing.py (reduced decode,
+downscaled detection, RGB crop encoding) on a directory of sample images.
+
+Throughput is reported for both. Match distance is reported as the L2
+distance of each pipeline's encoding to a reference encoding computed from
+the full-resolution RGB image, which is what face_recognition expects.
+
+    python benchmarks/bench_preprocessing.py path/to/images --repeat 3
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import cv2
+import face_recognition
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from preprocessing import decode_image, find_faces, encode_faces  # noqa: E402
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def legacy_pipeline(data):
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    locations = face_recognition.face_locations(image)
+    if not locations:
+        return None
+    return face_recognition.face_encodings(image, locations)[0]
+
+
+def preprocessed_pipeline(data):
+    image = decode_image(data)
+    locations = find_faces(image)
+    if not locations:
+        return None
+    return encode_faces(image, locations[:1])[0]
+
+
+def reference_encoding(data):
+    image = cv2.cvtColor(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), cv2.COLOR_BGR2RGB)
+    locations = face_recognition.face_locations(image)
+    if not locations:
+        return None
+    return face_recognition.face_encodings(image, locations)[0]
+
+
+def run(pipeline, images, repeat):
+    encodings = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for name, data in images.items():
+            encodings[name] = pipeline(data)
+    elapsed = time.perf_counter() - start
+    return len(images) * repeat / elapsed, encodings
+
+
+def distance_summary(encodings, references):
+    distances = [
+        float(np.linalg.norm(encodings[name] - reference))
+        for name, reference in references.items()
+        if reference is not None and encodings.get(name) is not None
+    ]
+    if not distances:
+        return None
+    return {'mean': round(float(np.mean(distances)), 4), 'max': round(float(np.max(distances)), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='Directory of sample face images')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    images = {}
+    for name in sorted(os.listdir(args.directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(args.directory, name), 'rb') as f:
+                images[name] = f.read()
+    if not images:
+        raise SystemExit(f"No images found in {args.directory}")
+
+    references = {name: reference_encoding(data) for name, data in images.items()}
+    legacy_rate, legacy = run(legacy_pipeline, images, args.repeat)
+    new_rate, new = run(preprocessed_pipeline, images, args.repeat)
+
+    print(json.dumps({
+        'images': len(images),
+        'legacy': {
+            'images_per_sec': round(legacy_rate, 2),
+            'faces_found': sum(e is not None for e in legacy.values()),
+            'distance_to_reference': distance_summary(legacy, references),
+        },
+        'preprocessed': {
+            'images_per_sec': round(new_rate, 2),
+            'faces_found': sum(e is not None for e in new.values()),
+            'distance_to_reference': distance_summary(new, references),
+        },
+        'speedup': round(new_rate / legacy_rate, 2),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
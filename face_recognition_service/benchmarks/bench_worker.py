@@ -0,0 +1,82 @@
+"""
+Compare face_scan.py latency when spawned per image (what the Node backend
+used to do) against a resident `--worker` process.
+
+    python benchmarks/bench_worker.py path/to/face.jpg --runs 20
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'face_scan.py')
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000.0
+    return {
+        'p50_ms': round(float(np.percentile(samples, 50)), 1),
+        'p99_ms': round(float(np.percentile(samples, 99)), 1),
+        'mean_ms': round(float(samples.mean()), 1),
+    }
+
+
+def bench_cold(image, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, SCRIPT, image], capture_output=True, text=True, check=True)
+        samples.append(time.perf_counter() - start)
+        if not json.loads(out.stdout).get('success'):
+            raise SystemExit(f"face_scan.py failed: {out.stdout.strip()}")
+    return samples
+
+
+def bench_warm(image, runs, workers):
+    py = subprocess.Popen(
+        [sys.executable, SCRIPT, '--worker', '--workers', str(workers)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1
+    )
+    try:
+        # The first job pays model loading; report it separately
+        start = time.perf_counter()
+        py.stdin.write(json.dumps({'id': 0, 'image': image}) + '\n')
+        json.loads(py.stdout.readline())
+        first = time.perf_counter() - start
+
+        samples = []
+        for i in range(1, runs + 1):
+            start = time.perf_counter()
+            py.stdin.write(json.dumps({'id': i, 'image': image}) + '\n')
+            result = json.loads(py.stdout.readline())
+            samples.append(time.perf_counter() - start)
+            if not result.get('success'):
+                raise SystemExit(f"worker failed: {result}")
+        return first, samples
+    finally:
+        py.stdin.close()
+        py.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('image', help='Image path containing one face')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    cold = bench_cold(args.image, args.runs)
+    first, warm = bench_warm(args.image, args.runs, args.workers)
+    print(json.dumps({
+        'runs': args.runs,
+        'cold_spawn': percentiles(cold),
+        'warm_worker': percentiles(warm),
+        'warm_worker_first_job_ms': round(first * 1000.0, 1),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""
+Offline fixtures for the endpoint benchmarks: an in-process MongoDB
+stand-in for db_config, a synthetic gallery generator and sample images.
+
+Import this module before anything that imports db_config.
+"""
+import os
+import sys
+import tempfile
+import numpy as np
+import cv2
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def use_local_mongo():
+    """
+    Point db_config at an in-process mongomock client and keep every other
+    side effect (image archival, snapshots) on the local disk. The result
+    cache is off unless RESULT_CACHE_SIZE is set.
+    """
+    try:
+        import mongomock
+    except ImportError:
+        raise SystemExit('The benchmarks need mongomock: pip install mongomock')
+    import pymongo
+    pymongo.MongoClient = mongomock.MongoClient
+    workdir = tempfile.mkdtemp(prefix='face-bench-')
+    os.environ.setdefault('ARCHIVE_UPLOADER', 'local')
+    os.environ.setdefault('ARCHIVE_OUTBOX_DIR', os.path.join(workdir, 'outbox'))
+    os.environ.setdefault('GALLERY_SNAPSHOT_PATH', '')
+    os.environ.setdefault('SERVER_TIMING', '1')
+    # Benchmarks resend the same frames; cached results would skip the pipeline
+    os.environ.setdefault('RESULT_CACHE_SIZE', '0')
+    os.environ.setdefault('FACE_SERVICE_TOKEN', 'bench')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return workdir
+
+
+def synthetic_encodings(employees, templates_per_employee=1, seed=0):
+    """
+    (employees * templates, 128) float32 encodings shaped like dlib's:
+    identity centres with a little per-template noise
+    """
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(0, 0.1, (employees, 128))
+    noise = rng.normal(0, 0.02, (employees, templates_per_employee, 128))
+    return (centres[:, None, :] + noise).astype(np.float32)
+
+
+def populate_gallery(employees, templates_per_employee=1, enrolled=None, seed=0):
+    """
+    Fill the faces and users collections with a synthetic gallery.
+    enrolled maps extra employee ids to real encodings (e.g. of the sample
+    images) so recognition requests have something to match.
+    """
+    from db_config import face_collection, employee_collection, encode_face_encoding
+    from gallery_index import summarize_templates
+
+    face_collection.delete_many({})
+    employee_collection.delete_many({})
+    faces = []
+    users = []
+    encodings = synthetic_encodings(employees, templates_per_employee, seed)
+    items = [(f'EMP{i:06d}', templates) for i, templates in enumerate(encodings)]
+    items += [(employee_id, np.asarray(encoding, dtype=np.float32)[None, :])
+              for employee_id, encoding in (enrolled or {}).items()]
+    for employee_id, templates in items:
+        centroid, spread = summarize_templates(templates)
+        faces.append({
+            'employee_id': employee_id,
+            'templates': [{'encoding': encode_face_encoding(t), 'source': 'enrollment'} for t in templates],
+            'centroid': encode_face_encoding(centroid),
+            'spread': spread,
+            'revision': 1,
+        })
+        users.append({'employee_id': employee_id, 'name': f'Employee {employee_id}', 'role': 'employee'})
+    if faces:
+        face_collection.insert_many(faces)
+        employee_collection.insert_many(users)
+    return len(items)
+
+
+def synthetic_image(width=640, height=480, seed=0):
+    """
+    A JPEG with smooth gradients and noise. It exercises decode and
+    detection cost; no face will be found in it.
+    """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    image = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+def load_images(directory=None, count=4, width=640, height=480):
+    """
+    Sample image bytes: the images in directory when given (use real face
+    photos to measure the full pipeline), otherwise synthetic frames
+    """
+    if directory:
+        names = sorted(n for n in os.listdir(directory) if n.lower().endswith(IMAGE_EXTENSIONS))
+        images = []
+        for name in names:
+            with open(os.path.join(directory, name), 'rb') as f:
+                images.append(f.read())
+        if images:
+            return images
+    return [synthetic_image(width, height, seed) for seed in range(count)]
+
+
+def encode_samples(images):
+    """
+    Encoding of the first face in each sample image, for enrolling the
+    samples in the synthetic gallery; images without a face are skipped
+    """
+    from preprocessing import decode_image, find_faces, encode_faces
+
+    encodings = []
+    for data in images:
+        image = decode_image(data)
+        locations = find_faces(image) if image is not None else []
+        if locations:
+            encodings.append(encode_faces(image, locations[:1])[0])
+    return encodings
@@ -0,0 +1,346 @@
+"""
+Enroll many employees' faces at once.
+
+    python bulk_enroll.py path/to/source [--workers 4] [--append] [--dry-run]
+
+The source is one of:
+  - a directory holding <employee_id>.jpg files or <employee_id>/ folders
+    of images (each image becomes one template),
+  - a zip archive with the same layout,
+  - a CSV manifest with employee_id and image columns (image paths are
+    relative to the CSV) and optional name and email columns.
+
+Images are encoded across a pool of warm worker processes. Faces are
+written with batched bulk_write operations and the gallery snapshot is
+rebuilt once at the end. Images that fail (no face, several faces, a face
+too small or too blurry) are listed in the JSON report.
+"""
+import os
+import io
+import csv
+import sys
+import json
+import zipfile
+import argparse
+import logging
+import multiprocessing
+from datetime import datetime
+import cv2
+from preprocessing import decode_image, find_faces, encode_faces
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# Smallest face box side (pixels, in the decoded image) accepted for enrollment
+BULK_MIN_FACE_SIZE = int(os.environ.get('BULK_MIN_FACE_SIZE', '80'))
+# Variance of the Laplacian over the face below which it is considered blurred
+BULK_MIN_SHARPNESS = float(os.environ.get('BULK_MIN_SHARPNESS', '40'))
+BULK_WORKERS = int(os.environ.get('BULK_ENROLL_WORKERS', str(os.cpu_count() or 1)))
+BULK_BATCH_SIZE = 500
+# Images encoded per pipeline slot when enrolling inside the web service
+BULK_ADMIT_CHUNK = int(os.environ.get('BULK_ADMIT_CHUNK', '8'))
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def _employee_from_path(name):
+    """
+    employee_id for an image path: its folder when nested, else the file stem
+    """
+    parts = name.replace('\\', '/').strip('/').split('/')
+    if len(parts) > 1:
+        return parts[-2]
+    return os.path.splitext(parts[-1])[0]
+
+
+def read_directory(path):
+    items = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                full = os.path.join(root, name)
+                rel = os.path.relpath(full, path)
+                with open(full, 'rb') as f:
+                    items.append({'employee_id': _employee_from_path(rel), 'source': rel, 'data': f.read()})
+    return items, {}
+
+
+def read_zip(source):
+    """
+    Items from a zip archive, given as a path or a file-like object. A
+    manifest.csv at the archive root takes precedence over the layout.
+    """
+    with zipfile.ZipFile(source) as archive:
+        names = [n for n in archive.namelist() if not n.endswith('/')]
+        if 'manifest.csv' in names:
+            text = archive.read('manifest.csv').decode('utf-8-sig')
+            return _read_manifest(text, lambda image: archive.read(image[2:] if image.startswith('./') else image))
+        items = [
+            {'employee_id': _employee_from_path(name), 'source': name, 'data': archive.read(name)}
+            for name in sorted(names)
+            if name.lower().endswith(IMAGE_EXTENSIONS) and not os.path.basename(name).startswith('.')
+        ]
+    return items, {}
+
+
+def read_csv(path):
+    base = os.path.dirname(os.path.abspath(path))
+
+    def load(image):
+        with open(os.path.join(base, image), 'rb') as f:
+            return f.read()
+    with open(path, encoding='utf-8-sig') as f:
+        return _read_manifest(f.read(), load)
+
+
+def _read_manifest(text, load):
+    """
+    (items, {employee_id: {'name', 'email'}}) from manifest CSV text. Rows
+    whose image cannot be read become failed items.
+    """
+    reader = csv.DictReader(io.StringIO(text))
+    if not reader.fieldnames or not {'employee_id', 'image'} <= set(reader.fieldnames):
+        raise ManifestError('Manifest needs employee_id and image columns')
+    items = []
+    profiles = {}
+    for row in reader:
+        employee_id = (row.get('employee_id') or '').strip()
+        image = (row.get('image') or '').strip()
+        if not employee_id or not image:
+            continue
+        profile = {k: row[k].strip() for k in ('name', 'email') if row.get(k)}
+        if profile:
+            profiles[employee_id] = profile
+        try:
+            items.append({'employee_id': employee_id, 'source': image, 'data': load(image)})
+        except (OSError, KeyError) as e:
+            items.append({'employee_id': employee_id, 'source': image, 'data': None, 'error': f'unreadable: {e}'})
+    return items, profiles
+
+
+def read_source(source):
+    """
+    (items, profiles) from a directory, zip archive or CSV manifest
+    """
+    if os.path.isdir(source):
+        return read_directory(source)
+    if zipfile.is_zipfile(source):
+        return read_zip(source)
+    if source.lower().endswith('.csv'):
+        return read_csv(source)
+    raise ManifestError(f'{source} is not a directory, zip archive or CSV manifest')
+
+
+def encode_item(item):
+    """
+    Encode one image; runs in the worker pool. Returns (employee_id,
+    source, encoding as a list or None, error or None).
+    """
+    employee_id, source = item['employee_id'], item['source']
+    if item.get('error'):
+        return employee_id, source, None, item['error']
+    try:
+        image = decode_image(item['data'])
+        if image is None:
+            return employee_id, source, None, 'invalid_image'
+        locations = find_faces(image)
+        if not locations:
+            return employee_id, source, None, 'no_face'
+        if len(locations) > 1:
+            return employee_id, source, None, 'multiple_faces'
+        top, right, bottom, left = locations[0]
+        if min(bottom - top, right - left) < BULK_MIN_FACE_SIZE:
+            return employee_id, source, None, 'face_too_small'
+        gray = cv2.cvtColor(image[top:bottom, left:right], cv2.COLOR_BGR2GRAY)
+        if cv2.Laplacian(gray, cv2.CV_64F).var() < BULK_MIN_SHARPNESS:
+            return employee_id, source, None, 'blurry'
+        return employee_id, source, encode_faces(image, locations)[0].tolist(), None
+    except Exception as e:
+        return employee_id, source, None, f'error: {e}'
+
+
+def encode_items(items, workers=BULK_WORKERS):
+    """
+    Encode every item across a pool of warm processes, in input order
+    """
+    from face_scan import warm_up
+    if workers <= 1 or len(items) <= 1:
+        warm_up()
+        return [encode_item(item) for item in items]
+    # Spawned rather than forked: the caller may be a threaded web worker
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(min(workers, len(items)), initializer=warm_up) as pool:
+        return pool.map(encode_item, items, chunksize=4)
+
+
+def encode_admitted(items, admit, chunk_size=BULK_ADMIT_CHUNK):
+    """
+    Encode items in the calling thread, in input order, inside one
+    admit() context (a pipeline slot) per chunk, so scans queued meanwhile
+    are served between chunks
+    """
+    encoded = []
+    for start in range(0, len(items), chunk_size):
+        with admit():
+            encoded.extend(encode_item(item) for item in items[start:start + chunk_size])
+    return encoded
+
+
+def _bulk_write(collection, operations, employee_ids, batch_size):
+    """
+    Run the operations in unordered batches; returns {employee_id: error}
+    for the ones the server rejected, e.g. a profile whose email is taken
+    """
+    from pymongo.errors import BulkWriteError
+    errors = {}
+    for start in range(0, len(operations), batch_size):
+        try:
+            collection.bulk_write(operations[start:start + batch_size], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                employee_id = employee_ids[start + error['index']]
+                if error.get('code') == 11000 and 'email' in (error.get('keyPattern') or error.get('errmsg', '')):
+                    errors[employee_id] = 'duplicate_email'
+                else:
+                    errors[employee_id] = f"write_failed: {error.get('errmsg', '')}"
+    return errors
+
+
+def write_faces(encoded, profiles=None, append=False, batch_size=BULK_BATCH_SIZE, dry_run=False):
+    """
+    Write the encoded templates to faces (and profiles to users) in bulk.
+    Profiles are written first and employees whose profile is rejected get
+    no faces. Returns (ids of the employees written, ids of those without a
+    users document, who can be matched but not named, {employee_id: error}
+    for those whose writes failed).
+    """
+    from pymongo import UpdateOne
+    from db_config import face_collection, employee_collection, encode_face_encoding
+    from gallery_index import stored_templates, summarize_templates
+    from face_templates import evict_templates, SOURCE_ENROLLMENT, COLOR_SPACE, LEGACY_COLOR_SPACE
+
+    now = datetime.utcnow()
+    by_employee = {}
+    for employee_id, _, encoding, _ in encoded:
+        if encoding is not None:
+            by_employee.setdefault(employee_id, []).append(
+                {'encoding': encode_face_encoding(encoding), 'source': SOURCE_ENROLLMENT, 'color_space': COLOR_SPACE,
+                 'created_at': now}
+            )
+    user_ids = [employee_id for employee_id in (profiles or {}) if employee_id in by_employee]
+    user_operations = [
+        UpdateOne({'employee_id': employee_id}, {'$set': profiles[employee_id], '$setOnInsert': {'created_at': now}},
+                  upsert=True)
+        for employee_id in user_ids
+    ]
+    errors = {}
+    if not dry_run:
+        errors = _bulk_write(employee_collection, user_operations, user_ids, batch_size)
+        for employee_id in errors:
+            del by_employee[employee_id]
+
+    existing = {}
+    if append and by_employee:
+        for face in face_collection.find({'employee_id': {'$in': list(by_employee)}}):
+            existing[face['employee_id']] = face
+
+    face_ids = list(by_employee)
+    operations = []
+    for employee_id, templates in by_employee.items():
+        face = existing.get(employee_id)
+        if face and face.get('templates'):
+            templates = list(face['templates']) + templates
+        elif face and face.get('face_encoding') is not None:
+            templates = [{'encoding': encode_face_encoding(stored_templates(face)[0]), 'source': SOURCE_ENROLLMENT,
+                          'color_space': LEGACY_COLOR_SPACE, 'created_at': face.get('created_at', now)}] + templates
+        templates = evict_templates(templates)
+        centroid, spread = summarize_templates(stored_templates({'templates': templates}))
+        operations.append(UpdateOne({'employee_id': employee_id}, {
+            '$set': {
+                'templates': templates,
+                'centroid': encode_face_encoding(centroid),
+                'spread': spread,
+                'updated_at': now,
+            },
+            '$inc': {'revision': 1},
+            '$unset': {'face_encoding': ''},
+            '$setOnInsert': {'created_at': now},
+        }, upsert=True))
+
+    if not dry_run:
+        face_errors = _bulk_write(face_collection, operations, face_ids, batch_size)
+        for employee_id in face_errors:
+            del by_employee[employee_id]
+        errors.update(face_errors)
+    known = set()
+    if by_employee:
+        known = {user['employee_id'] for user in employee_collection.find(
+            {'employee_id': {'$in': list(by_employee)}}, {'employee_id': 1})}
+    missing = [employee_id for employee_id in by_employee if employee_id not in known and employee_id not in (profiles or {})]
+    return list(by_employee), missing, errors
+
+
+def report(encoded, written, missing_users, write_errors=None):
+    """
+    JSON report of an import; images of employees whose writes failed are
+    listed as failures with the write error
+    """
+    write_errors = write_errors or {}
+    failures = [
+        {'employee_id': employee_id, 'source': source, 'error': error or write_errors[employee_id]}
+        for employee_id, source, encoding, error in encoded
+        if error or (encoding is not None and employee_id in write_errors)
+    ]
+    return {
+        'images': len(encoded),
+        'encoded': sum(1 for _, _, encoding, _ in encoded if encoding is not None),
+        'employees': len(written),
+        'failures': failures,
+        'missing_users': missing_users,
+    }
+
+
+def enroll(items, profiles=None, workers=BULK_WORKERS, append=False, dry_run=False, admit=None):
+    """
+    Encode and write a batch of items; returns (report, encoded results,
+    ids of the employees written). With admit, items are encoded in this
+    thread a chunk per admit() context (see encode_admitted) instead of on
+    a process pool.
+    """
+    encoded = encode_admitted(items, admit) if admit else encode_items(items, workers)
+    written, missing_users, write_errors = write_faces(encoded, profiles, append=append, dry_run=dry_run)
+    return report(encoded, written, missing_users, write_errors), encoded, written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='directory, zip archive or CSV manifest')
+    parser.add_argument('--workers', type=int, default=BULK_WORKERS)
+    parser.add_argument('--append', action='store_true', help='add to existing templates instead of replacing them')
+    parser.add_argument('--dry-run', action='store_true', help='encode and report without writing')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    try:
+        items, profiles = read_source(args.source)
+    except ManifestError as e:
+        raise SystemExit(str(e))
+    result, _, _ = enroll(items, profiles, args.workers, args.append, args.dry_run)
+
+    if not args.dry_run and result['employees']:
+        # One gallery rebuild for the whole import
+        from gallery_snapshot import GALLERY_SNAPSHOT_PATH, write_snapshot
+        if GALLERY_SNAPSHOT_PATH:
+            from db_config import face_collection, employee_collection
+            from gallery_index import read_gallery
+            result['snapshot_etag'] = write_snapshot(GALLERY_SNAPSHOT_PATH, read_gallery(face_collection, employee_collection))
+        else:
+            logger.info('No GALLERY_SNAPSHOT_PATH; send SIGHUP to the face service to reload its gallery')
+    print(json.dumps(result, indent=2))
+    sys.exit(1 if result['failures'] and not result['encoded'] else 0)
+
+
+if __name__ == '__main__':
+    main()
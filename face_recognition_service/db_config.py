@@ -1,7 +1,12 @@
 import os
-from pymongo import MongoClient
+import numpy as np
+from bson.binary import Binary
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 from dotenv import load_dotenv
 import logging
+from datetime import datetime
+from metrics import timed
 
 # Load environment variables from .env file
 load_dotenv()
@@ -11,7 +16,18 @@ logger = logging.getLogger(__name__)
 # Never commit secrets or credentials to GitHub!
 MONGODB_URI = os.environ.get("MONGODB_URI")
 
+# Face encodings are stored as {'v': 1, 'dtype': '<f4', 'data': Binary(...)}:
+# 512 bytes of little-endian float32 instead of 128 BSON doubles with keys
+ENCODING_FORMAT_VERSION = 1
+ENCODING_DTYPE = '<f4'
+
+# Set to 0 to leave index management to a DBA / migration
+ENSURE_INDEXES = os.environ.get('MONGODB_ENSURE_INDEXES', '1') != '0'
+
 def get_database():
+    """
+    Connect to MongoDB and return the service's database
+    """
     try:
         client = MongoClient(MONGODB_URI)
         
@@ -25,12 +41,166 @@ def get_database():
         logger.error(f"Error connecting to MongoDB: {str(e)}")
         raise
 
+def encode_face_encoding(encoding):
+    """
+    Pack a face encoding into its binary storage form
+    """
+    data = np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+    return {'v': ENCODING_FORMAT_VERSION, 'dtype': ENCODING_DTYPE, 'data': Binary(data)}
+
+def decode_face_encoding(stored):
+    """
+    Unpack a stored face encoding into a float32 vector. Accepts the binary
+    form as well as legacy lists of doubles written before the migration.
+    """
+    if stored is None:
+        return None
+    if isinstance(stored, dict):
+        if stored.get('v') != ENCODING_FORMAT_VERSION:
+            raise ValueError(f"Unsupported face encoding version {stored.get('v')}")
+        return np.frombuffer(stored['data'], dtype=stored.get('dtype', ENCODING_DTYPE)).astype(np.float32)
+    return np.asarray(stored, dtype=np.float32)
+
+def decode_face_encodings(stored_values, dim=128):
+    """
+    Unpack many stored encodings into one (N, dim) float32 matrix. Binary
+    values are joined and converted in a single frombuffer call.
+    """
+    stored_values = list(stored_values)
+    if all(isinstance(v, dict) and v.get('v') == ENCODING_FORMAT_VERSION
+           and v.get('dtype', ENCODING_DTYPE) == ENCODING_DTYPE for v in stored_values):
+        data = b''.join(bytes(v['data']) for v in stored_values)
+        return np.frombuffer(data, dtype=ENCODING_DTYPE).astype(np.float32).reshape(-1, dim)
+    return np.asarray([decode_face_encoding(v) for v in stored_values], dtype=np.float32).reshape(-1, dim)
+
 # Initialize database
 db = get_database()
 
+def connect():
+    """
+    Replace this process's MongoDB client with a new one. A client must not
+    be shared across fork, so forked workers call this before serving (see
+    gunicorn.conf.py); the collection handles below follow the new client.
+    """
+    global db
+    db = get_database()
+
+class CollectionHandle:
+    """
+    A collection looked up on the current client on every use, so modules
+    that imported it keep working after connect()
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(db.get_collection(self.name), attribute)
+
 # Collections - ensure these names match your Node.js models/collections
-face_collection = db.get_collection('faces')
+face_collection = CollectionHandle('faces')
 # The user collection is likely named 'users' by Mongoose default
-employee_collection = db.get_collection('users') 
-attendance_collection = db.get_collection('attendance') 
- 
\ No newline at end of file
+employee_collection = CollectionHandle('users')
+attendance_collection = CollectionHandle('attendance')
+ 
+
+def attendance_day(timestamp):
+    """
+    The UTC calendar day an attendance record counts for, as 'YYYY-MM-DD'
+    """
+    return timestamp.strftime('%Y-%m-%d')
+
+def ensure_indexes():
+    """
+    Create the indexes the service's queries rely on. create_index is a
+    no-op for an index that already exists, so this is safe on every start.
+    """
+    specs = [
+        # One attendance record per employee per day; records written before
+        # the day field existed are left out of the constraint
+        (attendance_collection, [('employee_id', ASCENDING), ('day', ASCENDING)],
+         {'name': 'employee_day', 'unique': True, 'partialFilterExpression': {'day': {'$exists': True}}}),
+        # Attendance history pages walk an employee's records newest first
+        (attendance_collection, [('employee_id', ASCENDING), ('timestamp', DESCENDING)], {'name': 'employee_timestamp'}),
+        (employee_collection, [('employee_id', ASCENDING)], {'name': 'employee_id'}),
+        (face_collection, [('employee_id', ASCENDING)], {'name': 'employee_id'}),
+    ]
+    for collection, keys, options in specs:
+        try:
+            collection.create_index(keys, **options)
+        except PyMongoError as e:
+            logger.error(f"Error creating index {options['name']} on {collection.name}: {str(e)}")
+
+def find_attendance(employee_id, before=None, start=None, end=None, limit=0, batch_size=500):
+    """
+    Cursor over an employee's attendance records, newest first, read along
+    the employee_timestamp index. before (exclusive) continues from the
+    last record of a previous page; start (inclusive) and end (exclusive)
+    bound the time range. A limit of 0 returns every matching record.
+    """
+    query = {'employee_id': employee_id}
+    bounds = {}
+    if start is not None:
+        bounds['$gte'] = start
+    upper = [t for t in (before, end) if t is not None]
+    if upper:
+        bounds['$lt'] = min(upper)
+    if bounds:
+        query['timestamp'] = bounds
+    return attendance_collection.find(
+        query, {'_id': 0, 'employee_id': 1, 'timestamp': 1, 'confidence': 1}
+    ).sort('timestamp', DESCENDING).limit(limit).batch_size(batch_size)
+
+@timed('attendance_write')
+def record_attendance(employee_id, confidence, timestamp=None):
+    """
+    Mark an employee present for the day in a single atomic upsert.
+
+    Returns (created, record): created is False when the employee was
+    already marked today, in which case record is the existing entry.
+    """
+    timestamp = timestamp or datetime.utcnow()
+    record = {'employee_id': employee_id, 'day': attendance_day(timestamp),
+              'timestamp': timestamp, 'confidence': confidence}
+    query = {'employee_id': employee_id, 'day': record['day']}
+    try:
+        existing = attendance_collection.find_one_and_update(
+            query, {'$setOnInsert': record}, upsert=True, return_document=ReturnDocument.BEFORE
+        )
+    except DuplicateKeyError:
+        # A concurrent upsert for the same employee and day won the insert
+        existing = attendance_collection.find_one(query)
+    if existing is None:
+        return True, record
+    return False, existing
+
+@timed('attendance_write')
+def record_attendance_many(confidences, timestamp=None):
+    """
+    Mark several employees present in one bulk write. confidences maps
+    employee_id to confidence; returns the set of employee ids newly marked.
+    """
+    if not confidences:
+        return set()
+    timestamp = timestamp or datetime.utcnow()
+    day = attendance_day(timestamp)
+    employee_ids = list(confidences)
+    operations = [
+        UpdateOne(
+            {'employee_id': employee_id, 'day': day},
+            {'$setOnInsert': {'employee_id': employee_id, 'day': day,
+                              'timestamp': timestamp, 'confidence': confidences[employee_id]}},
+            upsert=True
+        )
+        for employee_id in employee_ids
+    ]
+    try:
+        result = attendance_collection.bulk_write(operations, ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        # Duplicate keys from concurrent writers mean "already marked"
+        upserted = {item['index']: item['_id'] for item in e.details.get('upserted', [])}
+    return {employee_ids[index] for index in upserted}
+
+if ENSURE_INDEXES:
+    ensure_indexes()
@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from metrics import stage
+
+# Seconds a cached employee entry (or a cached miss) stays valid
+EMPLOYEE_CACHE_TTL = float(os.environ.get('EMPLOYEE_CACHE_TTL', '300'))
+
+
+class EmployeeDirectory:
+    """
+    In-process cache of the employee fields shown after a recognition, so a
+    scan does not need a users lookup on top of its attendance write.
+
+    Employees are found by the service's employee_id or, for users the Node
+    backend registered (whose faces the gallery includes), its employeeId.
+    """
+
+    def __init__(self, collection, ttl=EMPLOYEE_CACHE_TTL):
+        self.collection = collection
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # employee_id -> (expires_at, {'employee_id', 'name'} or None)
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, employee_id):
+        """
+        Display info for an employee, or None if no such employee exists
+        """
+        return self.get_many([employee_id]).get(employee_id)
+
+    def get_many(self, employee_ids):
+        """
+        {employee_id: info} for the employees that exist, fetching every
+        stale or missing entry in one query
+        """
+        now = time.monotonic()
+        found = {}
+        missing = []
+        with self._lock:
+            for employee_id in employee_ids:
+                entry = self._entries.get(employee_id)
+                if entry is None or entry[0] <= now:
+                    missing.append(employee_id)
+                elif entry[1] is not None:
+                    found[employee_id] = entry[1]
+            self.misses += len(missing)
+            self.hits += len(employee_ids) - len(missing)
+        if missing:
+            with stage('employee_lookup'):
+                employees = list(self.collection.find(
+                    {'$or': [{'employee_id': {'$in': missing}}, {'employeeId': {'$in': missing}}]},
+                    {'_id': 0, 'employee_id': 1, 'employeeId': 1, 'name': 1}
+                ))
+            wanted = set(missing)
+            fetched = {}
+            for employee in employees:
+                for key in (employee.get('employeeId'), employee.get('employee_id')):
+                    if key in wanted:
+                        fetched[key] = {'employee_id': key, 'name': employee.get('name')}
+            with self._lock:
+                for employee_id in missing:
+                    self._entries[employee_id] = (now + self.ttl, fetched.get(employee_id))
+            found.update(fetched)
+        return found
+
+    def invalidate(self, employee_id=None):
+        """
+        Forget one employee, or everyone when no id is given
+        """
+        with self._lock:
+            if employee_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(employee_id, None)
@@ -1,34 +1,221 @@
 import sys
 import json
+import base64
+import argparse
+import threading
 import requests
 import numpy as np
-import cv2
 import face_recognition
 import os
+import socket
+import socketserver
+from multiprocessing import Pool
+from preprocessing import decode_image, read_image, find_faces, encode_faces
 
-def main():
-    if len(sys.argv) < 2:
-        print(json.dumps({"success": False, "error": "No image URL or path provided"}))
-        return
-    img_input = sys.argv[1]
+DEFAULT_WORKERS = int(os.environ.get('FACE_SCAN_WORKERS', '1'))
+# Seconds allowed to download an image given by URL
+DOWNLOAD_TIMEOUT = float(os.environ.get('FACE_SCAN_DOWNLOAD_TIMEOUT', '10'))
+
+
+def load_image(job):
+    """
+    Decode the image referenced by a job: raw bytes sent after its header,
+    base64 bytes, a URL or a local path
+    """
+    if job.get('image_data') is not None:
+        return decode_image(job['image_data'])
+    if job.get('image_b64'):
+        image_data = job['image_b64']
+        image_data = image_data.split(',')[1] if ',' in image_data else image_data
+        return decode_image(base64.b64decode(image_data))
+    img_input = job.get('image') or ''
+    if img_input.startswith('http://') or img_input.startswith('https://'):
+        resp = requests.get(img_input, timeout=DOWNLOAD_TIMEOUT)
+        return decode_image(resp.content)
+    if os.path.exists(img_input):
+        return read_image(img_input)
+    return None
+
+
+def process_job(job):
+    """
+    Compute the face encoding for one job and return the JSON-ready result
+    """
+    result = {'id': job.get('id')} if 'id' in job else {}
     try:
-        if img_input.startswith('http://') or img_input.startswith('https://'):
-            resp = requests.get(img_input)
-            img_array = np.asarray(bytearray(resp.content), dtype=np.uint8)
-            img = cv2.imdecode(img_array, cv2.IMREAD_COLOR)
-        elif os.path.exists(img_input):
-            img = cv2.imread(img_input)
-        else:
-            print(json.dumps({"success": False, "error": "Invalid image path or URL"}))
-            return
-        face_locations = face_recognition.face_locations(img)
+        img = load_image(job)
+        if img is None:
+            result.update({"success": False, "error": "Invalid image path or URL"})
+            return result
+        face_locations = find_faces(img)
         if not face_locations:
-            print(json.dumps({"success": False, "error": "No face detected"}))
-            return
-        face_encoding = face_recognition.face_encodings(img, face_locations)[0]
-        print(json.dumps({"success": True, "encoding": face_encoding.tolist()}))
+            result.update({"success": False, "error": "No face detected"})
+            return result
+        face_encoding = encode_faces(img, face_locations[:1])[0]
+        result.update({"success": True, "encoding": face_encoding.tolist()})
     except Exception as e:
-        print(json.dumps({"success": False, "error": str(e)}))
+        result.update({"success": False, "error": str(e)})
+    return result
+
+
+def warm_up():
+    """
+    Run one detection so dlib's models are resident before the first job
+    """
+    blank = np.zeros((64, 64, 3), dtype=np.uint8)
+    face_recognition.face_encodings(blank, [(0, 63, 63, 0)])
+
+
+def parse_job(line, stream):
+    """
+    (job, None) or (None, error result) for one header line. A header with
+    "image_bytes": n is followed on the stream by n bytes of raw image,
+    read into job["image_data"].
+    """
+    try:
+        job = json.loads(line)
+    except ValueError:
+        return None, {"success": False, "error": "Invalid JSON job"}
+    if not isinstance(job, dict):
+        return None, {"success": False, "error": "Invalid JSON job"}
+    if 'image_bytes' in job:
+        error = {'id': job['id']} if 'id' in job else {}
+        size = job.pop('image_bytes')
+        if not isinstance(size, int) or isinstance(size, bool) or size < 0:
+            error.update({"success": False, "error": "Invalid image_bytes"})
+            return None, error
+        job['image_data'] = stream.read(size)
+        if len(job['image_data']) < size:
+            error.update({"success": False, "error": "Truncated image"})
+            return None, error
+    return job, None
+
+
+class JobRunner:
+    """
+    Runs jobs inline or on a pool of warm worker processes
+    """
+
+    def __init__(self, workers):
+        self.pool = None
+        if workers > 1:
+            self.pool = Pool(workers, initializer=warm_up)
+        else:
+            warm_up()
+
+    def submit(self, job, callback):
+        if self.pool is None:
+            callback(process_job(job))
+        else:
+            self.pool.apply_async(process_job, (job,), callback=callback)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+def serve_stdio(runner):
+    """
+    Read newline-delimited JSON jobs on stdin, each optionally followed by
+    raw image bytes (see parse_job), and write one result line per job on
+    stdout. With several workers results may arrive out of order, so
+    clients should match them by "id".
+    """
+    write_lock = threading.Lock()
+
+    def write(result):
+        with write_lock:
+            sys.stdout.write(json.dumps(result) + '\n')
+            sys.stdout.flush()
+
+    stdin = sys.stdin.buffer
+    for line in iter(stdin.readline, b''):
+        if not line.strip():
+            continue
+        job, error = parse_job(line, stdin)
+        if error:
+            write(error)
+            continue
+        runner.submit(job, write)
+    runner.close()
+
+
+def serve_socket(runner, socket_path):
+    """
+    Same protocol as serve_stdio, one stream per Unix socket connection
+    """
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            write_lock = threading.Lock()
+            pending = threading.Semaphore(0)
+            submitted = 0
+
+            def write(result):
+                with write_lock:
+                    try:
+                        self.wfile.write((json.dumps(result) + '\n').encode('utf-8'))
+                        self.wfile.flush()
+                    except OSError:
+                        pass
+                pending.release()
+
+            for line in iter(self.rfile.readline, b''):
+                if not line.strip():
+                    continue
+                job, error = parse_job(line, self.rfile)
+                submitted += 1
+                if error:
+                    write(error)
+                else:
+                    runner.submit(job, write)
+            # Keep the connection open until every job has answered
+            for _ in range(submitted):
+                pending.acquire()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    with Server(socket_path, Handler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            runner.close()
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute a 128-d face encoding for an image.')
+    parser.add_argument('image', nargs='?', help='Image URL or path (one-shot mode)')
+    parser.add_argument('--worker', action='store_true',
+                        help='Stay resident and read newline-delimited JSON jobs')
+    parser.add_argument('--socket', help='Serve jobs on this Unix socket instead of stdin/stdout')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='Number of encoding processes in worker mode')
+    args = parser.parse_args()
+
+    if args.worker or args.socket:
+        runner = JobRunner(max(1, args.workers))
+        if args.socket:
+            if not hasattr(socket, 'AF_UNIX'):
+                print(json.dumps({"success": False, "error": "Unix sockets are not supported on this platform"}))
+                return
+            serve_socket(runner, args.socket)
+        else:
+            serve_stdio(runner)
+        return
+
+    if not args.image:
+        print(json.dumps({"success": False, "error": "No image URL or path provided"}))
+        return
+    print(json.dumps(process_job({'image': args.image})))
+
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
@@ -0,0 +1,257 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from db_config import encode_face_encoding
+from gallery_index import stored_templates, summarize_templates
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+# Most templates kept per employee; the oldest automatic ones go first
+MAX_TEMPLATES = int(os.environ.get('FACE_MAX_TEMPLATES', '10'))
+# A confirmed scan is added as a template when its distance to the nearest
+# existing template falls in [AUTO_TEMPLATE_MIN_DISTANCE, AUTO_TEMPLATE_MAX_DISTANCE]:
+# close enough to be certain, far enough to add new information
+AUTO_TEMPLATE_MAX_DISTANCE = float(os.environ.get('FACE_AUTO_TEMPLATE_MAX_DISTANCE', '0.4'))
+AUTO_TEMPLATE_MIN_DISTANCE = float(os.environ.get('FACE_AUTO_TEMPLATE_MIN_DISTANCE', '0.2'))
+# Minimum seconds between automatic templates for the same employee
+AUTO_TEMPLATE_INTERVAL = float(os.environ.get('FACE_AUTO_TEMPLATE_INTERVAL', '3600'))
+# Scan templates claimed within this many seconds are written and applied
+# to the gallery together, off the scan's request thread
+AUTO_TEMPLATE_FLUSH_DELAY = float(os.environ.get('FACE_AUTO_TEMPLATE_FLUSH_DELAY', '10'))
+# Scan templates waiting to be written; beyond this new ones are dropped
+AUTO_TEMPLATE_MAX_PENDING = int(os.environ.get('FACE_AUTO_TEMPLATE_MAX_PENDING', '1000'))
+WRITE_RETRIES = 3
+
+SOURCE_ENROLLMENT = 'enrollment'
+SOURCE_SCAN = 'scan'
+
+# Channel order of the images new templates are encoded from (preprocessing
+# hands dlib RGB). Templates without a color_space predate that and were
+# encoded from BGR; reencode_faces.py replaces them.
+COLOR_SPACE = 'rgb'
+LEGACY_COLOR_SPACE = 'bgr'
+
+
+# Faces documents holding a BGR template, and Node users whose faceEmbeddings
+# (recorded with faceColorSpace since the switch) were encoded from BGR
+LEGACY_FACES_QUERY = {'$or': [
+    {'face_encoding': {'$exists': True}},
+    {'templates': {'$elemMatch': {'color_space': {'$ne': COLOR_SPACE}}}},
+]}
+LEGACY_USERS_QUERY = {'faceEmbeddings.0': {'$exists': True}, 'faceColorSpace': {'$ne': COLOR_SPACE}}
+
+
+def is_legacy(template):
+    return template.get('color_space', LEGACY_COLOR_SPACE) != COLOR_SPACE
+
+
+def count_legacy(collection, user_collection):
+    """
+    (faces documents, users) whose encodings still need reencode_faces.py
+    """
+    return collection.count_documents(LEGACY_FACES_QUERY), user_collection.count_documents(LEGACY_USERS_QUERY)
+
+
+def evict_templates(templates, limit=MAX_TEMPLATES):
+    """
+    Trim a template list to the limit, dropping the oldest scan-sourced
+    templates before any enrollment template
+    """
+    templates = list(templates)
+    while len(templates) > limit:
+        scans = [i for i, t in enumerate(templates) if t.get('source') == SOURCE_SCAN]
+        victim = scans[0] if scans else 0
+        templates.pop(victim)
+    return templates
+
+
+def _merged_templates(face, new_template, now, replace=False):
+    """
+    Template list of a faces document after adding new_template
+    """
+    if replace:
+        templates = []
+    elif face.get('templates'):
+        templates = list(face['templates'])
+    elif face.get('face_encoding') is not None:
+        # Carry a pre-template enrollment over as the first template
+        templates = [{'encoding': encode_face_encoding(stored_templates(face)[0]), 'source': SOURCE_ENROLLMENT,
+                      'color_space': LEGACY_COLOR_SPACE, 'created_at': face.get('created_at', now)}]
+    else:
+        templates = []
+    return evict_templates(templates + [new_template])
+
+
+def _guarded_update(face, employee_id, templates, now):
+    """
+    (query, update) writing templates only if the document is still at the
+    revision it was read at
+    """
+    centroid, spread = summarize_templates(stored_templates({'templates': templates}))
+    revision = face.get('revision')
+    query = {'employee_id': employee_id, 'revision': revision}
+    if revision is None:
+        query['revision'] = {'$exists': False}
+    return query, {
+        '$set': {
+            'templates': templates,
+            'centroid': encode_face_encoding(centroid),
+            'spread': spread,
+            'revision': (revision or 0) + 1,
+            'updated_at': now,
+        },
+        '$unset': {'face_encoding': ''},
+        '$setOnInsert': {'created_at': now},
+    }
+
+
+def _new_template(encoding, source, now):
+    return {'encoding': encode_face_encoding(encoding), 'source': source, 'color_space': COLOR_SPACE,
+            'created_at': now}
+
+
+@timed('template_write')
+def add_template(collection, employee_id, encoding, source=SOURCE_ENROLLMENT, replace=False):
+    """
+    Append a template to an employee's faces document and refresh its
+    centroid and spread. With replace=True all earlier templates are
+    discarded. Returns the employee's resulting (n, 128) template matrix.
+
+    Writes are guarded by a revision counter, so two concurrent additions
+    for the same employee cannot drop each other's template.
+    """
+    now = datetime.utcnow()
+    new_template = _new_template(encoding, source, now)
+    for _ in range(WRITE_RETRIES):
+        face = collection.find_one({'employee_id': employee_id}) or {}
+        templates = _merged_templates(face, new_template, now, replace)
+        query, update = _guarded_update(face, employee_id, templates, now)
+        result = collection.update_one(query, update, upsert=not face)
+        if result.matched_count or result.upserted_id is not None:
+            return stored_templates({'templates': templates})
+    raise RuntimeError(f"Concurrent template updates for employee {employee_id}")
+
+
+@timed('template_write')
+def add_scan_templates(collection, encodings):
+    """
+    Append one scan template per employee ({employee_id: encoding}) with a
+    single read and a single bulk write. Returns {employee_id: (n, 128)
+    template matrix} as stored afterwards. An employee whose document
+    changed in between keeps the other write and loses this template.
+    """
+    now = datetime.utcnow()
+    employee_ids = list(encodings)
+    faces = {face['employee_id']: face for face in collection.find({'employee_id': {'$in': employee_ids}})}
+    operations = []
+    for employee_id, encoding in encodings.items():
+        face = faces.get(employee_id, {})
+        templates = _merged_templates(face, _new_template(encoding, SOURCE_SCAN, now), now)
+        query, update = _guarded_update(face, employee_id, templates, now)
+        operations.append(UpdateOne(query, update, upsert=not face))
+    try:
+        collection.bulk_write(operations, ordered=False)
+    except BulkWriteError as e:
+        # Typically a concurrent first enrollment; the re-read below has it
+        logger.warning(f"Scan templates partly written: {len(e.details.get('writeErrors', []))} rejected")
+    stored = {}
+    for face in collection.find({'employee_id': {'$in': employee_ids}}):
+        templates = stored_templates(face)
+        if templates is not None and len(templates):
+            stored[face['employee_id']] = templates
+    return stored
+
+
+class AutoEnroller:
+    """
+    Decides which confirmed scans become new templates, rate-limited per
+    employee within this process
+    """
+
+    def __init__(self, min_distance=AUTO_TEMPLATE_MIN_DISTANCE, max_distance=AUTO_TEMPLATE_MAX_DISTANCE,
+                 interval=AUTO_TEMPLATE_INTERVAL):
+        self.min_distance = min_distance
+        self.max_distance = max_distance
+        self.interval = interval
+        self._last_added = {}
+        self._lock = threading.Lock()
+
+    def claim(self, employee_id, distance):
+        """
+        True if a scan matched at this distance should be added. Claiming
+        starts the employee's cool-down, so concurrent scans add at most one.
+        """
+        if distance is None or not (self.min_distance <= distance <= self.max_distance):
+            return False
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_added.get(employee_id)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last_added[employee_id] = now
+        return True
+
+
+class ScanTemplateWriter:
+    """
+    Writes claimed scan templates on a background thread, so a scan never
+    waits on them. Templates claimed within `delay` seconds are written
+    with one bulk write (see add_scan_templates) and handed to `apply` as
+    {employee_id: templates} in one call. Pending templates are dropped on
+    shutdown; they are only ever an opportunistic refinement.
+    """
+
+    def __init__(self, collection, apply, delay=AUTO_TEMPLATE_FLUSH_DELAY, max_pending=AUTO_TEMPLATE_MAX_PENDING):
+        self.collection = collection
+        self.apply = apply
+        self.delay = delay
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def submit(self, employee_id, encoding):
+        """
+        Queue a template; False when the queue is full and it was dropped
+        """
+        with self._lock:
+            if len(self._pending) >= self.max_pending and employee_id not in self._pending:
+                return False
+            self._pending[employee_id] = encoding
+            # Started lazily so it is created in the process that uses it,
+            # not inherited half-dead across a fork
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='scan-templates', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return True
+
+    def flush(self):
+        """
+        Write everything pending now; returns the number of employees written
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            stored = add_scan_templates(self.collection, pending)
+            if stored:
+                self.apply(stored)
+            return len(stored)
+        except Exception as e:
+            logger.error(f"Error writing {len(pending)} scan templates: {str(e)}")
+            return 0
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.delay)
+            self._wake.clear()
+            self.flush()
@@ -0,0 +1,305 @@
+import os
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+from db_config import decode_face_encoding, decode_face_encodings
+from matchers import create_matcher, GALLERY_MATCHER
+from metrics import timed
+
+logger = logging.getLogger(__name__)
+
+ENCODING_DIM = 128
+DEFAULT_TOLERANCE = 0.6
+# Employees whose centroids are nearest a query get their templates re-ranked
+TEMPLATE_TOP_K = int(os.environ.get('GALLERY_TEMPLATE_TOP_K', '8'))
+
+# Per-employee arrays (employee_ids, centroids, radii) and the templates of
+# employee row r, stored contiguously at templates[offsets[r]:offsets[r + 1]]
+GalleryArrays = namedtuple('GalleryArrays', ['employee_ids', 'centroids', 'radii', 'offsets', 'templates'])
+
+
+def summarize_templates(templates):
+    """
+    Return (centroid, spread) for an employee's templates, where spread is
+    the largest distance from a template to the centroid
+    """
+    templates = np.asarray(templates, dtype=np.float32).reshape(-1, ENCODING_DIM)
+    centroid = templates.mean(axis=0)
+    spread = float(np.linalg.norm(templates - centroid, axis=1).max())
+    return centroid, spread
+
+
+def stored_templates(face):
+    """
+    Template matrix of a faces document; documents written before templates
+    existed hold a single face_encoding
+    """
+    if face.get('templates'):
+        return decode_face_encodings([template['encoding'] for template in face['templates']], ENCODING_DIM)
+    if face.get('face_encoding') is not None:
+        return decode_face_encodings([face['face_encoding']], ENCODING_DIM)
+    return None
+
+
+def build_arrays(faces, summaries=None):
+    """
+    Pack {employee_id: (n, 128) templates} into GalleryArrays. summaries may
+    supply precomputed {employee_id: (centroid, spread)}.
+    """
+    summaries = summaries or {}
+    employee_ids = np.asarray(list(faces), dtype=object)
+    counts = np.asarray([len(templates) for templates in faces.values()], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    templates = np.empty((int(offsets[-1]), ENCODING_DIM), dtype=np.float32)
+    centroids = np.empty((len(faces), ENCODING_DIM), dtype=np.float32)
+    radii = np.empty(len(faces), dtype=np.float32)
+    for row, (employee_id, face_templates) in enumerate(faces.items()):
+        templates[offsets[row]:offsets[row + 1]] = face_templates
+        summary = summaries.get(employee_id)
+        centroids[row], radii[row] = summary if summary else summarize_templates(face_templates)
+    return GalleryArrays(employee_ids, centroids, radii, offsets, templates)
+
+
+@timed('gallery_load')
+def read_gallery(collection, user_collection=None):
+    """
+    Read every stored face into GalleryArrays.
+
+    When user_collection is given, embeddings the Node backend keeps on
+    user documents (faceEmbeddings keyed by employeeId) are included for
+    employees that have no entry in the faces collection.
+    """
+    faces = {}
+    summaries = {}
+    projection = {'_id': 0, 'employee_id': 1, 'templates.encoding': 1, 'face_encoding': 1, 'centroid': 1, 'spread': 1}
+    for face in collection.find({}, projection):
+        templates = stored_templates(face)
+        if templates is None or len(templates) == 0:
+            continue
+        faces[face['employee_id']] = templates
+        if face.get('centroid') is not None and face.get('spread') is not None:
+            summaries[face['employee_id']] = (decode_face_encoding(face['centroid']), face['spread'])
+    if user_collection is not None:
+        query = {'employeeId': {'$exists': True}, 'faceEmbeddings.0': {'$exists': True}}
+        for user in user_collection.find(query, {'_id': 0, 'employeeId': 1, 'faceEmbeddings': 1}):
+            if user['employeeId'] not in faces:
+                faces[user['employeeId']] = decode_face_encodings([user['faceEmbeddings']], ENCODING_DIM)
+
+    return build_arrays(faces, summaries)
+
+
+class GalleryIndex:
+    """
+    In-memory face gallery. Each employee has one or more enrollment
+    templates plus their centroid and spread, all kept in contiguous
+    float32 arrays.
+
+    Matching is two-stage: the pluggable matcher (see matchers.py) finds the
+    employees whose centroids are nearest the query, then those employees'
+    individual templates are re-ranked exactly.
+
+    Writers build new arrays and swap them in under a lock, so a matcher
+    that grabbed the previous arrays can finish without locking.
+    """
+
+    def __init__(self, matcher=GALLERY_MATCHER, top_k=TEMPLATE_TOP_K):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._matcher_name = matcher
+        self.top_k = top_k
+        # Version of the snapshot the gallery was mapped from, if any
+        self.etag = None
+        # Incremented on every change, so results derived from the gallery
+        # can tell they are stale
+        self.version = 0
+        # (GalleryArrays, matcher over the centroids), replaced as a unit
+        arrays = build_arrays({})
+        self._state = (arrays, create_matcher(arrays.centroids, arrays.employee_ids, matcher))
+
+    def __len__(self):
+        return len(self._state[0].employee_ids)
+
+    def load(self, collection, user_collection=None):
+        """
+        Replace the gallery with every stored face (see read_gallery)
+        """
+        arrays = read_gallery(collection, user_collection)
+        with self._lock:
+            self._swap_locked(arrays, None)
+            self.etag = None
+        logger.info(f"Gallery index loaded with {len(self)} employees, {len(arrays.templates)} templates")
+
+    def load_snapshot(self, snapshot):
+        """
+        Replace the gallery with a memory-mapped snapshot file
+        """
+        arrays, etag = snapshot.open()
+        with self._lock:
+            self._swap_locked(GalleryArrays(*arrays), None)
+            self.etag = etag
+        logger.info(f"Gallery index mapped snapshot {etag} with {len(self)} employees")
+
+    def refresh(self, snapshot):
+        """
+        Swap to the snapshot on disk if another process published a newer
+        one. Cheap enough to call on every request.
+        """
+        if snapshot.newer_than(self.etag):
+            self.load_snapshot(snapshot)
+            return True
+        return False
+
+    def upsert(self, employee_id, templates):
+        """
+        Insert an employee or replace all of their templates. Accepts one
+        encoding or an (n, 128) array of templates.
+        """
+        self.upsert_many({employee_id: templates})
+
+    def upsert_many(self, updates):
+        """
+        upsert for several employees ({employee_id: templates}) with a
+        single copy of the gallery arrays
+        """
+        updates = {
+            employee_id: np.asarray(templates, dtype=np.float32).reshape(-1, ENCODING_DIM)
+            for employee_id, templates in updates.items()
+        }
+        summaries = {employee_id: summarize_templates(templates) for employee_id, templates in updates.items()}
+        with self._lock:
+            arrays, matcher = self._state
+            counts = np.diff(arrays.offsets)
+            centroids = np.array(arrays.centroids)
+            radii = np.array(arrays.radii)
+            replaced = {}
+            added = []
+            for employee_id, templates in updates.items():
+                row = self._rows.get(employee_id)
+                if row is None:
+                    added.append(employee_id)
+                    continue
+                centroids[row], radii[row] = summaries[employee_id]
+                counts[row] = len(templates)
+                replaced[row] = templates
+
+            pieces = []
+            start = 0
+            for row in sorted(replaced):
+                pieces.append(arrays.templates[start:arrays.offsets[row]])
+                pieces.append(replaced[row])
+                start = arrays.offsets[row + 1]
+            pieces.append(arrays.templates[start:])
+            pieces.extend(updates[employee_id] for employee_id in added)
+
+            rows = list(replaced) + list(range(len(arrays.employee_ids), len(arrays.employee_ids) + len(added)))
+            if added:
+                extra = np.empty(len(added), dtype=object)
+                extra[:] = added
+                employee_ids = np.append(arrays.employee_ids, extra)
+                centroids = np.vstack([centroids] + [summaries[employee_id][0][None, :] for employee_id in added])
+                radii = np.append(radii, [summaries[employee_id][1] for employee_id in added])
+                counts = np.append(counts, [len(updates[employee_id]) for employee_id in added])
+            else:
+                employee_ids = arrays.employee_ids
+            new = GalleryArrays(
+                employee_ids,
+                np.ascontiguousarray(centroids, dtype=np.float32),
+                radii.astype(np.float32),
+                np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                np.vstack(pieces).astype(np.float32, copy=False),
+            )
+            self._swap_locked(new, matcher.updated(new.centroids, new.employee_ids, rows))
+
+    def remove(self, employee_id):
+        """
+        Drop an employee from the gallery. Returns False if it was not indexed.
+        """
+        with self._lock:
+            row = self._rows.get(employee_id)
+            if row is None:
+                return False
+            arrays, matcher = self._state
+            keep = np.ones(len(arrays.employee_ids), dtype=bool)
+            keep[row] = False
+            start, end = arrays.offsets[row], arrays.offsets[row + 1]
+            counts = np.diff(arrays.offsets)[keep]
+            new = GalleryArrays(
+                arrays.employee_ids[keep],
+                np.ascontiguousarray(arrays.centroids[keep]),
+                np.array(arrays.radii[keep]),
+                np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                np.vstack([arrays.templates[:start], arrays.templates[end:]]),
+            )
+            self._swap_locked(new, matcher.filtered(new.centroids, new.employee_ids, keep))
+        return True
+
+    def match(self, encoding, tolerance=DEFAULT_TOLERANCE):
+        """
+        Find the nearest stored template to a single encoding.
+
+        Returns (employee_id, distance); employee_id is None when the gallery
+        is empty or the nearest template is farther than the tolerance.
+        """
+        return self.match_many([encoding], tolerance)[0]
+
+    @timed('match')
+    def match_many(self, encodings, tolerance=DEFAULT_TOLERANCE):
+        """
+        Resolve a batch of encodings: one vectorized pass over the centroids
+        picks each query's top-k employees, whose templates are then
+        re-ranked exactly
+        """
+        queries = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_DIM)
+        arrays, matcher = self._state
+        if len(arrays.employee_ids) == 0:
+            return [(None, None) for _ in range(len(queries))]
+
+        candidate_rows, _ = matcher.search(queries, k=min(self.top_k, len(arrays.employee_ids)))
+        results = []
+        for query, rows in zip(queries, candidate_rows):
+            rows = rows[rows >= 0]
+            if len(rows) == 0:
+                results.append((None, None))
+                continue
+            template_rows = np.concatenate([
+                np.arange(arrays.offsets[row], arrays.offsets[row + 1]) for row in rows
+            ])
+            distances = np.linalg.norm(arrays.templates[template_rows] - query, axis=1)
+            best = int(distances.argmin())
+            distance = float(distances[best])
+            # Map the winning template back to its employee row
+            owner = int(np.searchsorted(arrays.offsets, template_rows[best], side='right') - 1)
+            results.append((arrays.employee_ids[owner] if distance <= tolerance else None, distance))
+        return results
+
+    def stats(self):
+        arrays, matcher = self._state
+        return {**matcher.stats(), 'employees': len(arrays.employee_ids), 'templates': len(arrays.templates)}
+
+    def recall_at_1(self, sample_size=200, noise=0.05, seed=0):
+        """
+        Estimate recall@1 of the configured matcher's centroid search against
+        exact search, using perturbed copies of random centroids as queries
+        """
+        arrays, matcher = self._state
+        centroids = arrays.centroids
+        if not hasattr(matcher, 'recall_at_1') or len(centroids) == 0:
+            return 1.0
+        rng = np.random.default_rng(seed)
+        sample = centroids[rng.choice(len(centroids), min(sample_size, len(centroids)), replace=False)]
+        queries = (sample + rng.normal(0, noise, sample.shape)).astype(np.float32)
+        return matcher.recall_at_1(queries)
+
+    def arrays(self):
+        """
+        The current GalleryArrays (treat as read-only)
+        """
+        return self._state[0]
+
+    def _swap_locked(self, arrays, matcher):
+        if matcher is None:
+            matcher = create_matcher(arrays.centroids, arrays.employee_ids, self._matcher_name)
+        self._rows = {employee_id: row for row, employee_id in enumerate(arrays.employee_ids)}
+        self._state = (arrays, matcher)
+        self.version += 1
@@ -0,0 +1,231 @@
+import os
+import sys
+import json
+import time
+import struct
+import hashlib
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Snapshot file shared by every worker on the host; empty disables snapshots
+GALLERY_SNAPSHOT_PATH = os.environ.get('GALLERY_SNAPSHOT_PATH', '')
+# How often a worker stats the snapshot file for a newer version (seconds)
+SNAPSHOT_CHECK_INTERVAL = float(os.environ.get('GALLERY_SNAPSHOT_CHECK_INTERVAL', '1.0'))
+# Writes arriving within this window are folded into one rebuild (seconds)
+SNAPSHOT_REBUILD_DELAY = float(os.environ.get('GALLERY_SNAPSHOT_REBUILD_DELAY', '2.0'))
+
+# Layout: fixed header, zero padding up to DATA_OFFSET, then in C order the
+# float32 (E, dim) centroids, float32 (T, dim) templates, int64 (E + 1)
+# template offsets and float32 (E) spreads, then the employee ids as a
+# UTF-8 JSON list.
+MAGIC = b'FACEGAL1'
+FORMAT_VERSION = 2
+# magic, version, dim, employees, templates, ids offset, ids length, etag
+_HEADER = struct.Struct('<8sIIQQQQ32s')
+DATA_OFFSET = 128
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _sections(dim, employees, templates):
+    """
+    (name, dtype, shape, offset) of each array section, in file order
+    """
+    sections = []
+    offset = DATA_OFFSET
+    for name, dtype, shape in (
+        ('centroids', np.float32, (employees, dim)),
+        ('templates', np.float32, (templates, dim)),
+        ('offsets', np.int64, (employees + 1,)),
+        ('radii', np.float32, (employees,)),
+    ):
+        sections.append((name, dtype, shape, offset))
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return sections, offset
+
+
+def write_snapshot(path, arrays):
+    """
+    Atomically write a gallery snapshot of GalleryArrays and return its
+    etag. The file is written next to the target and renamed over it, so
+    readers see either the old or the new snapshot, never a partial one;
+    workers that still map the old file keep reading it until they swap.
+    """
+    employee_ids, centroids, radii, offsets, templates = arrays
+    dim = centroids.shape[1]
+    data = {
+        'centroids': np.ascontiguousarray(centroids, dtype=np.float32),
+        'templates': np.ascontiguousarray(templates, dtype=np.float32),
+        'offsets': np.ascontiguousarray(offsets, dtype=np.int64),
+        'radii': np.ascontiguousarray(radii, dtype=np.float32),
+    }
+    ids_blob = json.dumps([str(employee_id) for employee_id in employee_ids]).encode('utf-8')
+    sections, ids_offset = _sections(dim, len(employee_ids), len(templates))
+    digest = hashlib.sha256(ids_blob)
+    for name, _, _, _ in sections:
+        digest.update(data[name].tobytes())
+    etag = digest.hexdigest()[:32]
+
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, dim, len(employee_ids), len(templates),
+                          ids_offset, len(ids_blob), etag.encode('ascii'))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(header.ljust(DATA_OFFSET, b'\0'))
+        for name, _, _, _ in sections:
+            f.write(data[name].tobytes())
+        f.write(ids_blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return etag
+
+
+def read_header(path):
+    """
+    Return (dim, employees, templates, ids_offset, ids_length, etag) from a
+    snapshot file
+    """
+    with open(path, 'rb') as f:
+        raw = f.read(_HEADER.size)
+    if len(raw) < _HEADER.size:
+        raise SnapshotError(f"Truncated gallery snapshot {path}")
+    magic, version, dim, employees, templates, ids_offset, ids_length, etag = _HEADER.unpack(raw)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise SnapshotError(f"Unsupported gallery snapshot {path}")
+    return dim, employees, templates, ids_offset, ids_length, etag.decode('ascii')
+
+
+def open_snapshot(path):
+    """
+    Map a snapshot read-only. Returns ((employee_ids, centroids, radii,
+    offsets, templates), etag); the arrays are np.memmap views, so every
+    process that opens the same file shares its physical pages through the
+    page cache.
+    """
+    dim, employees, templates, ids_offset, ids_length, etag = read_header(path)
+    sections, expected_ids_offset = _sections(dim, employees, templates)
+    if ids_offset != expected_ids_offset:
+        raise SnapshotError(f"Corrupt gallery snapshot {path}")
+    data = {}
+    for name, dtype, shape, offset in sections:
+        if np.prod(shape):
+            data[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            data[name] = np.empty(shape, dtype=dtype)
+    with open(path, 'rb') as f:
+        f.seek(ids_offset)
+        employee_ids = np.asarray(json.loads(f.read(ids_length).decode('utf-8')), dtype=object)
+    if len(employee_ids) != employees:
+        raise SnapshotError(f"Corrupt gallery snapshot {path}")
+    return (employee_ids, data['centroids'], data['radii'], data['offsets'], data['templates']), etag
+
+
+class GallerySnapshot:
+    """
+    A snapshot path plus cheap, throttled detection of newer versions
+    """
+
+    def __init__(self, path, check_interval=SNAPSHOT_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._next_check = 0.0
+        self._signature = None
+
+    def publish(self, arrays):
+        etag = write_snapshot(self.path, arrays)
+        logger.info(f"Gallery snapshot {etag} written with {len(arrays[0])} employees")
+        return etag
+
+    def open(self):
+        self._signature = self._stat()
+        return open_snapshot(self.path)
+
+    def newer_than(self, etag):
+        """
+        True when the file on disk holds a different version than etag.
+        Only stats the file once per check_interval.
+        """
+        now = time.monotonic()
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.check_interval
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            return read_header(self.path)[5] != etag
+        except (OSError, SnapshotError):
+            return False
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+class SnapshotRebuilder:
+    """
+    Rebuilds the snapshot from the source of truth on a background thread
+    after writes. Several workers may write concurrently, so each rebuild
+    reads the full gallery rather than publishing its own in-memory copy.
+    """
+
+    def __init__(self, snapshot, build, delay=SNAPSHOT_REBUILD_DELAY):
+        self.snapshot = snapshot
+        self.build = build
+        self.delay = delay
+        self._requested = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def request(self):
+        # Started lazily so it is created in the process that uses it, not
+        # inherited half-dead across a fork
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='gallery-snapshot', daemon=True)
+                self._thread.start()
+        self._requested.set()
+
+    def _run(self):
+        while True:
+            self._requested.wait()
+            time.sleep(self.delay)
+            self._requested.clear()
+            try:
+                self.snapshot.publish(self.build())
+            except Exception as e:
+                logger.error(f"Error rebuilding gallery snapshot: {str(e)}")
+
+
+def main():
+    """
+    python gallery_snapshot.py rebuild [path]   rebuild from MongoDB
+    python gallery_snapshot.py info [path]      print the header
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in ('rebuild', 'info'):
+        print(main.__doc__)
+        return
+    path = sys.argv[2] if len(sys.argv) > 2 else GALLERY_SNAPSHOT_PATH
+    if not path:
+        raise SystemExit('No snapshot path given and GALLERY_SNAPSHOT_PATH is not set')
+    if sys.argv[1] == 'rebuild':
+        from db_config import face_collection, employee_collection
+        from gallery_index import read_gallery
+        arrays = read_gallery(face_collection, employee_collection)
+        print(json.dumps({'etag': write_snapshot(path, arrays), 'employees': len(arrays.employee_ids)}))
+    else:
+        dim, employees, templates, _, _, etag = read_header(path)
+        print(json.dumps({'etag': etag, 'employees': employees, 'templates': templates, 'dim': dim}))
+
+
+if __name__ == '__main__':
+    main()
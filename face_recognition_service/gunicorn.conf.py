@@ -0,0 +1,67 @@
+"""
+Production serving configuration:
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app, dlib models and gallery are loaded once in the master before
+workers fork, so their memory is shared copy-on-write. Send SIGHUP to roll
+out a new gallery: the master reloads it, then replaces workers one
+generation at a time while the old ones finish their in-flight scans.
+"""
+import os
+import tempfile
+import multiprocessing
+
+# Threads each worker may use inside BLAS / OpenMP / OpenCV. These must be
+# set before numpy is first imported, which happens when the app preloads.
+BLAS_THREADS = os.environ.get('FACE_BLAS_THREADS', '1')
+for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS'):
+    os.environ.setdefault(variable, BLAS_THREADS)
+
+bind = os.environ.get('FACE_SERVICE_BIND', '0.0.0.0:8000')
+# Default to one worker per core's worth of BLAS threads so encodes never
+# oversubscribe the CPU
+workers = int(os.environ.get('FACE_SERVICE_WORKERS', max(1, multiprocessing.cpu_count() // int(BLAS_THREADS))))
+# Threads per worker: extra threads overlap I/O (MongoDB, request bodies)
+# with another request's encode and hold requests queued for admission
+threads = int(os.environ.get('FACE_SERVICE_THREADS', '8'))
+# Workers keep their galleries in sync through a shared snapshot file (see
+# gallery_snapshot.py). Without one, a face added or deleted on one worker
+# would stay unknown or keep matching on the others, so it is always on
+# when there is more than one worker.
+if workers > 1 and not os.environ.get('GALLERY_SNAPSHOT_PATH'):
+    os.environ['GALLERY_SNAPSHOT_PATH'] = os.path.join(tempfile.gettempdir(), f"face_gallery_{bind.rsplit(':', 1)[-1]}.snapshot")
+# Concurrent decode/detect/encode per worker (see admission.py): the cores
+# each worker owns, so all workers together keep every core busy but no more
+os.environ.setdefault('ADMISSION_SLOTS', str(max(1, multiprocessing.cpu_count() // workers)))
+worker_class = 'gthread'
+preload_app = True
+timeout = int(os.environ.get('FACE_SERVICE_TIMEOUT', '60'))
+# In-flight scans get this long to finish on reload or shutdown
+graceful_timeout = int(os.environ.get('FACE_SERVICE_GRACEFUL_TIMEOUT', '30'))
+# Recycle workers now and then so heap fragmentation cannot accumulate
+max_requests = int(os.environ.get('FACE_SERVICE_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+
+def when_ready(server):
+    # Runs in the master after the app is preloaded, before the first fork:
+    # touch dlib's models once so workers inherit them warm
+    from face_scan import warm_up
+    warm_up()
+
+
+def on_reload(server):
+    # SIGHUP: refresh the gallery in the master, so the next generation of
+    # workers forks with it already in shared memory
+    from app import reload_gallery
+    reload_gallery()
+
+
+def post_fork(server, worker):
+    import cv2
+    cv2.setNumThreads(int(BLAS_THREADS))
+    # The master's MongoDB client was created before the fork and must not
+    # be used here; give each worker its own
+    import db_config
+    db_config.connect()
@@ -0,0 +1,105 @@
+import os
+import time
+import logging
+import threading
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# Haar detection runs on a pyrDown'ed copy whose longest side is at most this
+MAX_DETECT_SIDE = int(os.environ.get('LIVENESS_MAX_SIDE', '480'))
+MIN_FACE_SIZE = 100
+
+_local = threading.local()
+
+
+def cascade_dir():
+    """
+    Directory holding OpenCV's bundled Haar cascade XML files
+    """
+    data = getattr(cv2, 'data', None)
+    if data is not None and getattr(data, 'haarcascades', None):
+        return data.haarcascades
+    return os.path.join(os.path.dirname(cv2.__file__), 'data')
+
+
+def get_classifiers():
+    """
+    Return this thread's (face, eye) cascades, parsing the XML only once.
+    CascadeClassifier is not safe to share between threads, so each thread
+    keeps its own pair.
+    """
+    classifiers = getattr(_local, 'classifiers', None)
+    if classifiers is None:
+        path = cascade_dir()
+        face_cascade = cv2.CascadeClassifier(os.path.join(path, 'haarcascade_frontalface_default.xml'))
+        eye_cascade = cv2.CascadeClassifier(os.path.join(path, 'haarcascade_eye.xml'))
+        if face_cascade.empty() or eye_cascade.empty():
+            raise RuntimeError(f"Could not load Haar cascades from {path}")
+        classifiers = _local.classifiers = (face_cascade, eye_cascade)
+    return classifiers
+
+
+def check_liveness(image, color_conversion=cv2.COLOR_BGR2GRAY):
+    """
+    Enhanced liveness detection using multiple checks.
+
+    Returns (is_live, face_location, timings). face_location is the single
+    face in face_recognition's (top, right, bottom, left) order, in the
+    coordinates of the original image, so callers can pass it straight to
+    face_recognition.face_encodings as known_face_locations. timings maps
+    each stage to its duration in milliseconds.
+    """
+    timings = {}
+    try:
+        face_cascade, eye_cascade = get_classifiers()
+        height, width = image.shape[:2]
+
+        # Downscale first so the grayscale conversion and the cascade scan
+        # both run on the small image
+        start = time.perf_counter()
+        small = image
+        scale = 1
+        while max(small.shape[:2]) > MAX_DETECT_SIDE:
+            small = cv2.pyrDown(small)
+            scale *= 2
+        small_gray = cv2.cvtColor(small, color_conversion)
+        timings['liveness_downscale'] = (time.perf_counter() - start) * 1000
+
+        # Detect faces and map them back to original coordinates
+        start = time.perf_counter()
+        faces = [
+            (x * scale, y * scale, w * scale, h * scale)
+            for (x, y, w, h) in face_cascade.detectMultiScale(small_gray, 1.3, 5)
+        ]
+        timings['liveness_faces'] = (time.perf_counter() - start) * 1000
+
+        if len(faces) == 0:
+            return False, None, timings
+
+        # Check for multiple faces (anti-spoofing)
+        if len(faces) > 1:
+            return False, None, timings
+
+        x, y, w, h = faces[0]
+
+        # Check face size (anti-spoofing)
+        if w < MIN_FACE_SIZE or h < MIN_FACE_SIZE:  # Face too small
+            return False, None, timings
+
+        # Check face position (should be centered)
+        if x < width * 0.1 or x + w > width * 0.9 or y < height * 0.1 or y + h > height * 0.9:
+            return False, None, timings
+
+        # Check for eye presence on the full-resolution face crop only
+        start = time.perf_counter()
+        roi_gray = cv2.cvtColor(image[y:y+h, x:x+w], color_conversion)
+        eyes = eye_cascade.detectMultiScale(roi_gray)
+        timings['liveness_eyes'] = (time.perf_counter() - start) * 1000
+        if len(eyes) < 1:
+            return False, None, timings
+
+        return True, (int(y), int(x + w), int(y + h), int(x)), timings
+    except Exception as e:
+        logger.error(f"Error in liveness detection: {str(e)}")
+        return False, None, timings
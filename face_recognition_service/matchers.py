@@ -0,0 +1,283 @@
+import os
+import hashlib
+import logging
+import threading
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+GALLERY_MATCHER = os.environ.get('GALLERY_MATCHER', 'brute_force')
+# File the IVF partitioning is persisted to; empty disables persistence
+IVF_INDEX_PATH = os.environ.get('IVF_INDEX_PATH', '')
+IVF_NPROBE = int(os.environ.get('IVF_NPROBE', '8'))
+# Below this many faces the IVF matcher keeps a single list (exact search)
+IVF_MIN_TRAIN = int(os.environ.get('IVF_MIN_TRAIN', '1024'))
+KMEANS_ITERATIONS = 15
+KMEANS_SAMPLES_PER_LIST = 64
+ASSIGN_CHUNK = 8192
+
+# One save at a time per process; processes write their own temporary file
+_save_lock = threading.Lock()
+
+
+def squared_distances(queries, matrix, matrix_sq_norms=None):
+    """
+    Pairwise squared L2 distances between two float32 matrices
+    """
+    if matrix_sq_norms is None:
+        matrix_sq_norms = (matrix * matrix).sum(axis=1)
+    sq_dist = (queries * queries).sum(axis=1)[:, None] + matrix_sq_norms[None, :] - 2.0 * (queries @ matrix.T)
+    return np.maximum(sq_dist, 0.0)
+
+
+def _empty_results(count, k):
+    return np.full((count, k), -1), np.full((count, k), np.inf, dtype=np.float32)
+
+
+def _top_k(sq_dist, k):
+    """
+    Column indices of the k smallest entries of each row, sorted ascending
+    """
+    if k == 1:
+        return sq_dist.argmin(axis=1)[:, None]
+    k = min(k, sq_dist.shape[1])
+    part = np.argpartition(sq_dist, k - 1, axis=1)[:, :k]
+    order = np.argsort(np.take_along_axis(sq_dist, part, axis=1), axis=1)
+    return np.take_along_axis(part, order, axis=1)
+
+
+def ids_digest(employee_ids):
+    return hashlib.sha1('\n'.join(str(i) for i in employee_ids).encode('utf-8')).hexdigest()
+
+
+class BruteForceMatcher:
+    """
+    Exact nearest-neighbour search over every gallery row.
+
+    Matchers are immutable: each gallery change produces a new matcher via
+    updated() or filtered(), so searches in flight keep a consistent view.
+    """
+    name = 'brute_force'
+
+    def __init__(self, matrix, employee_ids=None):
+        self.matrix = matrix
+        self.sq_norms = (matrix * matrix).sum(axis=1)
+
+    def updated(self, matrix, employee_ids, rows):
+        """
+        Matcher for a gallery where the given rows were replaced or appended
+        """
+        return BruteForceMatcher(matrix)
+
+    def filtered(self, matrix, employee_ids, keep):
+        """
+        Matcher for a gallery where only rows with keep[row] survived
+        """
+        return BruteForceMatcher(matrix)
+
+    def search(self, queries, k=1):
+        """
+        Return (rows, distances), each of shape (len(queries), k), holding
+        the k nearest gallery rows for each query, nearest first. Missing
+        neighbours are padded with row -1 and distance inf.
+        """
+        rows, distances = _empty_results(len(queries), k)
+        if len(self.matrix) == 0:
+            return rows, distances
+        sq_dist = squared_distances(queries, self.matrix, self.sq_norms)
+        found = _top_k(sq_dist, k)
+        rows[:, :found.shape[1]] = found
+        distances[:, :found.shape[1]] = np.sqrt(np.take_along_axis(sq_dist, found, axis=1))
+        return rows, distances
+
+    def stats(self):
+        return {'matcher': self.name, 'size': len(self.matrix)}
+
+
+def _assign(matrix, centroids):
+    """
+    Index of the nearest centroid for every row, computed in chunks
+    """
+    centroid_sq_norms = (centroids * centroids).sum(axis=1)
+    assignments = np.empty(len(matrix), dtype=np.int32)
+    for start in range(0, len(matrix), ASSIGN_CHUNK):
+        chunk = matrix[start:start + ASSIGN_CHUNK]
+        assignments[start:start + len(chunk)] = squared_distances(chunk, centroids, centroid_sq_norms).argmin(axis=1)
+    return assignments
+
+
+def train_kmeans(matrix, nlist, iterations=KMEANS_ITERATIONS, seed=0):
+    """
+    Plain Lloyd's k-means on a sample of the gallery
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), nlist * KMEANS_SAMPLES_PER_LIST)
+    sample = matrix[rng.choice(len(matrix), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = _assign(sample, centroids)
+        counts = np.bincount(assignments, minlength=nlist)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+        # Re-seed empty lists from random sample points
+        if not filled.all():
+            centroids[~filled] = sample[rng.choice(sample_size, int((~filled).sum()), replace=False)]
+    return centroids.astype(np.float32)
+
+
+class IVFMatcher:
+    """
+    Approximate search with an inverted-file index: rows are partitioned by
+    their nearest k-means centroid and a query only scans the nprobe lists
+    whose centroids are closest to it.
+
+    New rows are assigned to the existing centroids; the centroids are
+    retrained once the gallery has doubled since the last training. Only a
+    training is persisted, on a background thread, so gallery updates never
+    wait on the disk.
+    """
+    name = 'ivf'
+
+    def __init__(self, matrix, employee_ids, centroids=None, assignments=None,
+                 trained_size=None, nprobe=IVF_NPROBE, index_path=IVF_INDEX_PATH):
+        self.matrix = matrix
+        self.sq_norms = (matrix * matrix).sum(axis=1)
+        self.nprobe = nprobe
+        self.index_path = index_path
+        trained = False
+        if centroids is None or self._needs_training(len(matrix), trained_size):
+            nlist = self._nlist(len(matrix))
+            if nlist > 1:
+                centroids = train_kmeans(matrix, nlist)
+            elif len(matrix):
+                centroids = matrix.mean(axis=0, keepdims=True)
+            else:
+                centroids = np.zeros((1, matrix.shape[1]), dtype=np.float32)
+            trained_size = len(matrix)
+            assignments = None
+            trained = True
+            logger.info(f"IVF matcher trained {len(centroids)} lists over {len(matrix)} faces")
+        if assignments is None or len(assignments) != len(matrix):
+            assignments = _assign(matrix, centroids) if len(matrix) else np.empty(0, dtype=np.int32)
+        self.centroids = centroids
+        self.centroid_sq_norms = (centroids * centroids).sum(axis=1)
+        self.trained_size = trained_size
+        self.assignments = assignments
+        self._build_lists()
+        if trained and self.index_path:
+            threading.Thread(target=self.save, args=(employee_ids,), name='ivf-save', daemon=True).start()
+
+    @staticmethod
+    def _nlist(size):
+        if size < IVF_MIN_TRAIN:
+            return 1
+        return int(np.sqrt(size))
+
+    @classmethod
+    def _needs_training(cls, size, trained_size):
+        if trained_size is None:
+            return True
+        return size >= IVF_MIN_TRAIN and size >= 2 * max(trained_size, 1)
+
+    def _build_lists(self):
+        self.order = np.argsort(self.assignments, kind='stable')
+        self.bounds = np.searchsorted(self.assignments[self.order], np.arange(len(self.centroids) + 1))
+
+    def updated(self, matrix, employee_ids, rows):
+        if self._needs_training(len(matrix), self.trained_size):
+            return IVFMatcher(matrix, employee_ids, nprobe=self.nprobe, index_path=self.index_path)
+        assignments = np.empty(len(matrix), dtype=np.int32)
+        assignments[:len(self.assignments)] = self.assignments
+        rows = np.asarray(rows, dtype=np.int64)
+        assignments[rows] = _assign(matrix[rows], self.centroids)
+        return IVFMatcher(matrix, employee_ids, self.centroids, assignments,
+                          self.trained_size, self.nprobe, self.index_path)
+
+    def filtered(self, matrix, employee_ids, keep):
+        return IVFMatcher(matrix, employee_ids, self.centroids, self.assignments[keep],
+                          self.trained_size, self.nprobe, self.index_path)
+
+    def search(self, queries, k=1):
+        rows, distances = _empty_results(len(queries), k)
+        if len(self.matrix) == 0:
+            return rows, distances
+        nprobe = min(self.nprobe, len(self.centroids))
+        probe = np.argsort(squared_distances(queries, self.centroids, self.centroid_sq_norms), axis=1)[:, :nprobe]
+        for i, lists in enumerate(probe):
+            candidates = np.concatenate([self.order[self.bounds[c]:self.bounds[c + 1]] for c in lists])
+            if len(candidates) == 0:
+                continue
+            sq_dist = squared_distances(queries[i:i + 1], self.matrix[candidates], self.sq_norms[candidates])
+            best = _top_k(sq_dist, k)[0]
+            rows[i, :len(best)] = candidates[best]
+            distances[i, :len(best)] = np.sqrt(sq_dist[0, best])
+        return rows, distances
+
+    def recall_at_1(self, queries):
+        """
+        Fraction of queries whose approximate nearest row is the exact one
+        """
+        if len(queries) == 0 or len(self.matrix) == 0:
+            return 1.0
+        approx_rows, _ = self.search(queries)
+        exact_rows, _ = BruteForceMatcher(self.matrix).search(queries)
+        return float((approx_rows[:, 0] == exact_rows[:, 0]).mean())
+
+    def stats(self):
+        sizes = np.diff(self.bounds)
+        return {
+            'matcher': self.name,
+            'size': len(self.matrix),
+            'lists': len(self.centroids),
+            'nprobe': self.nprobe,
+            'largest_list': int(sizes.max()) if len(sizes) else 0,
+        }
+
+    def save(self, employee_ids):
+        """
+        Persist centroids and assignments so a restart skips k-means
+        """
+        if not self.index_path:
+            return
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with _save_lock:
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, centroids=self.centroids, assignments=self.assignments,
+                             trained_size=np.int64(self.trained_size), digest=np.array(ids_digest(employee_ids)))
+                os.replace(tmp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Error saving IVF index: {str(e)}")
+
+    @classmethod
+    def load(cls, matrix, employee_ids, index_path=IVF_INDEX_PATH, nprobe=IVF_NPROBE):
+        """
+        Build from a persisted index when one exists. Saved assignments are
+        reused only if the gallery rows are unchanged; otherwise rows are
+        reassigned to the saved centroids.
+        """
+        if index_path and os.path.exists(index_path):
+            try:
+                with np.load(index_path) as saved:
+                    centroids = saved['centroids']
+                    assignments = saved['assignments']
+                    trained_size = int(saved['trained_size'])
+                    if str(saved['digest']) != ids_digest(employee_ids):
+                        assignments = None
+                return cls(matrix, employee_ids, centroids, assignments, trained_size, nprobe, index_path)
+            except (OSError, KeyError, ValueError) as e:
+                logger.error(f"Error loading IVF index, retraining: {str(e)}")
+        return cls(matrix, employee_ids, nprobe=nprobe, index_path=index_path)
+
+
+def create_matcher(matrix, employee_ids, name=GALLERY_MATCHER):
+    """
+    Build the configured matcher ('brute_force' or 'ivf') for a gallery
+    """
+    if name == 'ivf':
+        return IVFMatcher.load(matrix, employee_ids)
+    if name != 'brute_force':
+        logger.warning(f"Unknown GALLERY_MATCHER {name!r}, using brute_force")
+    return BruteForceMatcher(matrix, employee_ids)
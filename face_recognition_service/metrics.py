@@ -0,0 +1,428 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+from functools import wraps
+from processes import pid_alive
+
+logger = logging.getLogger(__name__)
+
+# Directory where each worker process publishes its metrics so /metrics on
+# any worker reports the whole server; empty reports only this process
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))
+# Add a Server-Timing header with the request's stage durations
+SERVER_TIMING = os.environ.get('SERVER_TIMING', '0') == '1'
+# Requests slower than this (ms) have their sampled stacks logged; 0 disables
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', '0'))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', '5'))
+PROFILE_TOP_STACKS = int(os.environ.get('PROFILE_TOP_STACKS', '15'))
+
+# Seconds; spans a cached match (sub-ms) up to a slow full-resolution encode
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_text(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    """
+    Monotonic count per label set. With fn, the value is read from fn()
+    (for counters kept elsewhere, such as cache hits).
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=(), fn=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        if self.fn is not None:
+            return {(): float(self.fn())}
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, target, values):
+        for key, value in values.items():
+            target[key] = target.get(key, 0) + value
+
+    def render(self, values):
+        return [f"{self.name}{_labels_text(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """
+    Current value per label set, set directly or read from fn(). Values
+    from several processes are summed, or with aggregate='max' (for
+    per-host values every process sees, like the gallery size) the largest
+    is reported.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help_text, labelnames=(), fn=None, aggregate='sum'):
+        super().__init__(name, help_text, labelnames, fn)
+        self.aggregate = aggregate
+
+    def merge(self, target, values):
+        if self.aggregate != 'max':
+            return super().merge(target, values)
+        for key, value in values.items():
+            target[key] = max(target.get(key, value), value)
+
+    def set(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram of durations in seconds per label set
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts (last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def collect(self):
+        with self._lock:
+            return {key: [list(counts), total] for key, (counts, total) in self._values.items()}
+
+    def merge(self, target, values):
+        for key, (counts, total) in values.items():
+            entry = target.setdefault(key, [[0] * len(counts), 0.0])
+            entry[0] = [a + b for a, b in zip(entry[0], counts)]
+            entry[1] += total
+
+    def render(self, values):
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_labels_text(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels_text(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{_labels_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """
+    The process's metrics, rendered in the Prometheus text format. With a
+    shared directory, each process periodically writes its values there
+    and rendering sums the live processes' files.
+    """
+
+    def __init__(self, directory=METRICS_DIR, flush_interval=METRICS_FLUSH_INTERVAL):
+        self.metrics = []
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def collect(self):
+        values = {}
+        for metric in self.metrics:
+            try:
+                values[metric.name] = metric.collect()
+            except Exception as e:
+                logger.error(f"Error collecting metric {metric.name}: {str(e)}")
+        return values
+
+    def render(self):
+        merged = {metric.name: {} for metric in self.metrics}
+        by_name = {metric.name: metric for metric in self.metrics}
+        for snapshot in self._snapshots():
+            for name, values in snapshot.items():
+                if name in by_name:
+                    by_name[name].merge(merged[name], values)
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render(merged[metric.name]))
+        return '\n'.join(lines) + '\n'
+
+    def _snapshots(self):
+        if not self.directory:
+            return [self.collect()]
+        self.start()
+        self.flush()
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(self.directory, name)
+            pid = int(name[:-len('.json')])
+            if pid != os.getpid() and not pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    raw = json.load(f)
+            except (OSError, ValueError):
+                continue
+            snapshots.append({
+                metric: {tuple(json.loads(key)): value for key, value in values.items()}
+                for metric, values in raw.items()
+            })
+        return snapshots
+
+    def flush(self):
+        """
+        Write this process's values to the shared directory
+        """
+        if not self.directory:
+            return
+        data = {
+            metric: {json.dumps(list(key)): value for key, value in values.items()}
+            for metric, values in self.collect().items()
+        }
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(f"{path}.tmp", 'w') as f:
+            json.dump(data, f)
+        os.replace(f"{path}.tmp", path)
+
+    def start(self):
+        # Flush periodically from every process that records metrics; started
+        # lazily so each forked worker runs its own flusher
+        if not self.directory:
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            self._flusher_pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                logger.error(f"Error flushing metrics: {str(e)}")
+
+
+registry = Registry()
+stage_seconds = registry.histogram('face_stage_seconds', 'Duration of face pipeline stages', ['stage'])
+request_seconds = registry.histogram('face_request_seconds', 'Duration of HTTP requests', ['endpoint', 'status'])
+requests_in_flight = registry.gauge('face_requests_in_flight', 'Requests currently being served')
+slow_requests = registry.counter('face_slow_requests_total', 'Requests slower than PROFILE_SLOW_MS', ['endpoint'])
+
+
+def observe_stages(timings):
+    """
+    Record a {stage: milliseconds} dict, as produced by check_liveness and
+    the request handlers, into the stage histogram and the current
+    request's Server-Timing
+    """
+    for name, duration in timings.items():
+        stage_seconds.observe(duration / 1000.0, stage=name)
+    current = _current_timings()
+    if current is not None:
+        for name, duration in timings.items():
+            current[name] = current.get(name, 0.0) + duration
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a block as a pipeline stage
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stages({name: (time.perf_counter() - start) * 1000})
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as a pipeline stage
+    """
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _current_timings():
+    try:
+        from flask import g, has_request_context
+    except ImportError:
+        return None
+    if not has_request_context():
+        return None
+    return g.setdefault('stage_timings', {})
+
+
+class SlowRequestProfiler:
+    """
+    Sampling profiler for slow requests. While enabled, a background thread
+    samples the stack of every thread that is serving a request; stacks of
+    requests slower than the threshold are logged in collapsed
+    ("frame;frame;frame count") form, ready for a flame graph.
+    """
+
+    def __init__(self, threshold_ms=PROFILE_SLOW_MS, interval_ms=PROFILE_INTERVAL_MS, top=PROFILE_TOP_STACKS):
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000.0
+        self.top = top
+        # thread id -> stack samples of the request it is serving
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler_pid = None
+
+    @property
+    def enabled(self):
+        return self.threshold_ms > 0
+
+    def begin(self):
+        if not self.enabled:
+            return
+        self._start()
+        with self._lock:
+            self._active[threading.get_ident()] = StackCounter()
+
+    def end(self, endpoint, duration_ms):
+        if not self.enabled:
+            return
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if samples is None or duration_ms < self.threshold_ms:
+            return
+        slow_requests.inc(endpoint=endpoint)
+        stacks = '\n'.join(f"{stack} {count}" for stack, count in samples.most_common(self.top))
+        logger.warning(f"Slow request {endpoint} took {duration_ms:.0f} ms; hot stacks:\n{stacks}")
+
+    def _start(self):
+        with self._lock:
+            if self._sampler_pid == os.getpid():
+                return
+            self._sampler_pid = os.getpid()
+            self._active = {}
+        threading.Thread(target=self._sample_loop, name='slow-request-profiler', daemon=True).start()
+
+    def _sample_loop(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, samples in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        samples[_collapse(frame)] += 1
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+profiler = SlowRequestProfiler()
+
+
+def install(app):
+    """
+    Add request timing, in-flight tracking, Server-Timing, the slow request
+    profiler and a /metrics endpoint to a Flask app
+    """
+    from flask import g, request, Response
+
+    in_flight = [0]
+    in_flight_lock = threading.Lock()
+    requests_in_flight.fn = lambda: in_flight[0]
+
+    @app.before_request
+    def _begin_request():
+        registry.start()
+        g.request_start = time.perf_counter()
+        with in_flight_lock:
+            in_flight[0] += 1
+        g.counted_in_flight = True
+        profiler.begin()
+
+    @app.after_request
+    def _finish_request(response):
+        start = g.get('request_start')
+        if start is None:
+            return response
+        duration = time.perf_counter() - start
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(duration, endpoint=endpoint, status=response.status_code)
+        profiler.end(endpoint, duration * 1000)
+        if SERVER_TIMING:
+            entries = [f"{name};dur={value:.1f}" for name, value in g.get('stage_timings', {}).items()]
+            entries.append(f"total;dur={duration * 1000:.1f}")
+            response.headers['Server-Timing'] = ', '.join(entries)
+        return response
+
+    @app.teardown_request
+    def _teardown_request(exc):
+        if g.pop('counted_in_flight', False):
+            with in_flight_lock:
+                in_flight[0] -= 1
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
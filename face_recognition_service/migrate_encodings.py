@@ -0,0 +1,71 @@
+"""
+Convert face encodings stored as BSON arrays of doubles into the binary
+form written by db_config.encode_face_encoding.
+
+    python migrate_encodings.py [--batch-size 500] [--dry-run]
+
+Documents are rewritten in bulk batches. Each update is conditional on the
+field still being an array, so faces re-enrolled while the migration runs
+are left alone and the command can be re-run safely.
+"""
+import sys
+import time
+import argparse
+import logging
+from pymongo import UpdateOne
+from db_config import face_collection, encode_face_encoding
+
+logger = logging.getLogger(__name__)
+
+LEGACY_QUERY = {'face_encoding': {'$type': 'array'}}
+
+
+def migrate(collection, batch_size=500, dry_run=False):
+    """
+    Rewrite every legacy encoding in the collection. Returns
+    (documents seen, documents converted).
+    """
+    seen = converted = 0
+    batch = []
+    cursor = collection.find(LEGACY_QUERY, {'_id': 1, 'face_encoding': 1}, batch_size=batch_size)
+    for doc in cursor:
+        seen += 1
+        encoding = doc['face_encoding']
+        if len(encoding) != 128:
+            logger.warning(f"Skipping face {doc['_id']}: encoding has {len(encoding)} values")
+            continue
+        batch.append(UpdateOne(
+            {'_id': doc['_id'], 'face_encoding': {'$type': 'array'}},
+            {'$set': {'face_encoding': encode_face_encoding(encoding)}}
+        ))
+        if len(batch) >= batch_size:
+            converted += _flush(collection, batch, dry_run)
+            batch = []
+    if batch:
+        converted += _flush(collection, batch, dry_run)
+    return seen, converted
+
+
+def _flush(collection, batch, dry_run):
+    if dry_run:
+        return len(batch)
+    result = collection.bulk_write(batch, ordered=False)
+    return result.modified_count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--dry-run', action='store_true', help='Count documents without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    start = time.perf_counter()
+    seen, converted = migrate(face_collection, args.batch_size, args.dry_run)
+    verb = 'would convert' if args.dry_run else 'converted'
+    logger.info(f"Found {seen} legacy encodings, {verb} {converted} in {time.perf_counter() - start:.1f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,125 @@
+import os
+import struct
+import numpy as np
+import cv2
+import face_recognition
+from metrics import timed
+
+# Uploads are decoded at a reduced size down to about this longest side
+# (faces are encoded from crops of this image)
+ENCODE_MAX_SIDE = int(os.environ.get('FACE_ENCODE_MAX_SIDE', '1024'))
+# HOG detection runs on a copy scaled down to this longest side
+DETECT_MAX_SIDE = int(os.environ.get('FACE_DETECT_MAX_SIDE', '480'))
+DETECT_UPSAMPLE = int(os.environ.get('FACE_DETECT_UPSAMPLE', '1'))
+# Margin kept around each face box when cropping for encoding, as a fraction of the box size
+CROP_PADDING = float(os.environ.get('FACE_CROP_PADDING', '0.25'))
+
+_REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# JPEG start-of-frame markers (C4, C8 and CC are not frames)
+_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def image_dimensions(data):
+    """
+    Read (width, height) from a JPEG or PNG header without decoding pixels.
+    Returns None for other formats or truncated headers.
+    """
+    data = memoryview(data)
+    if len(data) >= 24 and bytes(data[:8]) == b'\x89PNG\r\n\x1a\n':
+        return struct.unpack('>II', data[16:24])
+    if len(data) < 4 or bytes(data[:2]) != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in _SOF_MARKERS:
+            height, width = struct.unpack('>HH', data[i + 5:i + 9])
+            return width, height
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+@timed('decode')
+def decode_image(data, max_side=ENCODE_MAX_SIDE):
+    """
+    Decode an encoded image buffer to BGR, letting libjpeg skip detail we
+    would throw away: the image is decoded at 1/2, 1/4 or 1/8 scale as long
+    as its longest side stays at or above max_side.
+    """
+    buffer = np.frombuffer(data, np.uint8)
+    flag = cv2.IMREAD_COLOR
+    dimensions = image_dimensions(data)
+    if dimensions:
+        longest = max(dimensions)
+        for factor, reduced_flag in _REDUCED_FLAGS:
+            if longest // factor >= max_side:
+                flag = reduced_flag
+                break
+    return cv2.imdecode(buffer, flag)
+
+
+def read_image(path, max_side=ENCODE_MAX_SIDE):
+    """
+    decode_image for a file on disk
+    """
+    with open(path, 'rb') as f:
+        return decode_image(f.read(), max_side)
+
+
+@timed('detect')
+def find_faces(image, max_side=DETECT_MAX_SIDE, upsample=DETECT_UPSAMPLE):
+    """
+    Run HOG face detection on a downscaled RGB copy of a BGR image.
+    Returns face_recognition (top, right, bottom, left) boxes in the
+    coordinates of the given image.
+    """
+    height, width = image.shape[:2]
+    scale = min(1.0, max_side / float(max(height, width)))
+    small = image
+    if scale < 1.0:
+        small = cv2.resize(image, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
+
+    locations = []
+    for top, right, bottom, left in face_recognition.face_locations(small, number_of_times_to_upsample=upsample):
+        locations.append((
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale)),
+        ))
+    return locations
+
+
+@timed('encode')
+def encode_faces(image, locations, padding=CROP_PADDING):
+    """
+    Compute 128-d encodings for face boxes of a BGR image. Each face is
+    encoded from a padded RGB crop, so only the pixels around the face are
+    converted and handed to dlib.
+    """
+    height, width = image.shape[:2]
+    encodings = []
+    for top, right, bottom, left in locations:
+        pad_y = int((bottom - top) * padding)
+        pad_x = int((right - left) * padding)
+        y0, y1 = max(0, top - pad_y), min(height, bottom + pad_y)
+        x0, x1 = max(0, left - pad_x), min(width, right + pad_x)
+        crop = cv2.cvtColor(image[y0:y1, x0:x1], cv2.COLOR_BGR2RGB)
+        local = (top - y0, right - x0, bottom - y0, left - x0)
+        encodings.append(face_recognition.face_encodings(crop, [local])[0])
+    return encodings
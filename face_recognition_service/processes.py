@@ -0,0 +1,15 @@
+import os
+
+
+def pid_alive(pid):
+    """
+    Whether a process with this pid exists, including one owned by another
+    user
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
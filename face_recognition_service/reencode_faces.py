@@ -0,0 +1,208 @@
+"""
+Re-encode faces that were computed from BGR frames, before images were
+converted to RGB for dlib.
+
+    python reencode_faces.py [--dry-run]
+
+Run it against the existing database before (or right after) deploying
+the RGB pipeline. For each employee in the faces collection the image is
+taken from, in order: the archived image_url on the faces document, the
+faceImageUrl on the employee's users document, and the newest
+employee_faces/employee_<id>_<timestamp> asset the service uploaded to
+Cloudinary. The employee's legacy templates are replaced by one template
+encoded from it; templates already recorded as RGB are kept. Node users'
+faceEmbeddings are re-encoded from their faceImageUrl the same way.
+
+Employees for whom no image yields exactly one face are listed in the JSON
+report and need to re-enroll. Send SIGHUP to the face service afterwards
+to reload its gallery.
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+from datetime import datetime
+import requests
+from db_config import face_collection, employee_collection, encode_face_encoding
+from gallery_index import stored_templates, summarize_templates
+from face_templates import (evict_templates, is_legacy, SOURCE_ENROLLMENT, COLOR_SPACE,
+                            LEGACY_FACES_QUERY, LEGACY_USERS_QUERY)
+from preprocessing import decode_image, find_faces, encode_faces
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_TIMEOUT = 30
+CLOUDINARY_FOLDER = 'employee_faces'
+# Suffix upload_face gives its Cloudinary public ids: employee_<id>_<timestamp>
+_ARCHIVE_STAMP = re.compile(r'\d{8}_\d{6}')
+
+
+def configure_cloudinary():
+    """
+    True when Cloudinary credentials are set, after configuring the client
+    """
+    if not os.getenv('CLOUDINARY_CLOUD_NAME'):
+        return False
+    import cloudinary
+    cloudinary.config(
+        cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
+        api_key=os.getenv('CLOUDINARY_API_KEY'),
+        api_secret=os.getenv('CLOUDINARY_API_SECRET')
+    )
+    return True
+
+
+def cloudinary_image(employee_id):
+    """
+    URL of the newest image archived for the employee on Cloudinary, or None
+    """
+    import cloudinary.api
+    import cloudinary.exceptions
+    prefix = f'{CLOUDINARY_FOLDER}/employee_{employee_id}_'
+    try:
+        resources = cloudinary.api.resources(type='upload', prefix=prefix, max_results=500).get('resources', [])
+    except cloudinary.exceptions.Error as e:
+        logger.warning(f"Cloudinary lookup for {employee_id} failed: {e}")
+        return None
+    archived = [r for r in resources if _ARCHIVE_STAMP.fullmatch(r['public_id'][len(prefix):])]
+    if not archived:
+        return None
+    return max(archived, key=lambda r: r['public_id'])['secure_url']
+
+
+def image_urls(face, user_collection, use_cloudinary):
+    """
+    Candidate images of a faces document's employee, best first
+    """
+    if face.get('image_url'):
+        yield face['image_url']
+    employee_id = face['employee_id']
+    user = user_collection.find_one({'$or': [{'employee_id': employee_id}, {'employeeId': employee_id}]},
+                                    {'faceImageUrl': 1})
+    if user and user.get('faceImageUrl'):
+        yield user['faceImageUrl']
+    if use_cloudinary:
+        url = cloudinary_image(employee_id)
+        if url:
+            yield url
+
+
+def encode_image_url(url):
+    """
+    (encoding, None) for the single face in the image at url, or
+    (None, reason) when it cannot be used
+    """
+    try:
+        response = requests.get(url, timeout=DOWNLOAD_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        return None, f'download_failed: {e}'
+    image = decode_image(response.content)
+    if image is None:
+        return None, 'invalid_image'
+    locations = find_faces(image)
+    if not locations:
+        return None, 'no_face'
+    if len(locations) > 1:
+        return None, 'multiple_faces'
+    return encode_faces(image, locations)[0], None
+
+
+def encode_first(urls):
+    """
+    Encoding of the first usable image; the last reason when none is
+    """
+    error = 'no_image'
+    for url in urls:
+        encoding, error = encode_image_url(url)
+        if error is None:
+            return encoding, None
+    return None, error
+
+
+def reencode_face(collection, face, encoding):
+    """
+    Replace one faces document's legacy templates with encoding; returns
+    None on success or the reason the employee needs to re-enroll
+    """
+    now = datetime.utcnow()
+    templates = [template for template in face.get('templates') or [] if not is_legacy(template)]
+    templates = evict_templates([{'encoding': encode_face_encoding(encoding), 'source': SOURCE_ENROLLMENT,
+                                  'color_space': COLOR_SPACE, 'created_at': now}] + templates)
+    centroid, spread = summarize_templates(stored_templates({'templates': templates}))
+
+    # Skip the document if a new enrollment or scan wrote it meanwhile
+    revision = face.get('revision')
+    query = {'_id': face['_id'], 'revision': revision if revision is not None else {'$exists': False}}
+    result = collection.update_one(query, {
+        '$set': {
+            'templates': templates,
+            'centroid': encode_face_encoding(centroid),
+            'spread': spread,
+            'revision': (revision or 0) + 1,
+            'updated_at': now,
+        },
+        '$unset': {'face_encoding': ''},
+    })
+    return None if result.matched_count else 'changed_during_migration'
+
+
+def reencode(collection, user_collection, dry_run=False, use_cloudinary=False):
+    """
+    Re-encode every faces document and Node user with legacy encodings.
+    Returns (ids re-encoded, [{'employee_id', 'error'}] of those left to
+    re-enroll).
+    """
+    reencoded = []
+    reenroll = []
+
+    def record(employee_id, error):
+        if error:
+            logger.warning(f"Employee {employee_id} needs to re-enroll: {error}")
+            reenroll.append({'employee_id': employee_id, 'error': error})
+        else:
+            reencoded.append(employee_id)
+
+    projection = {'employee_id': 1, 'templates': 1, 'face_encoding': 1, 'image_url': 1, 'revision': 1}
+    for face in collection.find(LEGACY_FACES_QUERY, projection):
+        encoding, error = encode_first(image_urls(face, user_collection, use_cloudinary))
+        if error is None and not dry_run:
+            error = reencode_face(collection, face, encoding)
+        record(face['employee_id'], error)
+
+    for user in user_collection.find(LEGACY_USERS_QUERY, {'employeeId': 1, 'email': 1, 'faceImageUrl': 1}):
+        employee_id = user.get('employeeId') or user.get('email')
+        encoding, error = encode_first([user['faceImageUrl']] if user.get('faceImageUrl') else [])
+        if error is None and not dry_run:
+            result = user_collection.update_one(
+                {'_id': user['_id'], 'faceColorSpace': {'$ne': COLOR_SPACE}},
+                {'$set': {'faceEmbeddings': encoding.tolist(), 'faceColorSpace': COLOR_SPACE}}
+            )
+            error = None if result.matched_count else 'changed_during_migration'
+        record(employee_id, error)
+    return reencoded, reenroll
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dry-run', action='store_true', help='Check the images without writing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    use_cloudinary = configure_cloudinary()
+    if not use_cloudinary:
+        logger.warning('CLOUDINARY_CLOUD_NAME is not set; images archived only on Cloudinary will not be found')
+    start = time.perf_counter()
+    reencoded, reenroll = reencode(face_collection, employee_collection, args.dry_run, use_cloudinary)
+    verb = 'Would re-encode' if args.dry_run else 'Re-encoded'
+    logger.info(f"{verb} {len(reencoded)} faces, {len(reenroll)} need re-enrollment, "
+                f"in {time.perf_counter() - start:.1f}s")
+    print(json.dumps({'reencoded': reencoded, 'reenroll': reenroll}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
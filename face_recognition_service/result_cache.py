@@ -0,0 +1,121 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+import cv2
+
+# Most recognition results kept; each entry is a few hundred bytes
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', '1024'))
+# Seconds a cached result stays valid
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', '30'))
+# Frames whose 64-bit dHash differs in at most this many bits reuse each
+# other's result; negative disables near-duplicate matching (the default,
+# since two people in front of the same background can hash closely)
+RESULT_CACHE_NEAR_BITS = int(os.environ.get('RESULT_CACHE_NEAR_BITS', '-1'))
+
+
+def dhash(image, size=8):
+    """
+    64-bit difference hash of a BGR image: the sign of horizontal gradients
+    on a (size + 1) x size grayscale thumbnail
+    """
+    small = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY).astype('int16')
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+class RecognitionCache:
+    """
+    Bounded LRU + TTL cache of recognition results for resubmitted frames.
+
+    Entries are keyed by the SHA-256 of the raw upload and, optionally, a
+    perceptual dHash of the decoded frame for near-duplicates. Each entry
+    records the version it was computed against (the caller's pipeline and
+    gallery version), so a gallery change invalidates it and one pipeline
+    never reads another's result.
+    """
+
+    def __init__(self, max_entries=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, near_bits=RESULT_CACHE_NEAR_BITS):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.near_bits = near_bits
+        # key -> (expires_at, version, fingerprint, result)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    @property
+    def near_enabled(self):
+        return self.near_bits >= 0 and self.max_entries > 0
+
+    @staticmethod
+    def key(data, namespace=''):
+        """
+        Cache key of an upload; namespace keeps the results of different
+        pipelines apart
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        digest = hashlib.sha256(namespace.encode('utf-8') + b'\0')
+        digest.update(data)
+        return digest.digest()
+
+    def get(self, key, version):
+        """
+        The cached result for an exact upload, or None
+        """
+        if self.max_entries <= 0:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now or entry[1] != version:
+                if entry is not None:
+                    del self._entries[key]
+                if not self.near_enabled:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[3]
+
+    def get_near(self, fingerprint, version):
+        """
+        The cached result of a recent frame whose dHash is within near_bits
+        of fingerprint, or None
+        """
+        now = time.monotonic()
+        with self._lock:
+            for key in reversed(self._entries):
+                expires_at, entry_version, entry_fingerprint, result = self._entries[key]
+                if entry_fingerprint is None or expires_at <= now or entry_version != version:
+                    continue
+                if bin(entry_fingerprint ^ fingerprint).count('1') <= self.near_bits:
+                    self._entries.move_to_end(key)
+                    self.near_hits += 1
+                    return result
+            self.misses += 1
+            return None
+
+    def put(self, key, version, result, fingerprint=None):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, version, fingerprint, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
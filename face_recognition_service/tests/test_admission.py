@@ -0,0 +1,189 @@
+"""
+Tests for admission control:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from admission import AdmissionController, Overloaded, PRIORITY_SCAN, PRIORITY_ENROLL  # noqa: E402
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class Requester:
+    """
+    Calls acquire on a thread and records the outcome: the slots taken,
+    or the Overloaded raised
+    """
+
+    def __init__(self, controller, name, granted, priority=PRIORITY_SCAN, slots=1, timeout=5.0):
+        self.result = None
+        self.error = None
+        self._controller = controller
+        self._name = name
+        self._granted = granted
+        self._thread = threading.Thread(target=self._run, args=(priority, slots, timeout), daemon=True)
+        self._thread.start()
+
+    def _run(self, priority, slots, timeout):
+        try:
+            self.result = self._controller.acquire(priority, timeout, slots)
+            self._granted.append(self._name)
+        except Overloaded as e:
+            self.error = e
+
+    def join(self):
+        self._thread.join(5.0)
+        return not self._thread.is_alive()
+
+
+class AdmissionControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.granted = []
+
+    def start(self, controller, name, **kwargs):
+        return Requester(controller, name, self.granted, **kwargs)
+
+    def wait_queued(self, controller, count):
+        self.assertTrue(wait_for(lambda: controller._queued() == count))
+
+    def test_free_slot_is_taken_without_waiting(self):
+        controller = AdmissionController(slots=2, max_queue=4, timeout=1.0)
+        self.assertEqual(controller.acquire(), 1)
+        self.assertEqual(controller.acquire(), 1)
+        self.assertEqual(controller._free, 0)
+        controller.release()
+        controller.release()
+        self.assertEqual(controller._free, 2)
+
+    def test_scans_are_served_before_enrollments(self):
+        controller = AdmissionController(slots=1, max_queue=8, timeout=5.0)
+        controller.acquire()
+        enroll_first = self.start(controller, 'enroll-1', priority=PRIORITY_ENROLL)
+        self.wait_queued(controller, 1)
+        enroll_second = self.start(controller, 'enroll-2', priority=PRIORITY_ENROLL)
+        self.wait_queued(controller, 2)
+        scan = self.start(controller, 'scan', priority=PRIORITY_SCAN)
+        self.wait_queued(controller, 3)
+
+        for requester in (scan, enroll_first, enroll_second):
+            controller.release()
+            self.assertTrue(requester.join())
+        self.assertEqual(self.granted, ['scan', 'enroll-1', 'enroll-2'])
+
+    def test_multi_slot_request_waits_for_enough_free_slots(self):
+        controller = AdmissionController(slots=3, max_queue=8, timeout=5.0)
+        controller.acquire()
+        controller.acquire()
+        wide = self.start(controller, 'wide', slots=3)
+        self.wait_queued(controller, 1)
+
+        controller.release()
+        time.sleep(0.05)
+        self.assertEqual(self.granted, [])
+        controller.release()
+        self.assertTrue(wide.join())
+        self.assertEqual(wide.result, 3)
+        self.assertEqual(controller._free, 0)
+
+        controller.release(slots=3)
+        self.assertEqual(controller._free, 3)
+
+    def test_multi_slot_request_is_capped_at_all_slots(self):
+        controller = AdmissionController(slots=2, max_queue=4, timeout=1.0)
+        self.assertEqual(controller.acquire(slots=5), 2)
+        self.assertEqual(controller._free, 0)
+
+    def test_higher_priority_single_slot_uses_slots_held_back_for_wider_request(self):
+        controller = AdmissionController(slots=2, max_queue=8, timeout=5.0)
+        controller.acquire()
+        wide = self.start(controller, 'wide', priority=PRIORITY_ENROLL, slots=2)
+        self.wait_queued(controller, 1)
+        # One slot is free but held back for the wider enrollment
+        self.assertEqual(controller._free, 1)
+
+        scan = self.start(controller, 'scan', priority=PRIORITY_SCAN)
+        self.assertTrue(scan.join())
+        self.assertEqual(self.granted, ['scan'])
+
+        controller.release()
+        controller.release()
+        self.assertTrue(wide.join())
+        self.assertEqual(self.granted, ['scan', 'wide'])
+
+    def test_full_queue_is_rejected_with_429(self):
+        controller = AdmissionController(slots=1, max_queue=1, timeout=5.0)
+        controller.acquire()
+        waiting = self.start(controller, 'waiting')
+        self.wait_queued(controller, 1)
+
+        with self.assertRaises(Overloaded) as raised:
+            controller.acquire()
+        self.assertEqual(raised.exception.status, 429)
+        self.assertGreaterEqual(raised.exception.retry_after, 1)
+
+        controller.release()
+        self.assertTrue(waiting.join())
+
+    def test_deadline_passed_while_queued_is_rejected_with_503(self):
+        controller = AdmissionController(slots=1, max_queue=4, timeout=5.0)
+        controller.acquire()
+        start = time.monotonic()
+        with self.assertRaises(Overloaded) as raised:
+            controller.acquire(timeout=0.1)
+        self.assertEqual(raised.exception.status, 503)
+        self.assertLess(time.monotonic() - start, 2.0)
+        self.assertEqual(controller._queued(), 0)
+
+        # The cancelled waiter is skipped, not handed the slot
+        controller.release()
+        self.assertEqual(controller._free, 1)
+
+    def test_cancelled_wide_request_unblocks_requests_behind_it(self):
+        controller = AdmissionController(slots=2, max_queue=8, timeout=5.0)
+        controller.acquire()
+        wide = self.start(controller, 'wide', slots=2, timeout=0.2)
+        self.wait_queued(controller, 1)
+        narrow = self.start(controller, 'narrow', priority=PRIORITY_ENROLL)
+
+        self.assertTrue(wide.join())
+        self.assertEqual(wide.error.status, 503)
+        self.assertTrue(narrow.join())
+        self.assertEqual(self.granted, ['narrow'])
+        self.assertEqual(controller._free, 0)
+
+    def test_admit_releases_its_slots(self):
+        controller = AdmissionController(slots=2, max_queue=4, timeout=1.0)
+        with controller.admit(slots=2):
+            self.assertEqual(controller._free, 0)
+        self.assertEqual(controller._free, 2)
+
+        with self.assertRaises(RuntimeError):
+            with controller.admit():
+                raise RuntimeError('pipeline failed')
+        self.assertEqual(controller._free, 2)
+
+    def test_nonpositive_timeout_never_waits(self):
+        controller = AdmissionController(slots=1, max_queue=4, timeout=1.0)
+        controller.acquire()
+        with self.assertRaises(Overloaded) as raised:
+            controller.acquire(timeout=0)
+        self.assertEqual(raised.exception.status, 429)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""
+Tests for the archive outbox, run against LocalUploader:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from archive_outbox import ArchiveOutbox, LocalUploader  # noqa: E402
+
+
+class FlakyUploader(LocalUploader):
+    """
+    LocalUploader that fails its first `failures` uploads and records when
+    each attempt was made
+    """
+
+    def __init__(self, directory, failures=0):
+        super().__init__(directory)
+        self.failures = failures
+        self.attempts = []
+        self.lock = threading.Lock()
+
+    def upload(self, path, folder, public_id):
+        with self.lock:
+            self.attempts.append(time.monotonic())
+            if len(self.attempts) <= self.failures:
+                raise ConnectionError('upload failed')
+        return super().upload(path, folder, public_id)
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return condition()
+
+
+class ArchiveOutboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='outbox-test-')
+        self.spool = os.path.join(self.root, 'outbox')
+        self.uploaded = os.path.join(self.root, 'uploaded')
+        self.archived = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def make_outbox(self, uploader, max_attempts=5, backoff=0.05):
+        return ArchiveOutbox(self.spool, uploader=uploader, workers=1, max_attempts=max_attempts,
+                             backoff=backoff, on_uploaded=lambda job, url: self.archived.append((job, url)))
+
+    def test_retries_with_backoff_until_uploaded(self):
+        uploader = FlakyUploader(self.uploaded, failures=3)
+        outbox = self.make_outbox(uploader, backoff=0.05)
+        outbox.enqueue(b'image', 'employee_faces', 'E1', {'employee_id': 'E1'})
+
+        self.assertTrue(wait_for(lambda: self.archived))
+        self.assertEqual(len(uploader.attempts), 4)
+        # Retry n waits backoff * 2 ** (n - 1), less at most half for jitter
+        gaps = [b - a for a, b in zip(uploader.attempts, uploader.attempts[1:])]
+        for n, gap in enumerate(gaps, start=1):
+            self.assertGreaterEqual(gap, 0.05 * 2 ** (n - 1) * 0.5)
+        job, url = self.archived[0]
+        self.assertEqual(job['meta'], {'employee_id': 'E1'})
+        self.assertEqual(url, outbox.url_for('employee_faces', 'E1'))
+        with open(os.path.join(self.uploaded, 'employee_faces', 'E1'), 'rb') as f:
+            self.assertEqual(f.read(), b'image')
+        self.assertTrue(wait_for(lambda: outbox.pending() == 0))
+        self.assertEqual(os.listdir(os.path.join(self.spool, 'failed')), [])
+
+    def test_moves_job_to_failed_after_max_attempts(self):
+        uploader = FlakyUploader(self.uploaded, failures=100)
+        outbox = self.make_outbox(uploader, max_attempts=3, backoff=0.01)
+        job_id = outbox.enqueue(b'image', 'employee_faces', 'E2')
+
+        failed = os.path.join(self.spool, 'failed')
+        self.assertTrue(wait_for(lambda: os.path.exists(os.path.join(failed, f'{job_id}.json'))))
+        self.assertEqual(len(uploader.attempts), 3)
+        with open(os.path.join(failed, f'{job_id}.json')) as f:
+            job = json.load(f)
+        self.assertEqual(job['attempts'], 3)
+        self.assertEqual(job['last_error'], 'upload failed')
+        with open(os.path.join(failed, f'{job_id}.bin'), 'rb') as f:
+            self.assertEqual(f.read(), b'image')
+        self.assertEqual(outbox.pending(), 0)
+        self.assertEqual(self.archived, [])
+
+    def test_recovers_jobs_left_by_a_previous_run(self):
+        # One job left unclaimed and one claimed by a process that has died
+        os.makedirs(self.spool)
+        dead_pid = 2 ** 22 + 12345
+        for job_id, record in (('a' * 32, f"{'a' * 32}.json"), ('b' * 32, f"{'b' * 32}.{dead_pid}.json")):
+            with open(os.path.join(self.spool, f'{job_id}.bin'), 'wb') as f:
+                f.write(job_id.encode())
+            with open(os.path.join(self.spool, record), 'w') as f:
+                json.dump({'id': job_id, 'folder': 'employee_faces', 'public_id': job_id, 'meta': {},
+                           'attempts': 1, 'created_at': time.time()}, f)
+
+        outbox = self.make_outbox(FlakyUploader(self.uploaded))
+        outbox.start()
+
+        self.assertTrue(wait_for(lambda: len(self.archived) == 2))
+        self.assertEqual(sorted(job['public_id'] for job, _ in self.archived), ['a' * 32, 'b' * 32])
+        self.assertTrue(wait_for(lambda: outbox.pending() == 0))
+        for job_id in ('a' * 32, 'b' * 32):
+            with open(os.path.join(self.uploaded, 'employee_faces', job_id), 'rb') as f:
+                self.assertEqual(f.read(), job_id.encode())
+
+    def test_leaves_jobs_claimed_by_a_live_process(self):
+        os.makedirs(self.spool)
+        job_id = 'c' * 32
+        with open(os.path.join(self.spool, f'{job_id}.bin'), 'wb') as f:
+            f.write(b'image')
+        # The test runner's parent is alive and not this process
+        with open(os.path.join(self.spool, f'{job_id}.{os.getppid()}.json'), 'w') as f:
+            json.dump({'id': job_id, 'folder': 'employee_faces', 'public_id': job_id, 'meta': {}, 'attempts': 0}, f)
+
+        uploader = FlakyUploader(self.uploaded)
+        outbox = self.make_outbox(uploader)
+        outbox.start()
+        time.sleep(0.2)
+        self.assertEqual(uploader.attempts, [])
+        self.assertEqual(outbox.pending(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
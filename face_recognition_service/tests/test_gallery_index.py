@@ -0,0 +1,131 @@
+"""
+Tests for the gallery's two-stage search, checked against exact search over
+every template. db_config connects on import, so MongoDB is replaced by
+mongomock as in the benchmarks:
+
+    python -m pytest tests
+"""
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import mongomock
+except ImportError:
+    raise unittest.SkipTest('The gallery tests need mongomock: pip install mongomock')
+import pymongo  # noqa: E402
+pymongo.MongoClient = mongomock.MongoClient
+os.environ.setdefault('MONGODB_ENSURE_INDEXES', '0')
+
+from gallery_index import GalleryIndex, build_arrays, ENCODING_DIM  # noqa: E402
+
+
+def random_gallery(employees, max_templates, seed):
+    """
+    {employee_id: (n, 128) templates} shaped like dlib encodings: identity
+    centres with per-template noise
+    """
+    rng = np.random.default_rng(seed)
+    gallery = {}
+    for i in range(employees):
+        centre = rng.normal(0, 0.1, ENCODING_DIM)
+        count = int(rng.integers(1, max_templates + 1))
+        gallery[f'EMP{i:04d}'] = (centre + rng.normal(0, 0.02, (count, ENCODING_DIM))).astype(np.float32)
+    return gallery
+
+
+def exact_match(gallery, query, tolerance):
+    """
+    Nearest template over the whole gallery, by brute force
+    """
+    best_id, best_distance = None, np.inf
+    for employee_id, templates in gallery.items():
+        distance = float(np.linalg.norm(templates - query, axis=1).min())
+        if distance < best_distance:
+            best_id, best_distance = employee_id, distance
+    return (best_id if best_distance <= tolerance else None), best_distance
+
+
+def loaded_index(gallery, matcher='brute_force', top_k=8):
+    index = GalleryIndex(matcher=matcher, top_k=top_k)
+    index._swap_locked(build_arrays(gallery), None)
+    return index
+
+
+class GalleryIndexMatchTest(unittest.TestCase):
+
+    def assertMatchesExact(self, index, gallery, queries, tolerance=0.6):
+        results = index.match_many(queries, tolerance)
+        self.assertEqual(len(results), len(queries))
+        for query, (employee_id, distance) in zip(queries, results):
+            expected_id, expected_distance = exact_match(gallery, query, tolerance)
+            self.assertEqual(employee_id, expected_id)
+            self.assertAlmostEqual(distance, expected_distance, places=4)
+
+    def test_rerank_matches_exact_search_for_noisy_templates(self):
+        gallery = random_gallery(300, 4, seed=1)
+        rng = np.random.default_rng(2)
+        ids = list(gallery)
+        queries = np.asarray([
+            gallery[ids[i]][rng.integers(len(gallery[ids[i]]))] + rng.normal(0, 0.02, ENCODING_DIM)
+            for i in rng.choice(len(ids), 100, replace=False)
+        ], dtype=np.float32)
+        for matcher in ('brute_force', 'ivf'):
+            with self.subTest(matcher=matcher):
+                self.assertMatchesExact(loaded_index(gallery, matcher), gallery, queries)
+
+    def test_rerank_picks_nearest_template_not_nearest_centroid(self):
+        # A's centroid is nearer the query, but B has the nearest template
+        base = np.zeros(ENCODING_DIM, dtype=np.float32)
+        offset = np.zeros(ENCODING_DIM, dtype=np.float32)
+        offset[0] = 1.0
+        gallery = {
+            'A': np.stack([base + 0.2 * offset, base - 0.2 * offset]),
+            'B': np.stack([base + 0.1 * offset, base + 2.0 * offset]),
+        }
+        index = loaded_index(gallery, top_k=2)
+        employee_id, distance = index.match(base + 0.1 * offset)
+        self.assertEqual(employee_id, 'B')
+        self.assertAlmostEqual(distance, 0.0, places=5)
+        self.assertMatchesExact(index, gallery, [base + 0.1 * offset, base - 0.3 * offset])
+
+    def test_full_top_k_is_exact_for_any_query(self):
+        gallery = random_gallery(50, 3, seed=3)
+        queries = np.random.default_rng(4).normal(0, 0.1, (40, ENCODING_DIM)).astype(np.float32)
+        self.assertMatchesExact(loaded_index(gallery, top_k=len(gallery)), gallery, queries)
+
+    def test_query_beyond_tolerance_reports_distance_without_match(self):
+        gallery = random_gallery(20, 2, seed=5)
+        far = np.full(ENCODING_DIM, 5.0, dtype=np.float32)
+        employee_id, distance = loaded_index(gallery).match(far, tolerance=0.6)
+        self.assertIsNone(employee_id)
+        self.assertGreater(distance, 0.6)
+
+    def test_empty_gallery_matches_nothing(self):
+        index = GalleryIndex()
+        queries = np.zeros((3, ENCODING_DIM), dtype=np.float32)
+        self.assertEqual(index.match_many(queries), [(None, None)] * 3)
+
+    def test_search_stays_exact_after_upserts_and_removal(self):
+        gallery = random_gallery(100, 3, seed=6)
+        index = loaded_index(gallery)
+        changes = random_gallery(110, 3, seed=7)
+        updates = {employee_id: changes[employee_id] for employee_id in ('EMP0003', 'EMP0050', 'EMP0105', 'EMP0109')}
+        index.upsert_many(updates)
+        gallery.update(updates)
+        index.remove('EMP0010')
+        del gallery['EMP0010']
+
+        arrays, expected = index.arrays(), build_arrays(gallery)
+        self.assertEqual(sorted(arrays.employee_ids), sorted(expected.employee_ids))
+        rng = np.random.default_rng(8)
+        queries = np.asarray([templates[0] + rng.normal(0, 0.02, ENCODING_DIM)
+                              for templates in gallery.values()], dtype=np.float32)
+        self.assertMatchesExact(index, gallery, queries)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+import os
+import time
+import uuid
+import threading
+import itertools
+
+# Full face detection runs on every Nth frame of a kiosk stream; frames in
+# between are acknowledged with the current tracks without being decoded
+KIOSK_DETECT_EVERY = int(os.environ.get('KIOSK_DETECT_EVERY', '5'))
+# A detection continues a track when its box overlaps the track's by this IoU
+KIOSK_TRACK_IOU = float(os.environ.get('KIOSK_TRACK_IOU', '0.3'))
+# A track is dropped after this many detection passes without a matching box
+KIOSK_TRACK_MAX_MISSES = int(os.environ.get('KIOSK_TRACK_MAX_MISSES', '2'))
+# Identified tracks are re-encoded when their box has drifted below this IoU
+# with the box they were last encoded from
+KIOSK_REENCODE_IOU = float(os.environ.get('KIOSK_REENCODE_IOU', '0.5'))
+# Identities matched farther than this are re-checked on the next detection
+# pass until they firm up
+KIOSK_CONFIDENT_DISTANCE = float(os.environ.get('KIOSK_CONFIDENT_DISTANCE', '0.45'))
+# Unrecognized tracks are retried on every detection pass up to this many times
+KIOSK_MAX_ENCODES = int(os.environ.get('KIOSK_MAX_ENCODES', '5'))
+# Idle kiosk sessions are discarded after this many seconds
+KIOSK_SESSION_TTL = float(os.environ.get('KIOSK_SESSION_TTL', '300'))
+
+
+def box_iou(a, b):
+    """
+    Intersection over union of two (top, right, bottom, left) boxes
+    """
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    if bottom <= top or right <= left:
+        return 0.0
+    intersection = (bottom - top) * (right - left)
+    area_a = (a[2] - a[0]) * (a[1] - a[3])
+    area_b = (b[2] - b[0]) * (b[1] - b[3])
+    return intersection / float(area_a + area_b - intersection)
+
+
+class Track:
+    """
+    One face followed across frames
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, box):
+        self.track_id = next(self._ids)
+        self.box = box
+        self.misses = 0
+        self.employee_id = None
+        self.distance = None
+        self.encoded_box = None
+        self.encodes = 0
+        # Attendance result for this track, set once per track
+        self.event = None
+
+    def needs_encoding(self):
+        if self.encoded_box is None:
+            return True
+        if self.employee_id is None:
+            return self.encodes < KIOSK_MAX_ENCODES
+        if self.distance > KIOSK_CONFIDENT_DISTANCE and self.encodes < KIOSK_MAX_ENCODES:
+            return True
+        return box_iou(self.box, self.encoded_box) < KIOSK_REENCODE_IOU
+
+    def to_dict(self):
+        return {
+            'trackId': self.track_id,
+            'box': list(self.box),
+            'employeeId': self.employee_id,
+            'distance': self.distance,
+            'event': self.event,
+        }
+
+
+class KioskSession:
+    """
+    Face tracking state for one kiosk's frame stream.
+
+    Detection runs every detect_every frames; detected boxes are associated
+    with existing tracks by greedy IoU. A face is encoded and matched only
+    when its track is new, not yet confidently identified, or has moved
+    away from where it was last encoded, and each track triggers at most
+    one attendance event.
+
+    The pipeline stages are injected: decode(bytes) -> image,
+    detect(image) -> boxes, encode(image, boxes) -> encodings,
+    match(encodings) -> [(employee_id, distance)] and
+    on_identified(employee_id, distance, encoding) -> event dict.
+    """
+
+    def __init__(self, decode, detect, encode, match, on_identified, detect_every=KIOSK_DETECT_EVERY):
+        self.session_id = uuid.uuid4().hex
+        self.decode = decode
+        self.detect = detect
+        self.encode = encode
+        self.match = match
+        self.on_identified = on_identified
+        self.detect_every = max(1, detect_every)
+        self.frames = 0
+        self.detections = 0
+        self.encodings = 0
+        self.tracks = []
+        self.last_seen = time.monotonic()
+        self._lock = threading.Lock()
+
+    def process(self, frame):
+        """
+        Feed one encoded frame; returns the session's view after it
+        """
+        with self._lock:
+            self.last_seen = time.monotonic()
+            index = self.frames
+            self.frames += 1
+            detected = index % self.detect_every == 0
+            if detected:
+                image = self.decode(frame)
+                if image is None:
+                    return {'frame': index, 'error': 'Invalid image'}
+                self._update_tracks(self.detect(image))
+                self._identify(image)
+                self.detections += 1
+            return {
+                'frame': index,
+                'detected': detected,
+                'tracks': [track.to_dict() for track in self.tracks],
+            }
+
+    def stats(self):
+        return {
+            'sessionId': self.session_id,
+            'frames': self.frames,
+            'detections': self.detections,
+            'encodings': self.encodings,
+            'tracks': len(self.tracks),
+        }
+
+    def _update_tracks(self, boxes):
+        pairs = sorted(
+            ((box_iou(track.box, box), t, b) for t, track in enumerate(self.tracks) for b, box in enumerate(boxes)),
+            reverse=True,
+        )
+        used_tracks, used_boxes = set(), set()
+        for iou, t, b in pairs:
+            if iou < KIOSK_TRACK_IOU:
+                break
+            if t in used_tracks or b in used_boxes:
+                continue
+            used_tracks.add(t)
+            used_boxes.add(b)
+            self.tracks[t].box = boxes[b]
+            self.tracks[t].misses = 0
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in used_tracks:
+                track.misses += 1
+                if track.misses > KIOSK_TRACK_MAX_MISSES:
+                    continue
+            survivors.append(track)
+        survivors.extend(Track(box) for b, box in enumerate(boxes) if b not in used_boxes)
+        self.tracks = survivors
+
+    def _identify(self, image):
+        pending = [track for track in self.tracks if track.misses == 0 and track.needs_encoding()]
+        if not pending:
+            return
+        encodings = self.encode(image, [track.box for track in pending])
+        self.encodings += len(encodings)
+        for track, encoding, (employee_id, distance) in zip(pending, encodings, self.match(encodings)):
+            track.encoded_box = track.box
+            track.encodes += 1
+            if employee_id is None:
+                if track.employee_id is None:
+                    track.distance = distance
+                continue
+            if track.employee_id is None or distance <= track.distance:
+                track.employee_id = employee_id
+                track.distance = distance
+            if track.event is None:
+                track.event = self.on_identified(track.employee_id, track.distance, encoding)
+
+
+class KioskSessions:
+    """
+    Live kiosk sessions of this process, expired after KIOSK_SESSION_TTL
+    idle seconds
+    """
+
+    def __init__(self, factory, ttl=KIOSK_SESSION_TTL):
+        self.factory = factory
+        self.ttl = ttl
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def create(self):
+        session = self.factory()
+        with self._lock:
+            self._expire_locked()
+            self._sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            self._expire_locked()
+            return self._sessions.get(session_id)
+
+    def get_or_create(self, session_id):
+        """
+        The session with this id, or a fresh one registered under it (for
+        example when a prefork server routed the kiosk to another worker)
+        """
+        with self._lock:
+            self._expire_locked()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self.factory()
+                session.session_id = session_id
+                self._sessions[session_id] = session
+            return session
+
+    def close(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None)
+
+    def _expire_locked(self):
+        cutoff = time.monotonic() - self.ttl
+        for session_id in [s for s, session in self._sessions.items() if session.last_seen < cutoff]:
+            del self._sessions[session_id]
@@ -0,0 +1,50 @@
+import os
+import base64
+from io import BytesIO
+from flask import Request, request
+
+# Multipart uploads up to this many bytes are parsed into memory; larger
+# ones are spooled to a temporary file
+UPLOAD_MEMORY_LIMIT = int(os.environ.get('UPLOAD_MEMORY_LIMIT', str(16 * 1024 * 1024)))
+
+
+class UploadRequest(Request):
+    """
+    Request that keeps multipart files in memory, instead of werkzeug's
+    default of spooling anything over 500 KB to a temporary file
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if total_content_length is not None and total_content_length <= UPLOAD_MEMORY_LIMIT:
+            return BytesIO()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+
+def is_raw_image(mimetype):
+    return mimetype == 'application/octet-stream' or mimetype.startswith('image/')
+
+
+def request_image(field='image'):
+    """
+    The image uploaded with the current request: the raw body
+    (application/octet-stream or image/*), a multipart file, or base64 text
+    in a JSON body. Raw and multipart uploads are returned as bytes, JSON
+    ones as the base64 str; None when there is no image.
+    """
+    if is_raw_image(request.mimetype):
+        return request.get_data(cache=False) or None
+    if request.mimetype == 'multipart/form-data':
+        upload = request.files.get(field)
+        return upload.read() if upload else None
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return None
+    return data.get(field) or None
+
+
+def decode_base64(image_b64):
+    """
+    Bytes of a base64 image, with or without a data-URL prefix
+    """
+    image_data = image_b64.split(',')[1] if ',' in image_b64 else image_b64
+    return base64.b64decode(image_data)